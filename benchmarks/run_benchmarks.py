@@ -0,0 +1,172 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import sqlalchemy
+
+from benchmarks.synthetic import SCALES, create_synthetic_db
+from humaniki_schema.utils import Properties
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+DEFAULT_SCALES = ['small', 'medium']
+DEFAULT_REPEAT = 20
+# the gap queries every benchmark runs, one per properties shape of benchmarks.synthetic
+BENCHMARK_QUERIES = [{'citizenship': 'all'},
+                     {'occupation': 'all', 'label_lang': 'en'},
+                     {'date_of_birth': 'all'},
+                     {'date_of_birth': 'all', 'bucket': 'decade'},
+                     {'project': 'all', 'date_of_birth': '1850~1900'},
+                     {'citizenship': 'all', 'occupation': 'all', 'label_lang': 'fr'},
+                     {'citizenship': 'all', 'occupation': 'all', 'label_lang': 'fr', 'sort': 'gap_ratio',
+                      'limit': '200'}]
+BENCHMARK_POPULATION = 'gte_one_sitelink'
+
+
+def time_repeatedly(fn, repeat, before_each=None):
+    """:return: summary statistics of repeat calls of fn, in milliseconds"""
+    durations = []
+    for _ in range(repeat):
+        if before_each is not None:
+            before_each()
+        call_start = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - call_start) * 1000)
+    durations.sort()
+    return {'repeat': repeat,
+            'min_ms': durations[0],
+            'median_ms': statistics.median(durations),
+            'p95_ms': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+            'max_ms': durations[-1]}
+
+
+def query_name(query_params):
+    return '&'.join(f'{param}={val}' for param, val in query_params.items())
+
+
+def benchmark_scale(scale_name, repeat, db_dir):
+    """
+    generate scale_name into sqlite and benchmark it. this runs in a fresh process per scale,
+    so that none of the app's process-wide caches carry over between datasets.
+    :return: a results dict for this scale
+    """
+    from humaniki_schema import db
+
+    db_path = os.path.join(db_dir, f'humaniki-{scale_name}.sqlite')
+    generate_start = time.time()
+    engine, row_counts = create_synthetic_db(db_path, scale_name)
+    generate_seconds = time.time() - generate_start
+    # the app binds its scoped session to this factory on import
+    db.session_factory.configure(bind=engine)
+
+    from humaniki_backend import app
+    from humaniki_backend.labels import load_language_labels
+    from humaniki_backend.query import get_aggregations_id_preds, get_metrics, build_gap_response
+    from humaniki_backend.reference import reference_data
+    from humaniki_backend.utils import order_query_params, determine_population_conflict, parse_gap_ranking, \
+        parse_year_bucket
+
+    client = app.app.test_client()
+    session = db.session_factory()
+    fill_id = app.fill_registry.snapshot().latest_fill_id
+    results = []
+    try:
+        for query_params in BENCHMARK_QUERIES:
+            ordered_query_params, non_orderable_query_params = order_query_params(query_params)
+            label_lang = non_orderable_query_params.get('label_lang')
+            ranking = parse_gap_ranking(non_orderable_query_params)
+            bucket_width = parse_year_bucket(non_orderable_query_params, ordered_query_params)
+            population_id, _, _ = determine_population_conflict(BENCHMARK_POPULATION, query_params)
+            properties_obj = reference_data.get_properties_obj(session, ordered_query_params.keys(),
+                                                               bias_property=Properties.GENDER.value)
+            aggregations_id_preds = get_aggregations_id_preds(session, ordered_query_params,
+                                                              non_orderable_query_params, as_subquery=True)
+
+            def run_get_metrics():
+                return get_metrics(session, fill_id, population_id, properties_obj, aggregations_id_preds,
+                                   ranking=ranking, bucket_width=bucket_width)
+
+            metrics, metrics_columns = run_get_metrics()
+            url = f'/v1/gender/gap/latest/{BENCHMARK_POPULATION}/properties?{query_name(query_params)}'
+            benchmarks = {
+                'get_metrics': time_repeatedly(run_get_metrics, repeat),
+                'build_gap_response': time_repeatedly(
+                    lambda: build_gap_response(properties_obj, metrics, metrics_columns, label_lang, session), repeat),
+                'gap_route_uncached': time_repeatedly(lambda: client.get(url).get_data(), repeat,
+                                                      before_each=app.gap_cache.clear),
+                'gap_route_cached': time_repeatedly(lambda: client.get(url).get_data(), repeat),
+            }
+            for benchmark_name, timings in benchmarks.items():
+                results.append({'benchmark': benchmark_name, 'query': query_name(query_params),
+                                'metric_rows': len(metrics), **timings})
+        # label_metric_query is gone, labels are now resolved from one whole-language load per worker
+        for label_lang in ('en', 'fr'):
+            timings = time_repeatedly(lambda: load_language_labels(session, label_lang), max(1, repeat // 4))
+            results.append({'benchmark': 'load_language_labels', 'query': f'label_lang={label_lang}', **timings})
+    finally:
+        session.close()
+    return {'scale': scale_name, 'scale_params': SCALES[scale_name], 'row_counts': row_counts,
+            'generate_seconds': generate_seconds, 'results': results}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_runs(previous_run, current_run):
+    """print the median of every benchmark in current_run next to the same one in previous_run"""
+    previous_medians = {(scale_run['scale'], result['benchmark'], result['query']): result['median_ms']
+                        for scale_run in previous_run['scales'] for result in scale_run['results']}
+    for scale_run in current_run['scales']:
+        for result in scale_run['results']:
+            key = (scale_run['scale'], result['benchmark'], result['query'])
+            previous_median = previous_medians.get(key)
+            change = f'{"%.2f" % (result["median_ms"] / previous_median)}x' if previous_median else 'new'
+            print(f'{key[0]:8} {key[1]:22} {key[2]:55} {"%10.2f" % result["median_ms"]} ms  {change}')
+
+
+def run_benchmarks(scale_names, repeat, db_dir):
+    run = {'started_at': datetime.utcnow().isoformat(),
+           'git_revision': git_revision(),
+           'python': platform.python_version(),
+           'sqlalchemy': sqlalchemy.__version__,
+           'platform': platform.platform(),
+           'repeat': repeat,
+           'scales': []}
+    spawn = multiprocessing.get_context('spawn')
+    for scale_name in scale_names:
+        with spawn.Pool(1) as pool:
+            run['scales'].append(pool.apply(benchmark_scale, (scale_name, repeat, db_dir)))
+    return run
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.run_benchmarks --scales small medium large --compare benchmarks/results/<previous>.json
+    parser = argparse.ArgumentParser(description='benchmark the gap pipeline against synthetic data')
+    parser.add_argument('--scales', nargs='+', choices=sorted(SCALES), default=DEFAULT_SCALES)
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--db-dir', default=tempfile.gettempdir(), help='where the sqlite databases are generated')
+    parser.add_argument('--results-dir', default=RESULTS_DIR)
+    parser.add_argument('--compare', help='a previous results file to compare the medians against')
+    args = parser.parse_args()
+
+    current_run = run_benchmarks(args.scales, args.repeat, args.db_dir)
+    os.makedirs(args.results_dir, exist_ok=True)
+    results_path = os.path.join(args.results_dir,
+                                f'{datetime.utcnow().strftime("%Y%m%dT%H%M%S")}-{current_run["git_revision"]}.json')
+    with open(results_path, 'w') as f:
+        json.dump(current_run, f, indent=2)
+    print(f'wrote {results_path}')
+    if args.compare:
+        with open(args.compare) as f:
+            compare_runs(json.load(f), current_run)
@@ -0,0 +1,184 @@
+import argparse
+import datetime
+import itertools
+import math
+import os
+import random
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from humaniki_schema.schema import fill, metric, metric_properties_j, metric_aggregations_j, metric_aggregations_n, \
+    metric_coverage, label, label_misc
+from humaniki_schema.utils import Properties, PopulationDefinition
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# how much of everything to generate. the pair shapes are sampled, a full cross product would be mostly empty anyway,
+# like in the real data where most occupation x citizenship combinations have no humans.
+SCALES = {
+    'small': {'fills': 2, 'projects': 5, 'citizenships': 50, 'occupations': 100, 'years': 100, 'pair_density': 0.2},
+    'medium': {'fills': 3, 'projects': 20, 'citizenships': 200, 'occupations': 1000, 'years': 300,
+               'pair_density': 0.05},
+    'large': {'fills': 4, 'projects': 50, 'citizenships': 250, 'occupations': 5000, 'years': 500,
+              'pair_density': 0.02},
+}
+PROPERTIES_SHAPES = [[],
+                     [Properties.PROJECT.value],
+                     [Properties.CITIZENSHIP.value],
+                     [Properties.OCCUPATION.value],
+                     [Properties.DATE_OF_BIRTH.value],
+                     [Properties.PROJECT.value, Properties.DATE_OF_BIRTH.value],
+                     [Properties.CITIZENSHIP.value, Properties.OCCUPATION.value]]
+# male, female, and a rarer third bias value
+BIAS_VALUES = [6581097, 6581072, 1052281]
+BIAS_PRESENCE = [1.0, 0.9, 0.1]
+POPULATIONS = [PopulationDefinition.ALL_WIKIDATA.value, PopulationDefinition.GTE_ONE_SITELINK.value]
+LABEL_LANGS = ['en', 'fr']
+FIRST_CITIZENSHIP_QID = 1000
+FIRST_OCCUPATION_QID = 100000
+FIRST_YEAR = 1800
+INSERT_CHUNK_ROWS = 10000
+
+
+def make_engine(db_path):
+    """
+    a sqlite engine that understands the mysql functions the queries use.
+    sqlite's json_extract already unquotes, so json_unquote only has to give back the same string mysql would.
+    floor, for year buckets, is only built into sqlite when it is compiled with its math functions.
+    """
+    engine = create_engine(f'sqlite:///{db_path}')
+
+    @event.listens_for(engine, 'connect')
+    def register_mysql_functions(dbapi_connection, connection_record):
+        dbapi_connection.create_function('json_unquote', 1, lambda val: None if val is None else str(val))
+        dbapi_connection.create_function('floor', 1, lambda val: None if val is None else math.floor(val))
+
+    return engine
+
+
+def property_values(prop, scale):
+    """every aggregation value of prop, as stored in metric_aggregations_j"""
+    if prop == Properties.PROJECT.value:
+        return [f'proj{project_i}wiki' for project_i in range(scale['projects'])]
+    elif prop == Properties.CITIZENSHIP.value:
+        return list(range(FIRST_CITIZENSHIP_QID, FIRST_CITIZENSHIP_QID + scale['citizenships']))
+    elif prop == Properties.OCCUPATION.value:
+        return list(range(FIRST_OCCUPATION_QID, FIRST_OCCUPATION_QID + scale['occupations']))
+    elif prop == Properties.DATE_OF_BIRTH.value:
+        return list(range(FIRST_YEAR, FIRST_YEAR + scale['years']))
+    raise ValueError(f'no synthetic values for property {prop}')
+
+
+def shape_aggregations(properties, scale, rng):
+    """the aggregation value combinations of one properties shape"""
+    if not properties:
+        return [[]]
+    combinations = itertools.product(*[property_values(prop, scale) for prop in properties])
+    if len(properties) == 1:
+        return [list(combination) for combination in combinations]
+    return [list(combination) for combination in combinations if rng.random() < scale['pair_density']]
+
+
+def insert_chunked(session, table, rows):
+    for chunk_start in range(0, len(rows), INSERT_CHUNK_ROWS):
+        session.execute(table.insert(), rows[chunk_start:chunk_start + INSERT_CHUNK_ROWS])
+
+
+def generate_synthetic_fills(session, scale, seed=0):
+    """
+    fill an empty database with synthetic fills at the given scale, deterministically for a seed
+    :param scale: one of SCALES' values
+    :return: {table name: rows inserted}
+    """
+    rng = random.Random(seed)
+    generate_start = time.time()
+    counts = {}
+
+    fill_rows = [{'id': fill_id, 'date': datetime.date(2020, 1, 1) + datetime.timedelta(days=7 * fill_id),
+                  'type': 1, 'detail': {'active': True}} for fill_id in range(1, scale['fills'] + 1)]
+    insert_chunked(session, fill.__table__, fill_rows)
+    counts['fill'] = len(fill_rows)
+
+    properties_rows, aggregations_j_rows, aggregations_n_rows, metric_rows, coverage_rows = [], [], [], [], []
+    aggregations_id = 0
+    for properties_id, properties in enumerate(PROPERTIES_SHAPES, start=1):
+        properties_rows.append({'id': properties_id, 'bias_property': Properties.GENDER.value,
+                                'properties': properties, 'properties_len': len(properties)})
+        for aggregations in shape_aggregations(properties, scale, rng):
+            aggregations_id += 1
+            aggregations_j_rows.append({'id': aggregations_id, 'aggregations': aggregations,
+                                        'aggregations_len': len(aggregations)})
+            for aggregation_order, (prop, value) in enumerate(zip(properties, aggregations), start=1):
+                # projects are matched by their internal id, see get_project_internal_id_from_wikiencoding
+                n_value = int(value[len('proj'):-len('wiki')]) + 1 if prop == Properties.PROJECT.value else value
+                aggregations_n_rows.append({'id': aggregations_id, 'property': prop, 'value': str(n_value),
+                                            'aggregation_order': aggregation_order})
+            for fill_row in fill_rows:
+                for population_id in POPULATIONS:
+                    for bias_value, presence in zip(BIAS_VALUES, BIAS_PRESENCE):
+                        if rng.random() < presence:
+                            metric_rows.append({'fill_id': fill_row['id'], 'population_id': population_id,
+                                                'properties_id': properties_id, 'aggregations_id': aggregations_id,
+                                                'bias_value': bias_value, 'total': rng.randint(1, 5000)})
+        for fill_row in fill_rows:
+            for population_id in POPULATIONS:
+                everyone = 10000000
+                coverage_rows.append({'fill_id': fill_row['id'], 'population_id': population_id,
+                                      'properties_id': properties_id,
+                                      'total_with_properties': everyone if not properties else
+                                      rng.randint(everyone // 10, everyone)})
+    for table, rows in ((metric_properties_j.__table__, properties_rows),
+                        (metric_aggregations_j.__table__, aggregations_j_rows),
+                        (metric_aggregations_n.__table__, aggregations_n_rows),
+                        (metric.__table__, metric_rows),
+                        (metric_coverage.__table__, coverage_rows)):
+        insert_chunked(session, table, rows)
+        counts[table.name] = len(rows)
+
+    label_rows, label_misc_rows = [], []
+    qids = property_values(Properties.CITIZENSHIP.value, scale) + property_values(Properties.OCCUPATION.value, scale)
+    for lang in LABEL_LANGS:
+        label_rows.extend({'qid': qid, 'lang': lang, 'label': f'Q{qid} ({lang})'} for qid in qids)
+        label_misc_rows.extend({'src': str(bias_value), 'lang': lang, 'label': f'bias {bias_value} ({lang})',
+                                'type': 'bias'} for bias_value in BIAS_VALUES)
+        label_misc_rows.extend({'src': project, 'lang': lang, 'label': f'{project} ({lang})', 'type': 'sitelink'}
+                               for project in property_values(Properties.PROJECT.value, scale))
+    label_misc_rows.extend({'src': str(qid), 'lang': 'iso_3166_1', 'label': f'C{qid % 1000}', 'type': 'iso_3166_1'}
+                           for qid in property_values(Properties.CITIZENSHIP.value, scale))
+    insert_chunked(session, label.__table__, label_rows)
+    insert_chunked(session, label_misc.__table__, label_misc_rows)
+    counts['label'] = len(label_rows)
+    counts['label_misc'] = len(label_misc_rows)
+    session.commit()
+    log.info(f'generated {counts} in {"%.3f" % (time.time() - generate_start)} seconds')
+    return counts
+
+
+def create_synthetic_db(db_path, scale_name, seed=0):
+    """
+    (re)create db_path with the tables of humaniki_schema and a synthetic dataset of scale_name
+    :return: (engine, {table name: rows inserted})
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    engine = make_engine(db_path)
+    metric.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        counts = generate_synthetic_fills(session, SCALES[scale_name], seed=seed)
+    finally:
+        session.close()
+    return engine, counts
+
+
+if __name__ == '__main__':
+    # python -m benchmarks.synthetic --scale medium --db-path /tmp/humaniki-medium.sqlite
+    parser = argparse.ArgumentParser(description='generate a synthetic humaniki database in sqlite')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--db-path', required=True)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    create_synthetic_db(args.db_path, args.scale, seed=args.seed)
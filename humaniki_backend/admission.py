@@ -0,0 +1,238 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from prometheus_client import Counter
+from sqlalchemy import func
+
+from humaniki_backend.concurrency import SingleFlight
+from humaniki_backend.instrumentation import timed
+from humaniki_schema.schema import metric
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# the most metric rows, as estimated by estimate_metrics_cost, a request of each cost class reads, cheapest first.
+# anything over the last is 'expensive'
+COST_CLASS_MAX_ROWS = OrderedDict([('cheap', 20000), ('moderate', 500000)])
+COST_CLASSES = list(COST_CLASS_MAX_ROWS) + ['expensive']
+# how many requests of each cost class one worker computes at a time, None for no limit.
+# cheap requests, like the dashboard's, are never held back by expensive ones, which have their own slots
+ADMISSION_LIMITS = {'cheap': None,
+                    'moderate': int(os.environ.get('HUMANIKI_MODERATE_QUERY_SLOTS', 4)),
+                    'expensive': int(os.environ.get('HUMANIKI_EXPENSIVE_QUERY_SLOTS', 1))}
+# how many more may wait for a slot, and for how long, before they are turned away
+ADMISSION_MAX_QUEUED = {'moderate': 16, 'expensive': 4}
+ADMISSION_QUEUE_SECONDS = {'moderate': 10, 'expensive': 5}
+# the Retry-After sent with a rejection
+ADMISSION_RETRY_AFTER_SECONDS = {'moderate': 5, 'expensive': 30}
+# a dimension pinned to some values, rather than all of them, is assumed to keep this fraction of its rows
+PINNED_DIMENSION_SELECTIVITY = 0.1
+# every item of a labelled response is also looked up in the labels
+LABELLED_COST_FACTOR = 2
+# how many fills' row counts to keep, they are a few hundred rows per population
+ROW_COUNTS_MAX_FILLS = 16
+
+ADMISSION_REJECTED = Counter('humaniki_admission_rejected_total', 'requests turned away for their cost class',
+                             ['cost_class'])
+
+
+class MetricRowCounts(object):
+    """
+    The number of metric rows of every population and properties combination of each fill, that costs are
+    estimated from. Counting scans a fill's metric rows, so it never happens while a request waits:
+    the latest fill is counted in the background as soon as the fill registry finds it, and any other fill the first
+    time it is asked for, estimated by the latest fill until then. A fill is counted by one query at a time.
+    """
+
+    def __init__(self, session_factory, max_fills=ROW_COUNTS_MAX_FILLS):
+        self.session_factory = session_factory
+        self.max_fills = max_fills
+        self.latest_fill_id = None
+        self._fills = OrderedDict()
+        self._counting = set()
+        self._lock = threading.Lock()
+        self._flights = SingleFlight(timeout=None)
+
+    def get(self, fill_id, population_id, properties_id):
+        """:return: the metric rows of a population and properties combination of fill_id, 0 if not known"""
+        with self._lock:
+            fill_counts = self._fills.get(fill_id)
+            if fill_counts is not None:
+                self._fills.move_to_end(fill_id)
+        if fill_counts is None:
+            self.count_later(fill_id)
+            with self._lock:
+                fill_counts = self._fills.get(self.latest_fill_id, {})
+        return fill_counts.get((population_id, properties_id), 0)
+
+    def count_later(self, fill_id):
+        """count fill_id on a background thread, unless it is already being counted"""
+        with self._lock:
+            if fill_id in self._counting:
+                return
+            self._counting.add(fill_id)
+        threading.Thread(target=self._count_in_background, args=(fill_id,),
+                         name=f'row-counts-{fill_id}', daemon=True).start()
+
+    def count_fill(self, fill_id):
+        """count and keep the metric rows of fill_id, in one query for every population and properties combination"""
+        return self._flights.do(fill_id, lambda: self._count_fill(fill_id))
+
+    def _count_fill(self, fill_id):
+        count_start = time.time()
+        session = self.session_factory()
+        try:
+            row_count_rows = session.query(metric.population_id, metric.properties_id, func.count()) \
+                .filter(metric.fill_id == fill_id) \
+                .group_by(metric.population_id, metric.properties_id) \
+                .all()
+        finally:
+            session.close()
+        row_counts = {(population_id, properties_id): rows for population_id, properties_id, rows in row_count_rows}
+        if not row_counts:
+            # nothing computed for this fill (yet), count again next time
+            return row_counts
+
+        with self._lock:
+            self._fills[fill_id] = row_counts
+            for kept_fill_id in list(self._fills):
+                if len(self._fills) <= self.max_fills:
+                    break
+                if kept_fill_id != self.latest_fill_id:
+                    del self._fills[kept_fill_id]
+        log.info(f'counted the metric rows of fill {fill_id} in {"%.3f" % (time.time() - count_start)} seconds')
+        return row_counts
+
+    def _count_in_background(self, fill_id):
+        try:
+            self.count_fill(fill_id)
+        except Exception:
+            log.exception(f'could not count the metric rows of fill {fill_id}')
+        finally:
+            with self._lock:
+                self._counting.discard(fill_id)
+
+    def observe_latest_fill(self, latest_fill_id):
+        # listeners run under the fill registry's refresh lock, so the count must not hold it up
+        self.latest_fill_id = latest_fill_id
+        with self._lock:
+            counted = latest_fill_id in self._fills
+        if not counted:
+            self.count_later(latest_fill_id)
+
+
+def estimate_metrics_cost(row_counts, fill_ids, population_id, properties_id, ordered_query_params, label_lang):
+    """
+    roughly how many metric rows answering a request reads and groups, before anything is queried
+    :param row_counts: the MetricRowCounts to look the rows up in
+    :param fill_ids: every fill the request reads, like the two of a diff
+    :param properties_id: the id of the request's properties combination
+    :return: the estimated rows, weighed up when they are labelled
+    """
+    rows = sum(row_counts.get(fill_id, population_id, properties_id) for fill_id in fill_ids)
+    pinned_dimensions = sum(1 for value in ordered_query_params.values() if value != 'all')
+    cost = rows * PINNED_DIMENSION_SELECTIVITY ** pinned_dimensions
+    if label_lang:
+        cost *= LABELLED_COST_FACTOR
+    return cost
+
+
+def classify_cost(cost):
+    """:return: the cost class of an estimated cost, one of COST_CLASSES"""
+    for cost_class, max_rows in COST_CLASS_MAX_ROWS.items():
+        if cost <= max_rows:
+            return cost_class
+    return COST_CLASSES[-1]
+
+
+class Overloaded(Exception):
+    """there is no slot for a request of this cost class now, it can be retried after retry_after seconds"""
+
+    def __init__(self, cost_class, retry_after):
+        super().__init__(f'too many {cost_class} requests, retry after {retry_after}s')
+        self.cost_class = cost_class
+        self.retry_after = retry_after
+
+
+class AdmissionControl(object):
+    """
+    Limits how many requests of each cost class a worker process computes at a time.
+    A request over the limit waits for a slot, in a queue of bounded length and for a bounded time,
+    and is otherwise rejected with Overloaded.
+    """
+
+    def __init__(self, limits=ADMISSION_LIMITS, max_queued=ADMISSION_MAX_QUEUED,
+                 queue_seconds=ADMISSION_QUEUE_SECONDS, retry_after=ADMISSION_RETRY_AFTER_SECONDS):
+        self.limits = limits
+        self.max_queued = max_queued
+        self.queue_seconds = queue_seconds
+        self.retry_after = retry_after
+        self._slots = {cost_class: threading.BoundedSemaphore(limit) for cost_class, limit in limits.items()
+                       if limit is not None}
+        # the requests of each cost class holding or waiting for a slot
+        self._pending = {cost_class: 0 for cost_class in self._slots}
+        self._lock = threading.Lock()
+
+    def acquire(self, cost_class, stage_timer=None):
+        """
+        wait for a slot of cost_class
+        :return: a function that gives the slot back, calling it more than once is harmless
+        :raises Overloaded: when the queue is full, or no slot came free before its deadline
+        """
+        slots = self._slots.get(cost_class)
+        if slots is None:
+            return lambda: None
+        with self._lock:
+            if self._pending[cost_class] >= self.limits[cost_class] + self.max_queued.get(cost_class, 0):
+                self.reject(cost_class)
+            self._pending[cost_class] += 1
+        try:
+            with timed(stage_timer, 'queued'):
+                acquired = slots.acquire(timeout=self.queue_seconds.get(cost_class, 0))
+        except BaseException:
+            self.leave(cost_class)
+            raise
+        if not acquired:
+            self.leave(cost_class)
+            self.reject(cost_class)
+
+        released = []
+
+        def release():
+            with self._lock:
+                if released:
+                    return
+                released.append(True)
+            slots.release()
+            self.leave(cost_class)
+
+        return release
+
+    def leave(self, cost_class):
+        with self._lock:
+            self._pending[cost_class] -= 1
+
+    @contextmanager
+    def admit(self, cost_class, stage_timer=None):
+        """hold a slot of cost_class for the duration of the with block"""
+        release = self.acquire(cost_class, stage_timer=stage_timer)
+        try:
+            yield
+        finally:
+            release()
+
+    def reject(self, cost_class):
+        ADMISSION_REJECTED.labels(cost_class).inc()
+        log.warning(f'rejecting a request of cost class {cost_class}, no slot came free in time')
+        raise Overloaded(cost_class, self.retry_after.get(cost_class, 1))
+
+
+def release_when_done(data_points, release):
+    """pass data_points through, calling release once they are exhausted or abandoned"""
+    try:
+        yield from data_points
+    finally:
+        release()
@@ -1,15 +1,33 @@
-from flask import Flask, abort, jsonify, request
+from flask import Flask, Response, abort, jsonify, request, send_file, stream_with_context
 
 from humaniki_schema.db import session_factory
 from flask_cors import CORS
 
 from flask_sqlalchemy_session import flask_scoped_session
 
+from humaniki_backend.admission import AdmissionControl, MetricRowCounts, Overloaded, COST_CLASSES, classify_cost, \
+    estimate_metrics_cost, release_when_done
+from humaniki_backend.cache import ResponseCache, make_gap_cache_key, make_etag, set_cache_headers, \
+    negotiate_encoding, variant_etag, CONTENT_ENCODINGS
+from humaniki_backend.concurrency import CONCURRENT_GAP_QUERIES, FlightAborted, FlightTimeout, SingleFlight, \
+    log_query_failure, submit_query
+from humaniki_backend.columnar import get_columnar_snapshot, build_metrics_from_snapshot
+from humaniki_backend.diff import build_diff_metrics
+from humaniki_backend.fills import FillRegistry
+from humaniki_backend.formats import render_gap, available_gap_formats, dumps_json, GAP_FORMAT_MIMETYPES
+from humaniki_backend.instrumentation import StageTimer, render_metrics, timed
+from humaniki_backend.labels import label_store
+from humaniki_backend.prerender import find_prerendered
+from humaniki_backend.querylog import slow_query_log
+from humaniki_backend.materialize import get_wide_table, build_metrics_from_wide_table
+from humaniki_backend.reference import reference_data
 from humaniki_backend.query import get_aggregations_id_preds, get_metrics, build_gap_response, build_metrics, \
-    get_metrics_count, get_all_snapshot_dates, get_coverage
+    get_metrics_count, get_coverage, build_metrics_stream, get_coverage_table, build_evolution_metrics, \
+    get_coverage_series
+from humaniki_backend.streaming import stream_gap_response, STREAM_MIMETYPES
 from humaniki_backend.utils import determine_population_conflict, assert_gap_request_valid, \
-    order_query_params, get_pid_from_str, determine_fill_id, is_property_exclusively_citizenship
-from humaniki_schema.queries import get_properties_obj, get_latest_fill_id
+    order_query_params, get_pid_from_str, determine_fill_id, is_property_exclusively_citizenship, is_admin_request, \
+    parse_gap_ranking, parse_snapshot_range, select_snapshots_in_range, parse_year_bucket
 from humaniki_schema.utils import Properties, make_fill_dt
 from humaniki_schema.log import get_logger
 
@@ -19,30 +37,389 @@ app = Flask(__name__)
 CORS(app)
 session = flask_scoped_session(session_factory, app)
 
-# Note this requires updating or the process restarting after a new fill.
-# TODO: have this be a function that can be called and updated.
-latest_fill_id, latest_fill_date = get_latest_fill_id(session)
-app.latest_fill_id = latest_fill_id
+gap_cache = ResponseCache()
+# identical gap requests computing at the same time in this worker share one computation
+gap_flights = SingleFlight()
+# expensive requests queue for their own few slots, so they cannot take every thread from cheap ones
+gap_admission = AdmissionControl()
+# what the cost of a request is estimated from, counted when a fill is first seen rather than on a request
+metric_row_counts = MetricRowCounts(session_factory)
+# the fills are loaded once per process and refreshed in the background, so a new fill needs no restart.
+fill_registry = FillRegistry(session_factory)
+fill_registry.add_listener(gap_cache.observe_latest_fill)
+fill_registry.add_listener(label_store.observe_latest_fill)
+fill_registry.add_listener(metric_row_counts.observe_latest_fill)
+
+BATCH_MAX_QUERIES = 50
+
+
+def warm_up():
+    """preload the fills, reference data and common labels, run this before a worker takes traffic"""
+    fill_registry.snapshot()
+    warm_up_session = session_factory()
+    try:
+        reference_data.warm_up(warm_up_session)
+    finally:
+        warm_up_session.close()
 
 
 @app.route("/")
 def home():
     log.info('home route called')
-    return jsonify(latest_fill_id, latest_fill_date)
+    fills = fill_registry.snapshot()
+    return jsonify(fills.latest_fill_id, fills.latest_fill_date)
 
 
 @app.route("/v1/available_snapshots/")
 def available_snapshots():
-    all_snaphot_dates = get_all_snapshot_dates(session)
-    return jsonify(all_snaphot_dates)
+    fills = fill_registry.snapshot()
+    all_snaphot_dates = fills.available_snapshots
+    etag = make_etag('available_snapshots', fills.latest_fill_id, all_snaphot_dates)
+    if request.if_none_match.contains_weak(etag):
+        return set_cache_headers(app.response_class(status=304), etag, immutable=False)
+    return set_cache_headers(jsonify(all_snaphot_dates), etag, immutable=False)
+
+
+@app.route("/v1/admin/refresh_fills", methods=['POST'])
+def refresh_fills():
+    if not is_admin_request(request):
+        abort(403)
+    fills = fill_registry.refresh()
+    return jsonify(latest_fill_id=fills.latest_fill_id, latest_fill_date=fills.latest_fill_date,
+                   available_snapshots=len(fills.available_snapshots))
+
+
+@app.route("/v1/admin/slow_queries")
+def slow_queries():
+    if not is_admin_request(request):
+        abort(403)
+    return jsonify(threshold_seconds=slow_query_log.threshold_seconds, slow_queries=slow_query_log.entries())
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """the prometheus exposition of the gap request timings"""
+    metrics_body, content_type = render_metrics()
+    return Response(metrics_body, content_type=content_type)
 
 
 @app.route("/v1/<string:bias>/gap/<string:snapshot>/<string:population>/properties")
 def gap(bias, snapshot, population):
-    latest_fill_id, latest_fill_date = get_latest_fill_id(session)
+    stage_timer = StageTimer()
+    response = build_gap(bias, snapshot, population, request.values, fill_registry.snapshot(),
+                         stage_timer=stage_timer, if_none_match=request.if_none_match,
+                         accept_encodings=request.accept_encodings, serve_prerendered=True)
+    return stage_timer.finish(response)
+
+
+@app.route("/v1/<string:bias>/evolution/<string:snapshot_range>/<string:population>/properties")
+def evolution(bias, snapshot_range, population):
+    """
+    the gap of one query over a range of snapshots, with the metrics of every snapshot from one query.
+    each data point has a series per bias value, aligned with meta's snapshots.
+    """
+    stage_timer = StageTimer()
+    response = build_evolution(bias, snapshot_range, population, request.values, fill_registry.snapshot(),
+                               stage_timer=stage_timer, if_none_match=request.if_none_match,
+                               accept_encodings=request.accept_encodings)
+    return stage_timer.finish(response)
+
+
+def build_evolution(bias, snapshot_range, population, query_params, fills, stage_timer=None, if_none_match=None,
+                    accept_encodings=None):
+    """
+    :param snapshot_range: "all", or dates around a "~", see parse_snapshot_range
+    see build_gap for the rest
+    :return: a flask response
+    """
+    errors = {}
+    try:
+        with timed(stage_timer, 'validation'):
+            start_dt, stop_dt = parse_snapshot_range(snapshot_range)
+    except ValueError as ve:
+        errors['validation'] = repr(ve)
+        return jsonify(errors=errors)
+    with timed(stage_timer, 'fill'):
+        snapshots = select_snapshots_in_range(fills.available_snapshots, start_dt, stop_dt)
+    if not snapshots:
+        errors['snapshot_range'] = repr(ValueError(f'there are no snapshots in {snapshot_range}'))
+        return jsonify(errors=errors)
+    fill_ids = [snapshot['id'] for snapshot in snapshots]
+    population_id, population_name, population_corrected = determine_population_conflict(population, query_params)
+    ordered_query_params, non_orderable_query_params = order_query_params(query_params)
+    label_lang = non_orderable_query_params['label_lang'] if 'label_lang' in non_orderable_query_params else None
+    cache_key = ('evolution', tuple(fill_ids), bias, population_id, population_corrected,
+                 tuple(ordered_query_params.items()), label_lang)
+    # the range can take in new fills, so it is never immutable
+    etag = make_etag(cache_key)
+    cached = cached_response(cache_key, etag, False, if_none_match, accept_encodings)
+    if cached is not None:
+        return cached
+
+    try:
+        bias_property = get_pid_from_str(bias)
+        with timed(stage_timer, 'properties'):
+            properties_id = reference_data.get_properties_obj(session=session,
+                                                              dimension_properties=ordered_query_params.keys(),
+                                                              bias_property=bias_property)
+    except ValueError as ve:
+        errors['properties_id'] = repr(ve)
+        log.exception(errors)
+        return jsonify(errors=errors)
+    try:
+        aggregations_id_preds = get_aggregations_id_preds(session, ordered_query_params, non_orderable_query_params,
+                                                          as_subquery=True)
+    except ValueError as ve:
+        errors['aggregations_id_preds'] = repr(ve)
+        log.exception(errors)
+        return jsonify(errors=errors)
+    with timed(stage_timer, 'coverage'):
+        coverages = get_coverage_series(session, fill_ids, population_id=population_id,
+                                        properties_id=properties_id.id)
+    with timed(stage_timer, 'estimate'):
+        cost_class = classify_cost(estimate_metrics_cost(metric_row_counts, fill_ids, population_id,
+                                                         properties_id.id, ordered_query_params, label_lang))
+    try:
+        with gap_admission.admit(cost_class, stage_timer=stage_timer):
+            metrics, represented_biases = build_evolution_metrics(session, fill_ids, population_id=population_id,
+                                                                  properties_id=properties_id,
+                                                                  aggregations_id=aggregations_id_preds,
+                                                                  label_lang=label_lang, stage_timer=stage_timer)
+    except Overloaded as o:
+        return overloaded_response(o, errors)
+
+    meta = {'snapshots': [str(snapshot['date']) for snapshot in snapshots],
+            'population': population_name,
+            'population_corrected': population_corrected,
+            'label_lang': label_lang,
+            'bias': bias,
+            'bias_property': bias_property,
+            'aggregation_properties': [Properties(p).name for p in properties_id.properties],
+            'coverage': coverages}
+    if represented_biases:
+        meta['bias_labels'] = represented_biases
+    with timed(stage_timer, 'serialization'):
+        body = dumps_json({'meta': meta, 'metrics': metrics})
+    variants = gap_cache.put(cache_key, body)
+    return encoded_response(variants, accept_encodings, etag, False, GAP_FORMAT_MIMETYPES['json'])
+
+
+@app.route("/v1/<string:bias>/diff/<string:from_snapshot>/<string:to_snapshot>/<string:population>/properties")
+def diff(bias, from_snapshot, to_snapshot, population):
+    """the change of a gap from one snapshot to another, per item, with both fills read in one query"""
+    stage_timer = StageTimer()
+    response = build_diff(bias, from_snapshot, to_snapshot, population, request.values, fill_registry.snapshot(),
+                          stage_timer=stage_timer, if_none_match=request.if_none_match,
+                          accept_encodings=request.accept_encodings)
+    return stage_timer.finish(response)
+
+
+def build_diff(bias, from_snapshot, to_snapshot, population, query_params, fills, stage_timer=None,
+               if_none_match=None, accept_encodings=None):
+    """
+    :param from_snapshot: "latest" or a date, like the gap's snapshot
+    :param to_snapshot: "latest" or a date
+    see build_gap for the rest
+    :return: a flask response
+    """
+    errors = {}
+    try:
+        with timed(stage_timer, 'validation'):
+            assert_gap_request_valid(from_snapshot, population, query_params)
+            assert_gap_request_valid(to_snapshot, population, query_params)
+    except AssertionError as ae:
+        errors['validation'] = repr(ae)
+        return jsonify(errors=errors)
+    try:
+        with timed(stage_timer, 'fill'):
+            from_fill_id, from_fill_date, _ = determine_fill_id(session, from_snapshot, fills.latest_fill_id,
+                                                                fills.latest_fill_date,
+                                                                exact_fill_id_fn=fill_registry.get_exact_fill_id)
+            to_fill_id, to_fill_date, _ = determine_fill_id(session, to_snapshot, fills.latest_fill_id,
+                                                            fills.latest_fill_date,
+                                                            exact_fill_id_fn=fill_registry.get_exact_fill_id)
+    except (ValueError, NotImplementedError) as e:
+        errors['snapshot'] = repr(e)
+        return jsonify(errors=errors)
+    population_id, population_name, population_corrected = determine_population_conflict(population, query_params)
+    ordered_query_params, non_orderable_query_params = order_query_params(query_params)
+    label_lang = non_orderable_query_params['label_lang'] if 'label_lang' in non_orderable_query_params else None
+    try:
+        limit = int(non_orderable_query_params['limit']) if 'limit' in non_orderable_query_params else None
+        assert limit is None or limit >= 1
+    except (ValueError, AssertionError):
+        errors['limit'] = repr(ValueError(f'limit must be a whole number of at least 1, '
+                                          f'not {non_orderable_query_params["limit"]}'))
+        return jsonify(errors=errors)
+    cache_key = ('diff', (from_fill_id, to_fill_id), bias, population_id, population_corrected,
+                 tuple(ordered_query_params.items()), label_lang, limit)
+    etag = make_etag(cache_key)
+    immutable = 'latest' not in (from_snapshot.lower(), to_snapshot.lower())
+    cached = cached_response(cache_key, etag, immutable, if_none_match, accept_encodings)
+    if cached is not None:
+        return cached
+
+    try:
+        bias_property = get_pid_from_str(bias)
+        with timed(stage_timer, 'properties'):
+            properties_id = reference_data.get_properties_obj(session=session,
+                                                              dimension_properties=ordered_query_params.keys(),
+                                                              bias_property=bias_property)
+    except ValueError as ve:
+        errors['properties_id'] = repr(ve)
+        log.exception(errors)
+        return jsonify(errors=errors)
+    try:
+        aggregations_id_preds = get_aggregations_id_preds(session, ordered_query_params, non_orderable_query_params,
+                                                          as_subquery=True)
+    except ValueError as ve:
+        errors['aggregations_id_preds'] = repr(ve)
+        log.exception(errors)
+        return jsonify(errors=errors)
+    with timed(stage_timer, 'coverage'):
+        coverages = get_coverage_series(session, [from_fill_id, to_fill_id], population_id=population_id,
+                                        properties_id=properties_id.id)
+    with timed(stage_timer, 'estimate'):
+        cost_class = classify_cost(estimate_metrics_cost(metric_row_counts, [from_fill_id, to_fill_id],
+                                                         population_id, properties_id.id, ordered_query_params,
+                                                         label_lang))
+    try:
+        with gap_admission.admit(cost_class, stage_timer=stage_timer):
+            metrics, represented_biases = build_diff_metrics(session, from_fill_id, to_fill_id,
+                                                             population_id=population_id, properties_id=properties_id,
+                                                             aggregations_id=aggregations_id_preds,
+                                                             label_lang=label_lang, limit=limit,
+                                                             stage_timer=stage_timer)
+    except Overloaded as o:
+        return overloaded_response(o, errors)
+
+    meta = {'snapshots': [str(from_fill_date), str(to_fill_date)],
+            'population': population_name,
+            'population_corrected': population_corrected,
+            'label_lang': label_lang,
+            'bias': bias,
+            'bias_property': bias_property,
+            'aggregation_properties': [Properties(p).name for p in properties_id.properties],
+            'coverage': coverages,
+            'limit': limit}
+    if represented_biases:
+        meta['bias_labels'] = represented_biases
+    with timed(stage_timer, 'serialization'):
+        body = dumps_json({'meta': meta, 'metrics': metrics})
+    variants = gap_cache.put(cache_key, body)
+    return encoded_response(variants, accept_encodings, etag, immutable, GAP_FORMAT_MIMETYPES['json'])
+
+
+@app.route("/v1/coverage/<string:snapshot>/<string:population>")
+def coverage(snapshot, population):
+    """the coverage of every properties combination computed for a snapshot and population"""
+    return_warnings = {}
+    errors = {}
+    try:
+        assert_gap_request_valid(snapshot, population, {})
+    except AssertionError as ae:
+        errors['validation'] = repr(ae)
+        return jsonify(errors=errors)
+    fills = fill_registry.snapshot()
+    try:
+        requested_fill_id, requested_fill_date, snapshot_corrected = determine_fill_id(
+            session, snapshot, fills.latest_fill_id, fills.latest_fill_date,
+            exact_fill_id_fn=fill_registry.get_exact_fill_id)
+    except (ValueError, NotImplementedError) as e:
+        errors['snapshot'] = repr(e)
+        return jsonify(errors=errors)
+    if snapshot_corrected:
+        return_warnings['snapshot_corrected to'] = requested_fill_date
+    population_id, population_name, population_corrected = determine_population_conflict(population, {})
+    coverage_table = get_coverage_table(session, fill_id=requested_fill_id, population_id=population_id)
+    coverages = [{'properties_id': properties_id,
+                  'aggregation_properties': [Properties(p).name for p in coverage_row['properties']],
+                  'coverage': coverage_row['coverage']}
+                 for properties_id, coverage_row in sorted(coverage_table.items())]
+    meta = {'snapshot': str(requested_fill_date),
+            'population': population_name}
+    if return_warnings:
+        meta['warnings'] = return_warnings
+    return jsonify(meta=meta, coverage=coverages)
+
+
+@app.route("/v1/batch", methods=['POST'])
+def batch():
+    """
+    many gap queries in one request, sharing the session and the fill resolution.
+    the body is {"queries": [{"bias": "gender", "snapshot": "latest", "population": "gte_one_sitelink",
+                              "params": {"citizenship": "all", "label_lang": "en"}}, ...]}
+    and the response is {"results": [...]} with one gap response per query, in the same order.
+    """
+    errors = {}
+    batch_request = request.get_json(silent=True)
+    queries = batch_request.get('queries') if isinstance(batch_request, dict) else None
+    if not isinstance(queries, list):
+        errors['batch'] = repr(ValueError('the body must be json like {"queries": [...]}'))
+        return jsonify(errors=errors)
+    if len(queries) > BATCH_MAX_QUERIES:
+        errors['batch'] = repr(ValueError(f'at most {BATCH_MAX_QUERIES} queries per batch, not {len(queries)}'))
+        return jsonify(errors=errors)
+
+    fills = fill_registry.snapshot()
+    rendered_bodies = {}
+    results = []
+    for query_i, gap_spec in enumerate(queries):
+        try:
+            bias, snapshot, population, query_params = parse_gap_spec(gap_spec)
+            # a snapshot without a fill fails the whole batch, like a malformed query
+            determine_fill_id(session, snapshot, fills.latest_fill_id, fills.latest_fill_date,
+                              exact_fill_id_fn=fill_registry.get_exact_fill_id)
+        except (AssertionError, AttributeError, TypeError, ValueError, NotImplementedError) as e:
+            errors[f'queries[{query_i}]'] = repr(e)
+            return jsonify(errors=errors)
+        # identical queries are only computed once
+        spec_key = (bias, snapshot, population, tuple(sorted(query_params.items())))
+        if spec_key not in rendered_bodies:
+            stage_timer = StageTimer()
+            rendered_bodies[spec_key] = build_gap(bias, snapshot, population, query_params, fills,
+                                                  stage_timer=stage_timer).get_data()
+            stage_timer.observe()
+        results.append(rendered_bodies[spec_key])
+    batch_body = b'{"results": [' + b', '.join(results) + b']}'
+    return app.response_class(batch_body, mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+def parse_gap_spec(gap_spec):
+    """
+    :param gap_spec: one of the queries of a batch request
+    :return: (bias, snapshot, population, query_params) just like the gap route gets them from its url
+    """
+    bias = gap_spec.get('bias', 'gender')
+    snapshot = gap_spec.get('snapshot', 'latest')
+    population = gap_spec['population'] if 'population' in gap_spec else None
+    query_params = gap_spec.get('params', {})
+    assert all(isinstance(part, str) for part in (bias, snapshot, population)), \
+        'bias, snapshot and population must be strings'
+    assert isinstance(query_params, dict), 'params must be an object'
+    assert 'stream' not in query_params, 'batched queries cannot be streamed'
+    assert query_params.get('format', 'json') in ('json', 'columnar'), 'batched queries have to be json'
+    query_params = {param: str(val) for param, val in query_params.items()}
+    return bias, snapshot, population, query_params
+
+
+def build_gap(bias, snapshot, population, query_params, fills, stage_timer=None, if_none_match=None,
+              accept_encodings=None, serve_prerendered=False):
+    """
+    the gap pipeline behind both the gap and batch routes
+    :param query_params: the query string of a gap request, or a dict of the same
+    :param fills: the FillSnapshot to resolve the snapshot against
+    :param stage_timer: an optional StageTimer to record each stage in, a streamed response is only timed until
+     its first byte
+    :param if_none_match: the request's If-None-Match etags, if they hold this response's etag the answer is a 304
+    :param accept_encodings: the request's Accept-Encoding, to pick a compressed variant of the response, None for
+     the uncompressed body
+    :param serve_prerendered: answer from a prerendered file if there is one, that response is sent from disk and
+     its body can't be read back
+    :return: a flask response
+    """
     return_warnings = {}
     errors = {}
-    query_params = request.values
 
     # If a client explicitly asks an error to be sent back.
     if "error_test" in query_params.keys():
@@ -52,14 +429,21 @@ def gap(bias, snapshot, population):
 
     try:
         # TODO include validating bias
-        valid_request = assert_gap_request_valid(snapshot, population, query_params)
+        with timed(stage_timer, 'validation'):
+            valid_request = assert_gap_request_valid(snapshot, population, query_params)
     except AssertionError as ae:
         errors['validation']=repr(ae)
         #in this case fail immediately
         return jsonify(errors=errors)
     # handle snapshot
-    requested_fill_id, requested_fill_date, snapshot_corrected = determine_fill_id(session, snapshot, latest_fill_id,
-                                                                                   latest_fill_date)
+    try:
+        with timed(stage_timer, 'fill'):
+            requested_fill_id, requested_fill_date, snapshot_corrected = determine_fill_id(
+                session, snapshot, fills.latest_fill_id, fills.latest_fill_date,
+                exact_fill_id_fn=fill_registry.get_exact_fill_id)
+    except (ValueError, NotImplementedError) as e:
+        errors['snapshot'] = repr(e)
+        return jsonify(errors=errors)
     # print(f"Fills {requested_fill_id} {requested_fill_date}")
     if snapshot_corrected:
         return_warnings['snapshot_corrected to'] = requested_fill_date
@@ -69,19 +453,164 @@ def gap(bias, snapshot, population):
         return_warnings['population_corrected to'] = population_name
     # order query params by property pid
     ordered_query_params, non_orderable_query_params = order_query_params(query_params)
+    label_lang = non_orderable_query_params['label_lang'] if 'label_lang' in non_orderable_query_params else None
+    stream_format = non_orderable_query_params['stream'] if 'stream' in non_orderable_query_params else None
+    if stream_format is not None and stream_format not in STREAM_MIMETYPES:
+        errors['stream'] = repr(ValueError(f'stream must be one of {list(STREAM_MIMETYPES)}, not {stream_format}'))
+        return jsonify(errors=errors)
+    gap_format = non_orderable_query_params['format'] if 'format' in non_orderable_query_params else 'json'
+    if gap_format not in available_gap_formats() or (stream_format is not None and gap_format != 'json'):
+        errors['format'] = repr(ValueError(f'format must be one of {available_gap_formats()}, and json when '
+                                           f'streaming, not {gap_format}'))
+        return jsonify(errors=errors)
+    try:
+        ranking = parse_gap_ranking(non_orderable_query_params)
+    except ValueError as ve:
+        errors['ranking'] = repr(ve)
+        return jsonify(errors=errors)
+    try:
+        bucket_width = parse_year_bucket(non_orderable_query_params, ordered_query_params)
+        if bucket_width is not None and ranking is not None:
+            raise ValueError('bucketed data points cannot be sorted or paged')
+    except ValueError as ve:
+        errors['bucket'] = repr(ve)
+        return jsonify(errors=errors)
+    cache_key = make_gap_cache_key(bias, requested_fill_id, population_id, population_corrected,
+                                   ordered_query_params, label_lang, gap_format, ranking, bucket_width)
+    # the client already has this response, a dated snapshot's never changes, and latest's only with the fill
+    etag = make_etag(cache_key, stream_format)
+    immutable = snapshot.lower() != 'latest'
+    if if_none_match is not None:
+        for encoding in ['identity'] + CONTENT_ENCODINGS:
+            if if_none_match.contains_weak(variant_etag(etag, encoding)):
+                return set_cache_headers(app.response_class(status=304), variant_etag(etag, encoding), immutable)
+    # serve a response rendered ahead of time by humaniki_backend.prerender, straight from disk
+    prerendered = find_prerendered(requested_fill_id, etag, accept_encodings) \
+        if serve_prerendered and stream_format is None else None
+    if prerendered is not None:
+        return prerendered_response(*prerendered, etag, immutable, GAP_FORMAT_MIMETYPES[gap_format])
+    # serve a previously rendered response for the same normalized request, streamed responses are never cached
+    cached_variants = gap_cache.get(cache_key) if stream_format is None else None
+    if cached_variants is not None:
+        return encoded_response(cached_variants, accept_encodings, etag, immutable,
+                                GAP_FORMAT_MIMETYPES[gap_format])
+    compute_args = (bias, requested_fill_id, requested_fill_date, population_id, population_name, population_corrected,
+                    ordered_query_params, non_orderable_query_params, stream_format, ranking, bucket_width)
+    with timed(stage_timer, 'estimate'):
+        cost_class = estimate_cost_class(bias, [requested_fill_id], population_id, ordered_query_params, label_lang)
+    if stream_format:
+        # the slot is held until the stream is sent, or abandoned
+        try:
+            release = gap_admission.acquire(cost_class, stage_timer=stage_timer)
+        except Overloaded as o:
+            return overloaded_response(o, errors)
+        try:
+            meta, metrics, represented_biases = compute_gap(*compute_args, stage_timer=stage_timer)
+        except GapErrors as ge:
+            release()
+            return jsonify(errors=ge.errors)
+        except Exception:
+            release()
+            raise
+        chunks, mimetype = stream_gap_response(stream_format, meta, release_when_done(metrics, release),
+                                               represented_biases)
+        response = app.response_class(stream_with_context(chunks), mimetype=mimetype)
+        response.call_on_close(release)
+        return set_cache_headers(response, etag, immutable)
+
+    def render_variants():
+        with gap_admission.admit(cost_class, stage_timer=stage_timer):
+            meta, metrics, represented_biases = compute_gap(*compute_args, stage_timer=stage_timer)
+            if represented_biases:
+                meta['bias_labels'] = represented_biases
+            with timed(stage_timer, 'serialization'):
+                body, mimetype = render_gap(gap_format, meta, metrics, represented_biases)
+        return gap_cache.put(cache_key, body)
+
+    # identical requests that arrive together, like right after a new fill is published, are only computed once
+    try:
+        variants = gap_flights.do(cache_key, render_variants, stage_timer=stage_timer)
+    except GapErrors as ge:
+        return jsonify(errors=ge.errors)
+    except Overloaded as o:
+        return overloaded_response(o, errors)
+    except (FlightTimeout, FlightAborted) as ft:
+        errors['coalesced'] = repr(ft)
+        response = jsonify(errors=errors)
+        response.status_code = 503
+        return response
+    return encoded_response(variants, accept_encodings, etag, immutable, GAP_FORMAT_MIMETYPES[gap_format])
+
+
+def estimate_cost_class(bias, fill_ids, population_id, ordered_query_params, label_lang):
+    """
+    the cost class of a request, from the metric rows of its properties combination in each of fill_ids
+    :return: one of admission.COST_CLASSES, the cheapest if the properties are not known, the query reports those
+    """
+    try:
+        properties_id = reference_data.get_properties_obj(session=session,
+                                                          dimension_properties=ordered_query_params.keys(),
+                                                          bias_property=get_pid_from_str(bias))
+    except ValueError:
+        return COST_CLASSES[0]
+    return classify_cost(estimate_metrics_cost(metric_row_counts, fill_ids, population_id, properties_id.id,
+                                               ordered_query_params, label_lang))
+
+
+def overloaded_response(overloaded, errors):
+    """a 503 with a Retry-After, for a request turned away by admission control"""
+    errors['admission'] = repr(overloaded)
+    response = jsonify(errors=errors)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(overloaded.retry_after)
+    return response
+
+
+class GapErrors(Exception):
+    """the errors of a gap request that cannot be answered, sent back as {"errors": errors}"""
+
+    def __init__(self, errors):
+        super().__init__(errors)
+        self.errors = errors
+
+
+def compute_gap(bias, requested_fill_id, requested_fill_date, population_id, population_name, population_corrected,
+                ordered_query_params, non_orderable_query_params, stream_format, ranking, bucket_width,
+                stage_timer=None):
+    """
+    the part of the gap pipeline that queries, for a request that is neither cached nor prerendered
+    :return: (meta, data points, represented_biases) the data points are a generator when streaming
+    :raises GapErrors: when the request cannot be answered
+    """
+    errors = {}
+    label_lang = non_orderable_query_params['label_lang'] if 'label_lang' in non_orderable_query_params else None
     # get properties-id
     try:
         bias_property = get_pid_from_str(bias)
         ordered_properties = ordered_query_params.keys()
-        properties_id = get_properties_obj(session=session, dimension_properties=ordered_properties,
-                                           bias_property=bias_property)
+        with timed(stage_timer, 'properties'):
+            properties_id = reference_data.get_properties_obj(session=session,
+                                                              dimension_properties=ordered_properties,
+                                                              bias_property=bias_property)
         # properties_id = get_properties_id(session, ordered_properties, bias_property=bias_property)
     except ValueError as ve:
         errors['properties_id'] = repr(ve)
         log.exception(errors)
+        # without properties there is nothing else to look up
+        raise GapErrors(errors)
 
-    # get coverage
-    coverage = get_coverage(session=session, population_id=population_id, properties_id=properties_id.id, fill_id=requested_fill_id)
+    # get coverage, and if allowed, start it and the labels on other connections while the metrics are queried here
+    if CONCURRENT_GAP_QUERIES:
+        coverage_future = submit_query(session_factory, get_coverage, population_id=population_id,
+                                       properties_id=properties_id.id, fill_id=requested_fill_id)
+        if label_lang:
+            labels_future = submit_query(session_factory, label_store.for_lang, lang=label_lang)
+            # labelling waits for this load, or loads them again when it failed, so only the failure is kept
+            labels_future.add_done_callback(log_query_failure)
+    else:
+        with timed(stage_timer, 'coverage'):
+            coverage = get_coverage(session=session, population_id=population_id, properties_id=properties_id.id,
+                                    fill_id=requested_fill_id)
 
     # get aggregations-id
     try:
@@ -92,17 +621,53 @@ def gap(bias, snapshot, population):
         log.exception(errors)
     # get metric
     try:
-        # default the label lang to 'en' if not set
-        label_lang = non_orderable_query_params['label_lang'] if 'label_lang' in non_orderable_query_params else None
-        metrics, represented_biases = build_metrics(session, fill_id=requested_fill_id, population_id=population_id,
-                                                    properties_id=properties_id, aggregations_id=aggregations_id_preds,
-                                                    label_lang=label_lang)
+        # an exported fill is answered from the memory-mapped columnar store instead of the database
+        # otherwise from its materialized wide table, and only otherwise by extracting the json aggregations.
+        # years are only bucketed by the database
+        columnar_snapshot = get_columnar_snapshot(requested_fill_id) \
+            if not stream_format and bucket_width is None else None
+        wide_table = get_wide_table(session, requested_fill_id, properties_id) \
+            if not stream_format and bucket_width is None and columnar_snapshot is None else None
+        if columnar_snapshot is not None:
+            metrics, represented_biases = build_metrics_from_snapshot(session, columnar_snapshot,
+                                                                      population_id=population_id,
+                                                                      properties_id=properties_id,
+                                                                      ordered_query_params=ordered_query_params,
+                                                                      label_lang=label_lang,
+                                                                      stage_timer=stage_timer, ranking=ranking)
+        elif wide_table is not None:
+            metrics, represented_biases = build_metrics_from_wide_table(session, wide_table,
+                                                                        population_id=population_id,
+                                                                        properties_id=properties_id,
+                                                                        ordered_query_params=ordered_query_params,
+                                                                        label_lang=label_lang,
+                                                                        stage_timer=stage_timer, ranking=ranking)
+        else:
+            # when streaming nothing is queried yet, metrics is a generator of data points
+            if stream_format:
+                metrics, represented_biases = build_metrics_stream(session, fill_id=requested_fill_id,
+                                                                   population_id=population_id,
+                                                                   properties_id=properties_id,
+                                                                   aggregations_id=aggregations_id_preds,
+                                                                   label_lang=label_lang, ranking=ranking,
+                                                                   bucket_width=bucket_width)
+            else:
+                metrics, represented_biases = build_metrics(session, fill_id=requested_fill_id,
+                                                            population_id=population_id, properties_id=properties_id,
+                                                            aggregations_id=aggregations_id_preds,
+                                                            label_lang=label_lang, stage_timer=stage_timer,
+                                                            ranking=ranking, bucket_width=bucket_width)
     except ValueError as ve:
         errors['metrics'] = repr(ve)
 
+    if CONCURRENT_GAP_QUERIES:
+        # only the time spent still waiting on it
+        with timed(stage_timer, 'coverage'):
+            coverage = coverage_future.result()
+
     # there are errors return those.
     if errors:
-        return jsonify(errors=errors)
+        raise GapErrors(errors)
 
     meta = {'snapshot': str(requested_fill_date),
             'population': population_name,
@@ -112,10 +677,42 @@ def gap(bias, snapshot, population):
             'bias_property': bias_property,
             'aggregation_properties': [Properties(p).name for p in properties_id.properties],
             'coverage': coverage,}
-    if represented_biases:
-        meta['bias_labels'] = represented_biases
-    full_response = {'meta': meta, 'metrics': metrics}
-    return jsonify(**full_response)
+    if ranking is not None:
+        meta['ranking'] = ranking._asdict()
+    if bucket_width is not None:
+        meta['bucket'] = bucket_width
+    return meta, metrics, represented_biases
+
+
+def cached_response(cache_key, etag, immutable, if_none_match, accept_encodings):
+    """a 304 if the client has the response of cache_key, or the cached json response, or None to compute it"""
+    if if_none_match is not None:
+        for encoding in ['identity'] + CONTENT_ENCODINGS:
+            if if_none_match.contains_weak(variant_etag(etag, encoding)):
+                return set_cache_headers(app.response_class(status=304), variant_etag(etag, encoding), immutable)
+    cached_variants = gap_cache.get(cache_key)
+    if cached_variants is not None:
+        return encoded_response(cached_variants, accept_encodings, etag, immutable, GAP_FORMAT_MIMETYPES['json'])
+    return None
+
+
+def encoded_response(variants, accept_encodings, etag, immutable, mimetype):
+    """a response of the variant of a rendered gap response that the client accepts"""
+    encoding = negotiate_encoding(accept_encodings, variants)
+    response = app.response_class(variants[encoding], mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return set_cache_headers(response, variant_etag(etag, encoding), immutable)
+
+
+def prerendered_response(path, encoding, etag, immutable, mimetype):
+    """a prerendered gap response, sent with the server's file wrapper (sendfile where it has it)"""
+    response = send_file(path, mimetype=mimetype, add_etags=False)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return set_cache_headers(response, variant_etag(etag, encoding), immutable)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# the byte budget of rendered responses held per worker process
+GAP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# how long browsers and CDNs may keep the response of a dated snapshot, it never changes
+IMMUTABLE_MAX_AGE_SECONDS = 365 * 24 * 60 * 60
+# responses are compressed once, when they are cached, so the levels can be high
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+# most preferred first
+CONTENT_ENCODINGS = ['br', 'gzip']
+
+
+def make_gap_cache_key(bias, fill_id, population_id, population_corrected, ordered_query_params, label_lang,
+                       gap_format='json', ranking=None, bucket_width=None):
+    """
+    the normalized identity of a gap request. two requests with the same key always render the same response.
+    population_corrected is part of the key because it is echoed back in the meta.
+    :param ordered_query_params: the {pid: value} dict from order_query_params, before any predicate transform
+    :param gap_format: one of formats.GAP_FORMAT_MIMETYPES
+    :param ranking: the request's utils.GapRanking, if it has one
+    :param bucket_width: the request's year bucket width, if it has one
+    :return: a hashable tuple
+    """
+    gap_cache_key = (bias, fill_id, population_id, population_corrected, tuple(ordered_query_params.items()),
+                     label_lang, gap_format)
+    # requests without them keep the keys, and etags, they always had
+    if ranking is not None:
+        gap_cache_key += (tuple(ranking),)
+    if bucket_width is not None:
+        gap_cache_key += (('bucket', bucket_width),)
+    return gap_cache_key
+
+
+def make_etag(*key_parts):
+    """a strong etag for whatever identifies a response, like a gap cache key, the same in every worker"""
+    return hashlib.sha1(repr(key_parts).encode('utf-8')).hexdigest()
+
+
+def set_cache_headers(response, etag, immutable):
+    """
+    :param immutable: whether the response can never change, like one for a dated snapshot,
+     otherwise caches have to revalidate it, which is cheap with the etag
+    """
+    response.set_etag(etag)
+    if immutable:
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE_SECONDS}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'public, no-cache'
+    return response
+
+
+def variant_etag(etag, encoding):
+    """every encoding of a response is a different representation, so it needs its own etag"""
+    return etag if encoding == 'identity' else f'{etag}-{encoding}'
+
+
+def compress_variants(body):
+    """
+    :return: {content encoding: body} with the identity body, and gzip and brotli (if installed) variants,
+     bodies too small to be worth compressing only have the identity variant
+    """
+    variants = {'identity': body}
+    if len(body) < COMPRESS_MIN_BYTES:
+        return variants
+    variants['gzip'] = gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if brotli is not None:
+        variants['br'] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return variants
+
+
+def negotiate_encoding(accept_encodings, variants):
+    """
+    :param accept_encodings: the request's werkzeug Accept-Encoding, or None to send the identity body
+    :return: the best content encoding in variants that the client accepts
+    """
+    if accept_encodings is not None:
+        for encoding in CONTENT_ENCODINGS:
+            if encoding in variants and accept_encodings.quality(encoding) > 0:
+                return encoding
+    return 'identity'
+
+
+def variants_size(variants):
+    return sum(len(variant) for variant in variants.values())
+
+
+class ResponseCache(object):
+    """
+    An LRU cache of rendered response bodies, each with its compressed variants,
+    bounded by the total number of bytes it holds.
+    The data for a fill never changes after it is written, so entries never go stale on their own,
+    they are only evicted for space, or dropped when the latest fill changes.
+    """
+
+    def __init__(self, max_bytes=GAP_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.latest_fill_id = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """:return: the {content encoding: body} variants of key, or None"""
+        with self._lock:
+            variants = self._entries.get(key)
+            if variants is not None:
+                self._entries.move_to_end(key)
+            return variants
+
+    def put(self, key, body):
+        """
+        compress body and cache it with its variants
+        :return: the variants, whether or not they fit in the cache
+        """
+        variants = compress_variants(body)
+        size = variants_size(variants)
+        if size > self.max_bytes:
+            log.debug(f'not caching a response of {size} bytes, it is larger than the whole cache')
+            return variants
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= variants_size(self._entries.pop(key))
+            self._entries[key] = variants
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted_variants = self._entries.popitem(last=False)
+                self.current_bytes -= variants_size(evicted_variants)
+        return variants
+
+    def drop_fill(self, fill_id):
+        """drop every entry computed from fill_id, recall the fill_id is the second element of the key"""
+        with self._lock:
+            for key in [key for key in self._entries if key[1] == fill_id]:
+                self.current_bytes -= variants_size(self._entries.pop(key))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def observe_latest_fill(self, latest_fill_id):
+        """
+        when a new fill is published, older fills may have been deactivated or rewritten too,
+        so start from an empty cache rather than trying to work out which entries survive.
+        """
+        if self.latest_fill_id is not None and self.latest_fill_id != latest_fill_id:
+            log.info(f'latest fill changed from {self.latest_fill_id} to {latest_fill_id}, clearing response cache')
+            self.clear()
+        self.latest_fill_id = latest_fill_id
+
+    def __len__(self):
+        return len(self._entries)
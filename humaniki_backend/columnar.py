@@ -0,0 +1,254 @@
+import argparse
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from humaniki_backend.instrumentation import timed
+from humaniki_backend.query import build_gap_response, rank_metric_rows
+from humaniki_backend.utils import parse_year_range
+from humaniki_schema.schema import metric, metric_aggregations_j
+from humaniki_schema.utils import Properties
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# where exported fills live, queries fall back to the database when this is unset or the fill is not exported
+COLUMNAR_STORE_DIR = os.environ.get('HUMANIKI_COLUMNAR_STORE_DIR')
+COLUMNAR_EXPORT_YIELD_PER = 10000
+MISSING_CODE = -1
+
+
+def fill_dir(store_dir, fill_id):
+    return os.path.join(store_dir, f'fill_{fill_id}')
+
+
+def as_agg_str(agg_value):
+    """the same string json_unquote(json_extract(...)) gives for a json aggregation value"""
+    if agg_value is None:
+        return 'null'
+    return agg_value if isinstance(agg_value, str) else json.dumps(agg_value)
+
+
+def iter_export_rows(session, fill_id):
+    """
+    fill_id's metric rows as (properties_id, population_id, [aggregation value strings], bias_value, total),
+    ordered by properties_id and population_id, streamed from the cursor
+    """
+    metric_rows = session.query(metric.properties_id, metric.population_id, metric_aggregations_j.aggregations,
+                                metric.bias_value, metric.total) \
+        .join(metric_aggregations_j, metric.aggregations_id == metric_aggregations_j.id) \
+        .filter(metric.fill_id == fill_id) \
+        .order_by(metric.properties_id, metric.population_id) \
+        .yield_per(COLUMNAR_EXPORT_YIELD_PER)
+    for properties_id, population_id, aggregations, bias_value, total in metric_rows:
+        yield properties_id, population_id, [as_agg_str(agg) for agg in aggregations or []], bias_value, total
+
+
+def export_fill(session, fill_id, store_dir):
+    """
+    write fill_id's metric rows as column files in store_dir/fill_<fill_id>
+    the rows are read twice, once for the dictionaries and the row count, and then one properties_id and
+    population_id at a time into the preallocated column files, so memory never holds more than the largest of those
+    the files are written to a temporary directory first and renamed into place, so readers never see half an export
+    :return: the number of rows exported
+    """
+    export_start = time.time()
+    n_rows = 0
+    aggs_by_position = []
+    for _, _, aggregations, _, _ in iter_export_rows(session, fill_id):
+        n_rows += 1
+        while len(aggs_by_position) < len(aggregations):
+            aggs_by_position.append(set())
+        for position, agg in enumerate(aggregations):
+            aggs_by_position[position].add(agg)
+    dictionaries = [sorted(position_aggs) for position_aggs in aggs_by_position]
+    codes_by_position = [{agg: code for code, agg in enumerate(dictionary)} for dictionary in dictionaries]
+
+    final_dir = fill_dir(store_dir, fill_id)
+    tmp_dir = f'{final_dir}.tmp-{os.getpid()}'
+    os.makedirs(tmp_dir)
+    column_dtypes = {'properties_id': np.int64, 'population_id': np.int64, 'bias_value': np.int64, 'total': np.int64}
+    column_dtypes.update({f'agg_{position}': np.int32 for position in range(len(dictionaries))})
+    columns = {column_name: np.lib.format.open_memmap(os.path.join(tmp_dir, f'{column_name}.npy'), mode='w+',
+                                                      dtype=dtype, shape=(n_rows,))
+               for column_name, dtype in column_dtypes.items()}
+
+    group_start = 0
+    group_rows = itertools.groupby(iter_export_rows(session, fill_id), key=lambda row: (row[0], row[1]))
+    for (properties_id, population_id), rows in group_rows:
+        rows = list(rows)
+        group_stop = group_start + len(rows)
+        group_columns = {'properties_id': np.full(len(rows), properties_id, dtype=np.int64),
+                         'population_id': np.full(len(rows), population_id, dtype=np.int64),
+                         'bias_value': np.array([row[3] for row in rows], dtype=np.int64),
+                         'total': np.array([row[4] for row in rows], dtype=np.int64)}
+        for position, codes in enumerate(codes_by_position):
+            group_columns[f'agg_{position}'] = np.array(
+                [codes[row[2][position]] if position < len(row[2]) else MISSING_CODE for row in rows], dtype=np.int32)
+        # within a properties_id and population_id, np.lexsort sorts by the last key first
+        sort_keys = [group_columns['bias_value']] + \
+                    [group_columns[f'agg_{position}'] for position in reversed(range(len(codes_by_position)))]
+        row_order = np.lexsort(sort_keys)
+        for column_name, group_column in group_columns.items():
+            columns[column_name][group_start:group_stop] = group_column[row_order]
+        group_start = group_stop
+    if group_start != n_rows:
+        raise RuntimeError(f'fill {fill_id} had {n_rows} rows and then {group_start}, it changed during the export')
+    for column in columns.values():
+        column.flush()
+    del columns
+
+    with open(os.path.join(tmp_dir, 'dictionaries.json'), 'w') as f:
+        json.dump(dictionaries, f)
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump({'fill_id': fill_id, 'rows': n_rows, 'positions': len(dictionaries),
+                   'exported_at': time.time()}, f)
+    if os.path.exists(final_dir):
+        shutil.rmtree(final_dir)
+    os.rename(tmp_dir, final_dir)
+    log.info(f'exported {n_rows} rows of fill {fill_id} in {"%.3f" % (time.time() - export_start)} seconds')
+    return n_rows
+
+
+def value_predicate(prop, val):
+    """
+    the python equivalent of the predicate get_aggregations_id_preds builds in sql, applied to the aggregation
+    value strings. it is only ever evaluated against the (small) dictionaries, never per row.
+    """
+    if prop in [Properties.DATE_OF_BIRTH.value, Properties.DATE_OF_DEATH.value]:
+        exact_year_str, start_year, stop_year = parse_year_range(val)
+        if exact_year_str is not None:
+            return lambda agg_value: agg_value == exact_year_str
+
+        def year_fn(agg_value):
+            try:
+                year = int(agg_value)
+            except ValueError:
+                return False
+            return (start_year is None or year >= start_year) and (stop_year is None or year <= stop_year)
+
+        return year_fn
+    elif prop == Properties.PROJECT.value:
+        return lambda agg_value: agg_value == val
+    else:
+        target_qid = str(int(val))
+        return lambda agg_value: agg_value == target_qid
+
+
+class ColumnarSnapshot(object):
+    """
+    A read-only, memory-mapped copy of one fill's metric rows, as written by export_fill.
+    The columns are properties_id | population_id | agg_0 .. agg_n | bias_value | total
+    where agg_i is the code of the i-th aggregation value in the sorted dictionary of position i (or MISSING_CODE).
+    Rows are sorted by properties_id, population_id and then the codes, so a query is two binary searches and
+    vectorized masks, and ordering by code is ordering by value, just like get_metrics.
+    Every worker maps the same files, so they share one copy in the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        with open(os.path.join(path, 'dictionaries.json')) as f:
+            self.dictionaries = json.load(f)
+        self.positions = self.manifest['positions']
+        column_names = ['properties_id', 'population_id', 'bias_value', 'total'] + \
+                       [f'agg_{position}' for position in range(self.positions)]
+        self.columns = {column_name: np.load(os.path.join(path, f'{column_name}.npy'), mmap_mode='r')
+                        for column_name in column_names}
+
+    def row_range(self, properties_id, population_id):
+        """the [start, stop) rows of one properties_id and population_id, they are contiguous because of the sort"""
+        properties_ids = self.columns['properties_id']
+        start = np.searchsorted(properties_ids, properties_id, side='left')
+        stop = np.searchsorted(properties_ids, properties_id, side='right')
+        population_ids = self.columns['population_id'][start:stop]
+        pop_start = np.searchsorted(population_ids, population_id, side='left')
+        pop_stop = np.searchsorted(population_ids, population_id, side='right')
+        return start + pop_start, start + pop_stop
+
+    def get_metrics(self, population_id, properties_id, ordered_query_params):
+        """
+        answers what query.get_metrics answers, with the same rows and columns in the same order
+        :param properties_id: a properties object
+        :param ordered_query_params: the untransformed {pid: value} from order_query_params
+        :return: (list of rows, column descriptions)
+        """
+        properties = properties_id.properties
+        start, stop = self.row_range(properties_id.id, population_id)
+        mask = np.ones(stop - start, dtype=bool)
+        for position, (prop, val) in enumerate(ordered_query_params.items()):
+            if val.lower() == 'all':
+                continue
+            predicate = value_predicate(prop, val)
+            matching_codes = [code for code, agg_value in enumerate(self.dictionaries[position]) if predicate(agg_value)]
+            mask &= np.isin(self.columns[f'agg_{position}'][start:stop], matching_codes)
+        row_idxs = np.flatnonzero(mask) + start
+
+        # decode only the selected rows
+        row_columns = []
+        columns = []
+        for position, prop in enumerate(properties):
+            dictionary = self.dictionaries[position]
+            agg_codes = self.columns[f'agg_{position}'][row_idxs].tolist()
+            row_columns.append([prop] * len(row_idxs))
+            row_columns.append([dictionary[code] if code != MISSING_CODE else None for code in agg_codes])
+            columns.extend([{'name': f'prop_{position}'}, {'name': f'agg_{position}'}])
+        row_columns.append(self.columns['bias_value'][row_idxs].tolist())
+        row_columns.append(self.columns['total'][row_idxs].tolist())
+        columns.extend([{'name': 'bias_value'}, {'name': 'total'}])
+        return list(zip(*row_columns)), columns
+
+
+# {fill_id: (the inode and mtime of its manifest, ColumnarSnapshot)}, a re-export writes a new manifest
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def get_columnar_snapshot(fill_id, store_dir=COLUMNAR_STORE_DIR):
+    """the ColumnarSnapshot of fill_id if it has been exported, otherwise None"""
+    if not store_dir:
+        return None
+    path = fill_dir(store_dir, fill_id)
+    try:
+        manifest_stat = os.stat(os.path.join(path, 'manifest.json'))
+    except FileNotFoundError:
+        # not exported (yet), look again next time
+        return None
+    manifest_version = (manifest_stat.st_ino, manifest_stat.st_mtime_ns)
+    with _snapshots_lock:
+        if fill_id not in _snapshots or _snapshots[fill_id][0] != manifest_version:
+            _snapshots[fill_id] = (manifest_version, ColumnarSnapshot(path))
+        return _snapshots[fill_id][1]
+
+
+def build_metrics_from_snapshot(session, columnar_snapshot, population_id, properties_id, ordered_query_params,
+                                label_lang, stage_timer=None, ranking=None):
+    """the columnar counterpart of query.build_metrics"""
+    query_start = time.time()
+    with timed(stage_timer, 'sql'):
+        metrics, metrics_columns = columnar_snapshot.get_metrics(population_id, properties_id, ordered_query_params)
+        metrics = rank_metric_rows(metrics, metrics_columns, ranking)
+    log.debug(f"Querying columnar metrics took {'%.3f' % (time.time() - query_start)} seconds")
+    return build_gap_response(properties_id, metrics, metrics_columns, label_lang, session,
+                              stage_timer=stage_timer)
+
+
+if __name__ == '__main__':
+    # python -m humaniki_backend.columnar --fill-id 3 --store-dir /srv/humaniki/columnar
+    from humaniki_schema.db import session_factory
+
+    parser = argparse.ArgumentParser(description='export a fill to the memory-mapped columnar store')
+    parser.add_argument('--fill-id', type=int, required=True)
+    parser.add_argument('--store-dir', default=COLUMNAR_STORE_DIR, required=COLUMNAR_STORE_DIR is None)
+    args = parser.parse_args()
+    export_session = session_factory()
+    try:
+        export_fill(export_session, args.fill_id, args.store_dir)
+    finally:
+        export_session.close()
@@ -0,0 +1,102 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+from prometheus_client import Counter
+
+from humaniki_backend.instrumentation import timed
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# run a gap request's independent queries (coverage, labels, metrics) at the same time, each on its own connection.
+# every concurrent request can then hold up to three connections, so size the connection pool accordingly.
+CONCURRENT_GAP_QUERIES = os.environ.get('HUMANIKI_CONCURRENT_GAP_QUERIES', '').lower() in ('1', 'true', 'yes')
+GAP_QUERY_THREADS = 8
+# how long a request waits on an identical one already being computed, before giving up with a 503
+SINGLE_FLIGHT_TIMEOUT_SECONDS = float(os.environ.get('HUMANIKI_SINGLE_FLIGHT_TIMEOUT_SECONDS', 30))
+
+COALESCED_REQUESTS = Counter('humaniki_coalesced_requests_total',
+                             'requests answered by waiting on an identical request already being computed')
+
+# threads are only started on the first submit, so this is safe to create before a fork
+_executor = ThreadPoolExecutor(max_workers=GAP_QUERY_THREADS, thread_name_prefix='gap-query')
+
+
+def submit_query(session_factory, query_fn, **kwargs):
+    """
+    run query_fn(session=<a new session>, **kwargs) on the pool, the session is closed once it returns.
+    scoped sessions belong to their thread, so a query on the pool can never share the request's session.
+    :return: a concurrent.futures.Future of query_fn's result
+    """
+    def run_query():
+        session = session_factory()
+        try:
+            return query_fn(session=session, **kwargs)
+        finally:
+            session.close()
+
+    return _executor.submit(run_query)
+
+
+def log_query_failure(query_future):
+    """a done callback for a future of submit_query that is never waited on, so that its failure is not lost"""
+    if not query_future.cancelled() and query_future.exception() is not None:
+        log.error('a query on the pool failed', exc_info=query_future.exception())
+
+
+class FlightTimeout(Exception):
+    """waited longer than the timeout on an identical request being computed"""
+
+
+class FlightAborted(Exception):
+    """the identical request being waited on was interrupted before it finished"""
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical work running at the same time in one worker process.
+    The first caller of a key computes it, everyone who asks for the same key while it is computing waits
+    and shares its result, or its exception. Nothing is kept once it is done, that is the response cache's job.
+    """
+
+    def __init__(self, timeout=SINGLE_FLIGHT_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, stage_timer=None):
+        """
+        :return: fn(), or the result of the call of fn for key that is already in flight
+        :raises FlightTimeout: when waiting on another caller took longer than the timeout
+        :raises FlightAborted: when the other caller was interrupted before it finished
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+        if not leader:
+            COALESCED_REQUESTS.inc()
+            with timed(stage_timer, 'coalesced'):
+                try:
+                    return flight.result(timeout=self.timeout)
+                except TimeoutError:
+                    raise FlightTimeout(f'waited over {self.timeout}s on an identical request')
+        try:
+            result = fn()
+        except Exception as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._flights[key]
+            # a GeneratorExit or KeyboardInterrupt is the leader's own, the waiters are only told it stopped
+            if not flight.done():
+                flight.set_exception(FlightAborted('the identical request was interrupted'))
+
+    def __len__(self):
+        return len(self._flights)
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+
+from humaniki_backend.instrumentation import timed
+from humaniki_backend.labels import label_store
+from humaniki_backend.query import get_metrics, make_item_labels
+from humaniki_backend.reference import reference_data
+from humaniki_backend.utils import is_property_exclusively_citizenship
+from humaniki_schema.utils import Properties
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# the decimal places of a change in share, like coverage's
+SHARE_CHANGE_DECIMALS = 4
+
+
+def align_fill_totals(metrics_rows, columns, from_fill_id, to_fill_id):
+    """
+    align the metric rows of two fills on their aggregation values
+    :param metrics_rows: rows with a fill_id column, see query.make_metrics_statement
+    :return: (from_totals, to_totals) dataframes with the same index of aggregation values and a column per bias value,
+     0 where a fill has no such humans, or (None, None) if there are no rows
+    """
+    col_names = [col['name'] for col in columns]
+    agg_cols = [name for name in col_names if name.startswith('agg')]
+    metrics_df = pd.DataFrame.from_records(metrics_rows, columns=col_names)
+    if agg_cols:
+        # rows without an aggregation value do not belong to any item
+        metrics_df = metrics_df.dropna(subset=agg_cols)
+    else:
+        # no aggregations were asked for, there is still one global item
+        agg_cols = ['global']
+        metrics_df['global'] = ''
+    if metrics_df.empty:
+        return None, None
+    totals = metrics_df.pivot_table(index=agg_cols, columns=['fill_id', 'bias_value'], values='total', aggfunc='sum',
+                                    fill_value=0)
+    bias_values = sorted(metrics_df['bias_value'].unique().tolist())
+    both_fills = pd.MultiIndex.from_product([sorted({from_fill_id, to_fill_id}), bias_values],
+                                            names=['fill_id', 'bias_value'])
+    totals = totals.reindex(columns=both_fills, fill_value=0)
+    return totals[from_fill_id], totals[to_fill_id]
+
+
+def build_diff_metrics(session, from_fill_id, to_fill_id, population_id, properties_id, aggregations_id, label_lang,
+                       limit=None, stage_timer=None):
+    """
+    the metrics of two fills from one query, aligned on their aggregation values, with the change of each bias value's
+    total and share of the item
+    :param limit: only this many items, those whose total changed the most either way, or None for every item
+    :return: (data points, represented_biases) each data point is
+     {'order': 0, 'item': {...}, 'item_label': {...},
+      'values': {bias_value: [total in from, total in to]}, 'delta': {bias_value: change in total},
+      'share_change': {bias_value: change in share, None if the item had no humans in either}, 'total_delta': n}
+    """
+    with timed(stage_timer, 'sql'):
+        metrics, metrics_columns = get_metrics(session, [from_fill_id, to_fill_id], population_id, properties_id,
+                                               aggregations_id, stage_timer=stage_timer)
+    with timed(stage_timer, 'grouping'):
+        from_totals, to_totals = align_fill_totals(metrics, metrics_columns, from_fill_id, to_fill_id)
+        if from_totals is None:
+            return [], {} if label_lang else None
+        deltas = to_totals - from_totals
+        # a share is NaN where an item has no humans in that fill
+        share_changes = to_totals.div(to_totals.sum(axis=1), axis=0) - from_totals.div(from_totals.sum(axis=1), axis=0)
+        total_deltas = deltas.sum(axis=1)
+        if limit is not None:
+            # a stable sort, ties stay in the order of their aggregation values
+            top_items = total_deltas.abs().sort_values(ascending=False, kind='mergesort').index[:limit]
+            from_totals, to_totals, deltas, share_changes, total_deltas = \
+                [frame.loc[top_items] for frame in (from_totals, to_totals, deltas, share_changes, total_deltas)]
+
+    with timed(stage_timer, 'labels'):
+        iso_codes = reference_data.get_iso_codes(session) if is_property_exclusively_citizenship(properties_id) \
+            else None
+        labels = label_store.for_lang(session, label_lang) if label_lang else None
+    bias_values = from_totals.columns.tolist()
+    represented_biases = {bias_value: labels.bias_label(bias_value) for bias_value in bias_values} \
+        if label_lang else None
+
+    prop_names = [Properties(p).name.lower() for p in properties_id.properties]
+    label_fns = [labels.label_fn_for_property(p) for p in properties_id.properties] if labels else []
+    # plain python values, once for the whole frame rather than per cell
+    from_rows, to_rows, delta_rows, share_change_rows, item_total_deltas = \
+        [frame.to_numpy().tolist() for frame in (from_totals, to_totals, deltas, share_changes, total_deltas)]
+    data_points = []
+    for item_i, group_name in enumerate(from_totals.index):
+        group_name = group_name if isinstance(group_name, tuple) else (group_name,)
+        data_points.append({
+            'order': item_i,
+            'item': dict(zip(prop_names, group_name)),
+            'item_label': make_item_labels(prop_names, label_fns, group_name, iso_codes),
+            'values': {bias_value: [from_total, to_total] for bias_value, from_total, to_total in
+                       zip(bias_values, from_rows[item_i], to_rows[item_i])},
+            'delta': dict(zip(bias_values, delta_rows[item_i])),
+            'share_change': {bias_value: None if np.isnan(share_change) else round(share_change, SHARE_CHANGE_DECIMALS)
+                             for bias_value, share_change in zip(bias_values, share_change_rows[item_i])},
+            'total_delta': item_total_deltas[item_i]})
+    if stage_timer is not None:
+        stage_timer.count_rows('metric_rows', len(metrics))
+        stage_timer.count_rows('data_points', len(data_points))
+    return data_points, represented_biases
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+from humaniki_backend.query import get_all_snapshot_dates
+from humaniki_schema.queries import get_latest_fill_id, get_exact_fill_id
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# how often each worker re-reads the fill table, 0 or None to only refresh on demand
+FILL_REFRESH_SECONDS = 300
+
+# everything known about the fills at one point in time, never mutated except to memoize exact_fills
+FillSnapshot = namedtuple('FillSnapshot', ['latest_fill_id', 'latest_fill_date', 'available_snapshots',
+                                           'exact_fills', 'loaded_at'])
+
+
+class FillRegistry(object):
+    """
+    A process-wide view of the fill table.
+    It is loaded on first use, refreshed by a background thread every refresh_seconds (or by calling refresh),
+    and the new view is swapped in with a single assignment, so a request only ever sees one consistent snapshot.
+    Listeners are called with the new latest fill id whenever it changes.
+    """
+
+    def __init__(self, session_factory, refresh_seconds=FILL_REFRESH_SECONDS):
+        self.session_factory = session_factory
+        self.refresh_seconds = refresh_seconds
+        self._snapshot = None
+        self._listeners = []
+        self._refresh_lock = threading.Lock()
+        # the refresher thread does not survive a fork, so remember which process started it
+        self._refresher_pid = None
+
+    def snapshot(self):
+        fill_snapshot = self._snapshot
+        if fill_snapshot is None:
+            fill_snapshot = self.refresh()
+        self._ensure_refresher()
+        return fill_snapshot
+
+    def refresh(self):
+        with self._refresh_lock:
+            session = self.session_factory()
+            try:
+                latest_fill_id, latest_fill_date = get_latest_fill_id(session)
+                available_snapshots = get_all_snapshot_dates(session)
+            finally:
+                session.close()
+            previous_snapshot = self._snapshot
+            self._snapshot = FillSnapshot(latest_fill_id=latest_fill_id,
+                                          latest_fill_date=latest_fill_date,
+                                          available_snapshots=available_snapshots,
+                                          exact_fills={},
+                                          loaded_at=time.time())
+        if previous_snapshot is None or previous_snapshot.latest_fill_id != latest_fill_id:
+            log.info(f'latest fill is now {latest_fill_id} from {latest_fill_date}')
+            for listener in self._listeners:
+                listener(latest_fill_id)
+        return self._snapshot
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def get_exact_fill_id(self, session, exact_fill_dt):
+        """a memoized humaniki_schema.queries.get_exact_fill_id, dropped on every refresh"""
+        exact_fills = self.snapshot().exact_fills
+        if exact_fill_dt not in exact_fills:
+            fill_id, fill_date = get_exact_fill_id(session, exact_fill_dt)
+            if not fill_id:
+                # don't remember misses, the fill could be published before the next refresh
+                return fill_id, fill_date
+            exact_fills[exact_fill_dt] = (fill_id, fill_date)
+        return exact_fills[exact_fill_dt]
+
+    def _ensure_refresher(self):
+        if not self.refresh_seconds or self._refresher_pid == os.getpid():
+            return
+        with self._refresh_lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            refresher = threading.Thread(target=self._refresh_forever, name='fill-registry-refresher', daemon=True)
+            refresher.start()
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_seconds)
+            try:
+                self.refresh()
+            except Exception:
+                log.exception('could not refresh the fill registry, keeping the previous snapshot')
@@ -0,0 +1,143 @@
+import json
+from decimal import Decimal
+
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+GAP_FORMAT_MIMETYPES = {'json': 'application/json',
+                        'columnar': 'application/json',
+                        'msgpack': 'application/x-msgpack',
+                        'arrow': 'application/vnd.apache.arrow.stream'}
+# the binary formats need their optional library
+GAP_FORMAT_LIBRARIES = {'msgpack': msgpack, 'arrow': pyarrow}
+
+
+def available_gap_formats():
+    return [gap_format for gap_format in GAP_FORMAT_MIMETYPES if
+            gap_format not in GAP_FORMAT_LIBRARIES or GAP_FORMAT_LIBRARIES[gap_format] is not None]
+
+
+def encode_default(obj):
+    """
+    the values neither json nor msgpack know, numpy's scalars and arrays come back from the columnar store,
+    and mysql returns its aggregates, like SUM, as decimals
+    """
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    elif isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.bool_):
+        return bool(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f'{type(obj).__name__} is not serializable')
+
+
+def dumps_json(obj):
+    """
+    json bytes with sorted keys, like jsonify, but with orjson when it is installed, which is much faster
+    on the many small dicts of a gap response
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=encode_default,
+                            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=encode_default, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def with_str_keys(d):
+    return {str(key): val for key, val in d.items()} if d is not None else None
+
+
+def columnar_gap_metrics(data_points, represented_biases):
+    """
+    the data points as parallel arrays instead of a list of dicts, so that no key is repeated per data point
+    {"length": n,
+     "item": {prop_name: [value of data point 0, ...]},
+     "item_label": {prop_name: {value: label}}, every label once, with "iso_3166" keyed by citizenship
+     "values": {bias_value: [total of data point 0 or null, ...]}}
+    the data points are in order, so "order" is just the position.
+    """
+    prop_names = list(data_points[0]['item']) if data_points else []
+    bias_values = set(represented_biases or ())
+    for data_point in data_points:
+        bias_values.update(data_point['values'])
+    bias_values = sorted(bias_values)
+    items = {prop_name: [] for prop_name in prop_names}
+    item_labels = {}
+    values = {str(bias_value): [] for bias_value in bias_values}
+    for data_point in data_points:
+        for prop_name, agg_value in data_point['item'].items():
+            items[prop_name].append(agg_value)
+        for label_name, item_label in data_point['item_label'].items():
+            # iso codes label the first (and only) property, citizenship
+            labelled_value = data_point['item'][prop_names[0] if label_name == 'iso_3166' else label_name]
+            item_labels.setdefault(label_name, {})[str(labelled_value)] = item_label
+        for bias_value in bias_values:
+            values[str(bias_value)].append(data_point['values'].get(bias_value))
+    return {'length': len(data_points), 'item': items, 'item_label': item_labels, 'values': values}
+
+
+def arrow_gap(meta, columnar_metrics):
+    """an arrow ipc stream of one record batch, a column per property, label and bias value, meta in the schema"""
+    arrays, names = [], []
+    for prop_name, agg_values in columnar_metrics['item'].items():
+        arrays.append(pyarrow.array([str(agg_value) for agg_value in agg_values], type=pyarrow.string()))
+        names.append(f'item_{prop_name}')
+    for label_name, item_labels in columnar_metrics['item_label'].items():
+        item_name = label_name if label_name in columnar_metrics['item'] else next(iter(columnar_metrics['item']))
+        arrays.append(pyarrow.array([item_labels.get(str(agg_value)) for agg_value in
+                                     columnar_metrics['item'][item_name]], type=pyarrow.string()))
+        names.append(f'label_{label_name}')
+    for bias_value, totals in columnar_metrics['values'].items():
+        totals = [total if total is None or isinstance(total, int) else encode_default(total) for total in totals]
+        arrays.append(pyarrow.array(totals, type=pyarrow.int64()))
+        names.append(f'value_{bias_value}')
+    record_batch = pyarrow.RecordBatch.from_arrays(arrays, names=names) \
+        .replace_schema_metadata({'meta': dumps_json(meta)})
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, record_batch.schema) as writer:
+        writer.write_batch(record_batch)
+    return sink.getvalue().to_pybytes()
+
+
+def render_gap(gap_format, meta, data_points, represented_biases):
+    """
+    :param gap_format: one of available_gap_formats()
+    :param meta: the gap response's meta, with bias_labels if there are any
+    :return: (body bytes, mimetype)
+    """
+    if gap_format == 'json':
+        body = dumps_json({'meta': meta, 'metrics': data_points})
+    else:
+        columnar_metrics = columnar_gap_metrics(data_points, represented_biases)
+        # msgpack and arrow only take string keys, and json turns the bias values into strings anyway
+        meta = dict(meta, bias_labels=with_str_keys(meta['bias_labels'])) if 'bias_labels' in meta else meta
+        if gap_format == 'columnar':
+            body = dumps_json({'meta': meta, 'metrics': columnar_metrics})
+        elif gap_format == 'msgpack' and msgpack is not None:
+            body = msgpack.packb({'meta': meta, 'metrics': columnar_metrics}, default=encode_default,
+                                 use_bin_type=True)
+        elif gap_format == 'arrow' and pyarrow is not None:
+            body = arrow_gap(meta, columnar_metrics)
+        else:
+            raise ValueError(f'format must be one of {available_gap_formats()}, not {gap_format}')
+    return body, GAP_FORMAT_MIMETYPES[gap_format]
@@ -0,0 +1,90 @@
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+from prometheus_client import Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# the stages of a gap request, in the order they happen, a coalesced request waits in place of those after estimate
+GAP_STAGES = ['validation', 'fill', 'estimate', 'queued', 'properties', 'coverage', 'sql', 'labels', 'grouping',
+              'serialization', 'coalesced']
+STAGE_SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+ROW_COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+GAP_STAGE_SECONDS = Histogram('humaniki_gap_stage_seconds', 'seconds spent in each stage of a gap request',
+                              ['stage'], buckets=STAGE_SECONDS_BUCKETS)
+GAP_REQUEST_SECONDS = Histogram('humaniki_gap_request_seconds', 'seconds spent building a gap response',
+                                buckets=STAGE_SECONDS_BUCKETS)
+GAP_ROWS = Histogram('humaniki_gap_rows', 'metric rows read, and data points returned, per gap request',
+                     ['kind'], buckets=ROW_COUNT_BUCKETS)
+
+
+class StageTimer(object):
+    """
+    Collects how long each stage of one gap request took, and how many rows it saw.
+    The timings go out to the client as a Server-Timing header and into the prometheus histograms.
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.durations = OrderedDict()
+        # a copy of durations once the request is done with them, for other threads to read
+        self.finished_durations = None
+        self.row_counts = {}
+
+    @contextmanager
+    def stage(self, stage_name):
+        stage_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # a stage can be entered more than once, like the sql of a batch
+            self.durations[stage_name] = self.durations.get(stage_name, 0) + time.perf_counter() - stage_start
+
+    def count_rows(self, kind, n):
+        self.row_counts[kind] = n
+
+    def server_timing(self):
+        """:return: the Server-Timing header value, durations in milliseconds"""
+        stage_timings = [f'{stage_name};dur={"%.1f" % (seconds * 1000)}' for stage_name, seconds in
+                         self.durations.items()]
+        stage_timings.append(f'total;dur={"%.1f" % ((time.perf_counter() - self.started_at) * 1000)}')
+        return ', '.join(stage_timings)
+
+    def observe(self):
+        """export the timings and row counts of a finished request"""
+        self.finished_durations = dict(self.durations)
+        for stage_name, seconds in self.durations.items():
+            GAP_STAGE_SECONDS.labels(stage=stage_name).observe(seconds)
+        for kind, n in self.row_counts.items():
+            GAP_ROWS.labels(kind=kind).observe(n)
+        GAP_REQUEST_SECONDS.observe(time.perf_counter() - self.started_at)
+
+    def finish(self, response):
+        """add the Server-Timing header to response and export the timings"""
+        response.headers['Server-Timing'] = self.server_timing()
+        self.observe()
+        return response
+
+
+def timed(stage_timer, stage_name):
+    """stage_timer.stage(stage_name), or nothing when there is no stage_timer, so timing stays optional"""
+    return stage_timer.stage(stage_name) if stage_timer is not None else nullcontext()
+
+
+def render_metrics():
+    """
+    :return: (body, content_type) of the prometheus exposition.
+    under a multi-worker server set PROMETHEUS_MULTIPROC_DIR, so that every worker's histograms are added up.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,129 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from humaniki_schema.schema import label, label_misc
+from humaniki_schema.utils import Properties
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# the approximate bytes of labels to hold in memory per worker, least recently used languages are dropped first
+LABEL_MAX_BYTES = int(os.environ.get('HUMANIKI_LABEL_MAX_BYTES', 256 * 1024 * 1024))
+
+
+def approximate_dict_bytes(labels_dict):
+    """the memory held by a dict of strings, its own table and every key and value"""
+    return sys.getsizeof(labels_dict) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                            for key, value in labels_dict.items())
+
+
+class LanguageLabels(object):
+    """
+    Every label in one language, keyed by the string form of what is being labelled:
+     qids: label.qid -> label, for occupations, citizenships etc.
+     misc: label_misc.src -> label, for sitelinks (projects)
+     bias: label_misc.src -> label, for bias values like genders
+    """
+
+    def __init__(self, lang, qids, misc, bias):
+        self.lang = lang
+        self.qids = qids
+        self.misc = misc
+        self.bias = bias
+        self.nbytes = approximate_dict_bytes(qids) + approximate_dict_bytes(misc) + approximate_dict_bytes(bias)
+
+    def __len__(self):
+        return len(self.qids) + len(self.misc) + len(self.bias)
+
+    def label_fn_for_property(self, prop):
+        """the function mapping an aggregation value of property prop to its label"""
+        if prop == Properties.PROJECT.value:  # recall we are faking sitelinks as property 0
+            return lambda agg_value: self.misc.get(str(agg_value))
+        elif prop in [Properties.DATE_OF_BIRTH.value, Properties.DATE_OF_DEATH.value]:
+            return lambda agg_value: agg_value  # years are their own label
+        else:
+            return lambda agg_value: self.qids.get(str(agg_value))
+
+    def bias_label(self, bias_value):
+        return self.bias.get(str(bias_value))
+
+
+def load_language_labels(session, lang):
+    load_start = time.time()
+    qids = {str(qid): qid_label for qid, qid_label in
+            session.query(label.qid, label.label).filter(label.lang == lang)}
+    misc, bias = {}, {}
+    misc_rows = session.query(label_misc.src, label_misc.label, label_misc.type).filter(label_misc.lang == lang)
+    for src, src_label, label_type in misc_rows:
+        if label_type == 'bias':
+            bias[str(src)] = src_label
+        else:
+            misc[str(src)] = src_label
+    language_labels = LanguageLabels(lang, qids=qids, misc=misc, bias=bias)
+    log.info(f'loaded {len(language_labels)} {lang} labels in {"%.3f" % (time.time() - load_start)} seconds')
+    return language_labels
+
+
+class LabelStore(object):
+    """
+    Lazily loads and holds LanguageLabels, bounded by their approximate total number of bytes.
+    Labels are written with each fill, so everything is dropped when the latest fill changes.
+    """
+
+    def __init__(self, max_bytes=LABEL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.latest_fill_id = None
+        self._langs = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def for_lang(self, session, lang):
+        with self._lock:
+            language_labels = self._langs.get(lang)
+            if language_labels is not None:
+                self._langs.move_to_end(lang)
+                return language_labels
+            load_lock = self._load_locks.setdefault(lang, threading.Lock())
+        # only one thread loads a language, the others wait for it rather than loading it again
+        with load_lock:
+            with self._lock:
+                language_labels = self._langs.get(lang)
+            if language_labels is None:
+                language_labels = load_language_labels(session, lang)
+                self.put(lang, language_labels)
+        return language_labels
+
+    def put(self, lang, language_labels):
+        if language_labels.nbytes > self.max_bytes:
+            log.warning(f'not keeping the {lang} labels of {language_labels.nbytes} bytes, '
+                        f'they are larger than the whole label store')
+            return
+        with self._lock:
+            if lang in self._langs:
+                self.current_bytes -= self._langs.pop(lang).nbytes
+            self._langs[lang] = language_labels
+            self.current_bytes += language_labels.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted_labels = self._langs.popitem(last=False)
+                self.current_bytes -= evicted_labels.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._langs.clear()
+            self.current_bytes = 0
+
+    def __contains__(self, lang):
+        return lang in self._langs
+
+    def observe_latest_fill(self, latest_fill_id):
+        if self.latest_fill_id is not None and self.latest_fill_id != latest_fill_id:
+            log.info(f'latest fill changed from {self.latest_fill_id} to {latest_fill_id}, dropping labels')
+            self.clear()
+        self.latest_fill_id = latest_fill_id
+
+
+label_store = LabelStore()
@@ -0,0 +1,174 @@
+import argparse
+import threading
+import time
+
+from sqlalchemy import Table, Column, Integer, String, MetaData, Index, cast, func, literal, and_, inspect
+
+from humaniki_backend.instrumentation import timed
+from humaniki_backend.query import build_gap_response, rank_metric_rows
+from humaniki_backend.querylog import slow_query_log
+from humaniki_backend.utils import parse_year_range
+from humaniki_schema.schema import metric, metric_aggregations_j, metric_properties_j
+from humaniki_schema.utils import Properties
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+WIDE_TABLE_PREFIX = 'metric_wide'
+# how long the list of materialized tables is trusted before asking the database again
+WIDE_TABLE_CATALOG_SECONDS = 300
+
+wide_metadata = MetaData()
+
+
+def wide_table_name(fill_id, properties_id):
+    return f'{WIDE_TABLE_PREFIX}_f{fill_id}_p{properties_id}'
+
+
+def wide_agg_type(prop):
+    """sitelinks are strings, everything else (qids and years) is an integer"""
+    return String(255) if prop == Properties.PROJECT.value else Integer
+
+
+def define_wide_table(fill_id, properties_id):
+    """
+    the denormalized metric table of one fill and one properties shape
+    population_id | agg_0 | ... | agg_n | bias_value | total
+    with the aggregations typed, and indexed after the population so that filtering any one dimension can use an index
+    :param properties_id: a properties object
+    """
+    table_name = wide_table_name(fill_id, properties_id.id)
+    if table_name in wide_metadata.tables:
+        return wide_metadata.tables[table_name]
+    agg_cols = [Column(f'agg_{prop_i}', wide_agg_type(prop)) for prop_i, prop in enumerate(properties_id.properties)]
+    agg_indexes = [Index(f'ix_{table_name}_agg_{prop_i}', 'population_id', f'agg_{prop_i}')
+                   for prop_i in range(len(agg_cols))]
+    return Table(table_name, wide_metadata,
+                 Column('population_id', Integer, nullable=False),
+                 *agg_cols,
+                 Column('bias_value', Integer, nullable=False),
+                 Column('total', Integer, nullable=False),
+                 *agg_indexes)
+
+
+def materialize_fill(session, fill_id):
+    """
+    build a wide table for every properties shape in fill_id, replacing any that already exist
+    :return: the names of the tables built
+    """
+    properties_ids = [properties_id for (properties_id,) in
+                      session.query(metric.properties_id).filter(metric.fill_id == fill_id).distinct()]
+    properties_objs = session.query(metric_properties_j).filter(metric_properties_j.id.in_(properties_ids)).all()
+    bind = session.get_bind()
+    table_names = []
+    for properties_obj in properties_objs:
+        materialize_start = time.time()
+        wide_table = define_wide_table(fill_id, properties_obj)
+        wide_table.drop(bind, checkfirst=True)
+        wide_table.create(bind)
+        select_cols = [metric.population_id]
+        for prop_i, prop in enumerate(properties_obj.properties):
+            agg_value = func.json_unquote(func.json_extract(metric_aggregations_j.aggregations, f"$[{prop_i}]"))
+            select_cols.append(cast(agg_value, wide_agg_type(prop)))
+        select_cols.extend([metric.bias_value, metric.total])
+        metrics_q = session.query(*select_cols) \
+            .join(metric_aggregations_j, metric.aggregations_id == metric_aggregations_j.id) \
+            .filter(metric.fill_id == fill_id) \
+            .filter(metric.properties_id == properties_obj.id)
+        session.execute(wide_table.insert().from_select([col.name for col in wide_table.columns], metrics_q))
+        session.commit()
+        table_names.append(wide_table.name)
+        log.info(f'materialized {wide_table.name} in {"%.3f" % (time.time() - materialize_start)} seconds')
+    forget_wide_tables()
+    return table_names
+
+
+_catalog = {'table_names': None, 'loaded_at': 0}
+_catalog_lock = threading.Lock()
+
+
+def forget_wide_tables():
+    _catalog['table_names'] = None
+
+
+def get_wide_table(session, fill_id, properties_id):
+    """the materialized table for this fill and properties shape if there is one, otherwise None"""
+    with _catalog_lock:
+        if _catalog['table_names'] is None or time.time() - _catalog['loaded_at'] > WIDE_TABLE_CATALOG_SECONDS:
+            table_names = inspect(session.get_bind()).get_table_names()
+            _catalog['table_names'] = {name for name in table_names if name.startswith(WIDE_TABLE_PREFIX)}
+            _catalog['loaded_at'] = time.time()
+        table_names = _catalog['table_names']
+    if wide_table_name(fill_id, properties_id.id) not in table_names:
+        return None
+    return define_wide_table(fill_id, properties_id)
+
+
+def wide_value_predicate(agg_col, prop, val):
+    """the predicates get_aggregations_id_preds builds, but on a typed column of raw (untransformed) values"""
+    if prop in [Properties.DATE_OF_BIRTH.value, Properties.DATE_OF_DEATH.value]:
+        exact_year_str, start_year, stop_year = parse_year_range(val)
+        if exact_year_str is not None:
+            return agg_col == int(exact_year_str)
+        elif (start_year is not None) and (stop_year is not None):
+            return and_(agg_col >= start_year, agg_col <= stop_year)
+        elif start_year is not None:
+            return agg_col >= start_year
+        else:
+            return agg_col <= stop_year
+    elif prop == Properties.PROJECT.value:
+        return agg_col == val
+    else:
+        return agg_col == int(val)
+
+
+def build_wide_metrics_query(session, wide_table, population_id, properties_id, ordered_query_params):
+    """
+    the same rows get_metrics returns, in the same order, but from a materialized table with indexed columns
+    instead of extracting json per row.
+    :param ordered_query_params: the untransformed {pid: value} from order_query_params
+    """
+    query_cols = []
+    for prop_i, prop in enumerate(properties_id.properties):
+        agg_col = wide_table.c[f'agg_{prop_i}']
+        # the json path returns every aggregation value as a string
+        agg_str_col = agg_col if prop == Properties.PROJECT.value else cast(agg_col, String)
+        query_cols.append(literal(prop).label(f'prop_{prop_i}'))
+        query_cols.append(agg_str_col.label(f'agg_{prop_i}'))
+    agg_order_cols = query_cols[1::2]
+    query_cols.extend([wide_table.c.bias_value, wide_table.c.total])
+
+    metrics_q = session.query(*query_cols).filter(wide_table.c.population_id == population_id)
+    for prop_i, (prop, val) in enumerate(ordered_query_params.items()):
+        if val.lower() == 'all':
+            continue
+        metrics_q = metrics_q.filter(wide_value_predicate(wide_table.c[f'agg_{prop_i}'], prop, val))
+    return metrics_q.order_by(*agg_order_cols)
+
+
+def build_metrics_from_wide_table(session, wide_table, population_id, properties_id, ordered_query_params,
+                                  label_lang, stage_timer=None, ranking=None):
+    """the materialized counterpart of query.build_metrics"""
+    query_start = time.time()
+    metrics_q = build_wide_metrics_query(session, wide_table, population_id, properties_id, ordered_query_params)
+    with timed(stage_timer, 'sql'):
+        metrics = metrics_q.all()
+    slow_query_log.observe(session, metrics_q, time.time() - query_start, len(metrics), stage_timer=stage_timer)
+    log.debug(f"Querying {wide_table.name} took {'%.3f' % (time.time() - query_start)} seconds")
+    metrics = rank_metric_rows(metrics, metrics_q.column_descriptions, ranking)
+    return build_gap_response(properties_id, metrics, metrics_q.column_descriptions, label_lang, session,
+                              stage_timer=stage_timer)
+
+
+if __name__ == '__main__':
+    # python -m humaniki_backend.materialize --fill-id 3
+    from humaniki_schema.db import session_factory
+
+    parser = argparse.ArgumentParser(description='materialize the wide metric tables of a fill')
+    parser.add_argument('--fill-id', type=int, required=True)
+    args = parser.parse_args()
+    materialize_session = session_factory()
+    try:
+        materialize_fill(materialize_session, args.fill_id)
+    finally:
+        materialize_session.close()
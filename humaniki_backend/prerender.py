@@ -0,0 +1,114 @@
+import argparse
+import itertools
+import os
+import time
+
+from humaniki_backend.cache import CONTENT_ENCODINGS, compress_variants
+from humaniki_schema.utils import PopulationDefinition
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# where prerendered responses live, the app only looks for them when this is set
+PRERENDER_DIR = os.environ.get('HUMANIKI_PRERENDER_DIR')
+# the standard query space, every single and pair combination of these properties is a default dashboard view
+PRERENDER_BIASES = ['gender']
+PRERENDER_PROPERTIES = ['project', 'citizenship', 'occupation', 'date_of_birth', 'date_of_death']
+PRERENDER_LABEL_LANGS = [None, 'en']
+PRERENDER_FORMATS = ['json']
+
+
+def prerendered_path(store_dir, fill_id, etag, encoding):
+    """a prerendered response is named by its etag, which already identifies the normalized request and the fill"""
+    return os.path.join(store_dir, f'fill_{fill_id}', f'{etag}.{encoding}')
+
+
+def find_prerendered(fill_id, etag, accept_encodings, store_dir=None):
+    """
+    :param accept_encodings: the request's Accept-Encoding, or None for the uncompressed body
+    :param store_dir: PRERENDER_DIR by default
+    :return: (path, content encoding) of the best prerendered variant the client accepts, or None
+    """
+    store_dir = store_dir or PRERENDER_DIR
+    if not store_dir:
+        return None
+    accepted_encodings = [encoding for encoding in CONTENT_ENCODINGS
+                          if accept_encodings is not None and accept_encodings.quality(encoding) > 0]
+    for encoding in accepted_encodings + ['identity']:
+        path = prerendered_path(store_dir, fill_id, etag, encoding)
+        if os.path.exists(path):
+            return path, encoding
+    return None
+
+
+def enumerate_gap_queries(biases=PRERENDER_BIASES, label_langs=PRERENDER_LABEL_LANGS,
+                          gap_formats=PRERENDER_FORMATS):
+    """:return: generator of (bias, population, query_params) over the standard query space"""
+    populations = [population.name.lower() for population in PopulationDefinition]
+    combinations = itertools.chain(itertools.combinations(PRERENDER_PROPERTIES, 1),
+                                   itertools.combinations(PRERENDER_PROPERTIES, 2))
+    for combination in combinations:
+        for bias, population, label_lang, gap_format in itertools.product(biases, populations, label_langs,
+                                                                          gap_formats):
+            query_params = {prop_name: 'all' for prop_name in combination}
+            if label_lang:
+                query_params['label_lang'] = label_lang
+            if gap_format != 'json':
+                query_params['format'] = gap_format
+            yield bias, population, query_params
+
+
+def write_variants(store_dir, fill_id, etag, body):
+    """write body and its compressed variants, each renamed into place so the app never serves half a file"""
+    for encoding, variant in compress_variants(body).items():
+        path = prerendered_path(store_dir, fill_id, etag, encoding)
+        tmp_path = f'{path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(variant)
+        os.replace(tmp_path, path)
+
+
+def prerender_fill(snapshot, store_dir, label_langs=PRERENDER_LABEL_LANGS, gap_formats=PRERENDER_FORMATS):
+    """
+    render every response of the standard query space for snapshot through the app's own gap pipeline,
+    and write them to store_dir
+    :return: the number of responses written
+    """
+    # the app imports this module to serve the files, so it is only imported when rendering them
+    from humaniki_backend import app as gap_app
+    from humaniki_backend.utils import determine_fill_id
+
+    prerender_start = time.time()
+    written = 0
+    fills = gap_app.fill_registry.snapshot()
+    with gap_app.app.app_context():
+        fill_id, _, _ = determine_fill_id(gap_app.session, snapshot, fills.latest_fill_id, fills.latest_fill_date,
+                                          exact_fill_id_fn=gap_app.fill_registry.get_exact_fill_id)
+        os.makedirs(os.path.join(store_dir, f'fill_{fill_id}'), exist_ok=True)
+        for bias, population, query_params in enumerate_gap_queries(label_langs=label_langs,
+                                                                    gap_formats=gap_formats):
+            response = gap_app.build_gap(bias, snapshot, population, query_params, fills)
+            etag, _ = response.get_etag()
+            if response.status_code != 200 or etag is None:
+                # an errors response, like for a combination that was never computed
+                log.info(f'not prerendering {bias} {population} {query_params}, {response.get_data(as_text=True)}')
+                continue
+            write_variants(store_dir, fill_id, etag, response.get_data())
+            written += 1
+            # nothing is served from this process, don't keep every response in memory too
+            gap_app.gap_cache.clear()
+    log.info(f'prerendered {written} responses of fill {fill_id} in {"%.3f" % (time.time() - prerender_start)} '
+             f'seconds')
+    return written
+
+
+if __name__ == '__main__':
+    # python -m humaniki_backend.prerender --snapshot latest --store-dir /srv/humaniki/prerendered
+    parser = argparse.ArgumentParser(description='prerender the standard gap responses of a snapshot')
+    parser.add_argument('--snapshot', default='latest')
+    parser.add_argument('--store-dir', default=PRERENDER_DIR, required=PRERENDER_DIR is None)
+    parser.add_argument('--label-langs', nargs='*', default=[lang for lang in PRERENDER_LABEL_LANGS if lang],
+                        help='besides the unlabelled responses')
+    parser.add_argument('--formats', nargs='+', default=PRERENDER_FORMATS)
+    args = parser.parse_args()
+    prerender_fill(args.snapshot, args.store_dir, label_langs=[None] + args.label_langs, gap_formats=args.formats)
@@ -1,23 +1,41 @@
+import itertools
+import threading
 import time
+from collections import OrderedDict
 
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, Query
+from sqlalchemy.util import LRUCache
 
+from humaniki_backend.instrumentation import timed
+from humaniki_backend.labels import label_store
+from humaniki_backend.querylog import LazySQL, slow_query_log
+from humaniki_backend.reference import reference_data
 from humaniki_backend.utils import is_property_exclusively_citizenship, transform_ordered_aggregations_with_year_fns, \
-    transform_ordered_aggregations_with_proj_internal_codes, get_transform_ordered_aggregation_qid_match
+    transform_ordered_aggregations_with_proj_internal_codes, get_transform_ordered_aggregation_qid_match, \
+    AggregationPredicate, YEAR_PROPERTIES
 from humaniki_schema import utils
 from humaniki_schema.queries import get_aggregations_obj
-from humaniki_schema.schema import metric, metric_aggregations_j, metric_properties_j, label, label_misc, \
-    metric_aggregations_n, fill, metric_coverage
+from humaniki_schema.schema import metric, metric_aggregations_j, metric_properties_j, metric_aggregations_n, fill, \
+    metric_coverage
 
-from sqlalchemy import func, and_, desc, text
-
-import pandas as pd
+from sqlalchemy import func, and_, or_, desc, bindparam, cast, literal_column, Integer, String
 
 from humaniki_schema.utils import Properties, get_enum_from_str
 from humaniki_schema.log import get_logger
 
 log = get_logger(BASE_DIR=__file__)
 
+# how many metric rows to fetch from the cursor at a time when streaming a response
+STREAM_YIELD_PER = 1000
+# how many (fill, population) coverage tables to keep, they are a few hundred rows each
+COVERAGE_MAX_TABLES = 64
+_coverage_tables = OrderedDict()
+_coverage_tables_lock = threading.Lock()
+# metrics statements by the shape of request they answer, and their compiled forms
+METRICS_STATEMENT_CACHE_SIZE = 256
+_metrics_statements = LRUCache(METRICS_STATEMENT_CACHE_SIZE)
+_compiled_metrics_statements = LRUCache(METRICS_STATEMENT_CACHE_SIZE)
+
 
 def get_aggregations_id_preds(session, ordered_aggregations, non_orderable_params, as_subquery=True):
     '''transform the ordered_aggreation dict of {prop:value} to {prop: sqlalchemy predicate} for use later on
@@ -31,7 +49,7 @@ def get_aggregations_id_preds(session, ordered_aggregations, non_orderable_param
                         Properties.CITIZENSHIP: get_transform_ordered_aggregation_qid_match(Properties.CITIZENSHIP),
                         Properties.OCCUPATION: get_transform_ordered_aggregation_qid_match(Properties.OCCUPATION)}
 
-    ordered_aggregations_preds = ordered_aggregations # we will be overwriting this
+    ordered_aggregations_preds = dict(ordered_aggregations) # we will be overwriting this, but not the caller's
     for prop_id, val in ordered_aggregations.items():
         if val.lower() == 'all':
             continue
@@ -47,7 +65,8 @@ def get_aggregations_id_preds(session, ordered_aggregations, non_orderable_param
 
 
 
-def build_metrics(session, fill_id, population_id, properties_id, aggregations_id, label_lang):
+def build_metrics(session, fill_id, population_id, properties_id, aggregations_id, label_lang, stage_timer=None,
+                  ranking=None, bucket_width=None):
     """
     the entry point for building metrics, first querys the database for the metrics in question
     secondly, builds the nested-dict response.
@@ -58,16 +77,21 @@ def build_metrics(session, fill_id, population_id, properties_id, aggregations_i
     :param properties_id:
     :param aggregations_id:
     :param label_lang:
+    :param stage_timer: an optional instrumentation.StageTimer to record the sql and grouping stages in
+    :param ranking: an optional utils.GapRanking, only its page of data points is fetched
+    :param bucket_width: an optional number of years to group the year properties by
     :return:
     """
     # query the metrics table
     build_metrics_start_time = time.time()
-    metrics, metrics_columns = get_metrics(session, fill_id, population_id, properties_id, aggregations_id, label_lang)
+    with timed(stage_timer, 'sql'):
+        metrics, metrics_columns = get_metrics(session, fill_id, population_id, properties_id, aggregations_id,
+                                               stage_timer=stage_timer, ranking=ranking, bucket_width=bucket_width)
     build_metrics_query_end_time = time.time()
 
     # make a nested dictionary represented the metrics
     metrics_response, represented_biases = build_gap_response(properties_id, metrics, metrics_columns, label_lang,
-                                                              session)
+                                                              session, stage_timer=stage_timer)
     build_metrics_grouping_end_time = time.time()
 
     # timing
@@ -78,6 +102,27 @@ def build_metrics(session, fill_id, population_id, properties_id, aggregations_i
     return metrics_response, represented_biases
 
 
+def build_metrics_stream(session, fill_id, population_id, properties_id, aggregations_id, label_lang, ranking=None,
+                         bucket_width=None):
+    """
+    the streaming counterpart of build_metrics, nothing is queried until the data points are iterated.
+    :return: (generator of data points, represented_biases) represented_biases is None without a label_lang,
+     otherwise a dict which is only complete once the data points are exhausted.
+    """
+    # the iso codes and labels have to be looked up before the cursor is opened, the connection is busy after that.
+    iso_codes = reference_data.get_iso_codes(session) if is_property_exclusively_citizenship(properties_id) else None
+    labels = label_store.for_lang(session, label_lang) if label_lang else None
+    represented_biases = {} if label_lang else None
+
+    def generate_data_points():
+        metrics, metrics_columns = stream_metrics(session, fill_id, population_id, properties_id, aggregations_id,
+                                                  ranking=ranking, bucket_width=bucket_width)
+        yield from iter_gap_data_points(properties_id, metrics, metrics_columns, iso_codes=iso_codes,
+                                        labels=labels, represented_biases=represented_biases)
+
+    return generate_data_points(), represented_biases
+
+
 def generate_json_expansion_values(properties):
     property_query_cols = []
     for prop_i, prop in enumerate(properties):
@@ -90,93 +135,123 @@ def generate_json_expansion_values(properties):
     return property_query_cols
 
 
-def generate_aliased_tables_for_labelling(properties):
+def get_metrics(session, fill_id, population_id, properties_id, aggregations_id, stage_timer=None, ranking=None,
+                bucket_width=None):
     """
-    generate a list of dicts defining how to join an aggregation column
-    the details needed are the join table and the join_key like
-    [{table:label_misc as 'label_0', join_key:'src'}
-            ...
-                        {{table:label as 'label_n', join_key:'qid'}}]
-    note that the table the join table and key are dependent on the property
-    :param properties:
-    :return:
+    get the metrics based on population and properties, and optionally the aggregations
+    see build_metrics_statement for the shape of the rows.
+    :param stage_timer: the request's StageTimer, kept with the query if it is slow
+    :param ranking: an optional utils.GapRanking
+    :param bucket_width: an optional number of years to group the year properties by
+    :return: (list of rows, column descriptions)
     """
-    aliased_joins = []
-    for prop_i, prop in enumerate(properties):
-        if prop == 0:  # recall we are faking sitelinks as property 0
-            label_table = label_misc
-            join_key = 'src'
-        elif prop in [Properties.DATE_OF_BIRTH.value, Properties.DATE_OF_DEATH.value]:
-            label_table = None  # there is no join to be made
-            join_key = None  # there is no join to be made
-        else:
-            label_table = label
-            join_key = 'qid'
-        aliased_label = aliased(label_table, name=f"label_{prop_i}") if label_table else None
-        join_data = {'label_table': aliased_label, 'join_key': join_key}
-        aliased_joins.append(join_data)
-    return aliased_joins
+    metrics_statement, params = build_metrics_statement(fill_id, population_id, properties_id, aggregations_id,
+                                                        ranking=ranking, bucket_width=bucket_width)
+    log.debug('metrics statement is: %s', LazySQL(metrics_statement, params))
+    query_start = time.time()
+    metrics_res = execute_metrics_statement(session, metrics_statement, params)
+    metrics = metrics_res.fetchall()
+    slow_query_log.observe(session, metrics_statement, time.time() - query_start, len(metrics), params=params,
+                           stage_timer=stage_timer)
+    metrics_columns = [{'name': key} for key in metrics_res.keys()]
+    log.debug(f'Number of metrics to return are {len(metrics)}')
+    return metrics, metrics_columns
 
 
-def label_metric_query(session, metrics_subq, properties, label_lang):
+def stream_metrics(session, fill_id, population_id, properties_id, aggregations_id, ranking=None, bucket_width=None):
+    """
+    like get_metrics, but the rows are fetched from a server side cursor STREAM_YIELD_PER at a time,
+    so they can be grouped and sent on before the whole result has been read.
+    note that no other query can run on the session's connection until the rows are exhausted.
+    :return: (iterator of rows, column descriptions)
     """
-     So we have the metrics table, exploded into one aggregation per column, but need to join the labels
-     we create an alias of the label table per aggregation, and then join
-     note that sitelinks must be joined on label_misc.src and
-               qids      must be joined on label.qid
+    metrics_statement, params = build_metrics_statement(fill_id, population_id, properties_id, aggregations_id,
+                                                        ranking=ranking, bucket_width=bucket_width)
+    metrics_res = execute_metrics_statement(session, metrics_statement, params, stream_results=True)
+
+    def iter_rows():
+        while True:
+            rows = metrics_res.fetchmany(STREAM_YIELD_PER)
+            if not rows:
+                break
+            yield from rows
+
+    return iter_rows(), [{'name': key} for key in metrics_res.keys()]
+
+
+def execute_metrics_statement(session, metrics_statement, params, **execution_options):
+    """execute on the session's connection, reusing the compiled form of metrics_statement after the first time"""
+    connection = session.connection().execution_options(compiled_cache=_compiled_metrics_statements,
+                                                         **execution_options)
+    return connection.execute(metrics_statement, params)
+
 
-    :return: a sqlalchemy query
+def build_metrics_statement(fill_id, population_id, properties_id, aggregations_id, ranking=None, bucket_width=None):
     """
-    # i wish i could compute the alias joins inline in this function rather than upfront, but
-    # I believe I need the column names before I can start joining.
-    aliased_joins = generate_aliased_tables_for_labelling(properties)
-    aliased_label_cols = []
-    dimension_label_params = []
-    for i, aj in enumerate(aliased_joins):
-        if aj['label_table']:
-            # the left key from the unlabelled metric
-            metrics_subq_join_col = getattr(metrics_subq.c, f'agg_{i}')
-            # define the right key
-            label_join_table = aj['label_table']
-            label_join_key = aj['join_key']
-            label_subtable_cols = [getattr(label_join_table, label_join_key),
-                                   getattr(label_join_table, 'lang'),
-                                   getattr(label_join_table, 'label')]
-            label_join_table_lang_filtered = session.query(*label_subtable_cols) \
-                .filter(label_join_table.lang == label_lang) \
-                .subquery(f'label_sub_{i}')
-
-            # was
-            # label_col = aj['label_table'].label.label(f'label_agg_{i}')
-            label_col = label_join_table_lang_filtered.c.label.label(f'label_agg_{i}')
-
-            label_join_column = getattr(label_join_table_lang_filtered.c, label_join_key)
-            dimension_label_tuple = (label_join_table_lang_filtered, label_join_column, metrics_subq_join_col)
-            dimension_label_params.append(dimension_label_tuple)
-
-        else:  # we probably aren't joining, like for labelling years
-            label_col = getattr(metrics_subq.c, f'agg_{i}').label(f'label_agg_{i}')
-        aliased_label_cols.append(label_col)
-
-    # first there will always be the bias_value to label
-    bias_sublabel_table = session.query(label_misc).filter(label_misc.lang == label_lang,
-                                                           label_misc.type == 'bias').subquery('label_sub')
-
-    label_query_cols = [metrics_subq, bias_sublabel_table.c.label.label('bias_label'), *aliased_label_cols]
-    labelled_q = session.query(*label_query_cols) \
-        .outerjoin(bias_sublabel_table,
-                   bias_sublabel_table.c.src == metrics_subq.c.bias_value)
-
-    for (label_join_table_lang_filtered, label_join_column, metrics_subq_join_col) in dimension_label_params:
-        labelled_q = labelled_q \
-            .outerjoin(label_join_table_lang_filtered, label_join_column == metrics_subq_join_col)
-
-    return labelled_q
-
-
-def get_metrics(session, fill_id, population_id, properties_id, aggregations_id, label_lang):
+    the statement for the metrics based on population and properties, and optionally the aggregations,
+    with every value as a bound parameter.
+    the statement only depends on the shape of the request: how many properties, which of them are filtered and
+    with which operator. the few shapes there are are built once, see make_metrics_statement for the rows.
+    :param fill_id: a fill id, or a list of them for the rows of every fill, with a fill_id column
+    :param aggregations_id: a specificed aggregations id, a list of them, the {prop: predicate} of
+     get_aggregations_id_preds, or None
+    :param ranking: an optional utils.GapRanking, the sort and whether there is a limit and offset are part of the shape
+    :param bucket_width: an optional number of years to group the year properties by, it is part of the shape
+    :return: (statement, params)
     """
-    get the metrics based on population and properties, and optionally the aggregations
+    params = {'properties_id': properties_id.id, 'population_id': population_id}
+    if isinstance(fill_id, list):
+        if ranking is not None:
+            raise ValueError('the data points of many fills cannot be ranked')
+        fills_shape = 'in'
+        params['fill_ids'] = fill_id
+    else:
+        fills_shape = 'eq'
+        params['fill_id'] = fill_id
+    if isinstance(aggregations_id, int):
+        aggregations_shape = 'eq'
+        params['aggregations_id'] = aggregations_id
+    elif isinstance(aggregations_id, list):
+        aggregations_shape = 'in'
+        params['aggregations_ids'] = aggregations_id
+    elif isinstance(aggregations_id, dict):
+        aggregations_shape = []
+        for prop_pos, (prop_id, val) in enumerate(aggregations_id.items()):
+            if val == 'all':
+                continue
+            predicate = val if isinstance(val, AggregationPredicate) else AggregationPredicate('eq', (val,))
+            params.update({f'agg_{prop_pos}_value_{value_i}': value for value_i, value in enumerate(predicate.values)})
+            aggregations_shape.append((prop_pos, prop_id, predicate.op, len(predicate.values)))
+        aggregations_shape = tuple(aggregations_shape)
+    else:
+        aggregations_shape = None
+
+    if ranking is not None:
+        ranking_shape = (ranking.sort, ranking.limit is not None, ranking.offset > 0)
+        params.update({'limit': ranking.limit, 'offset': ranking.offset})
+    else:
+        ranking_shape = None
+
+    if bucket_width is not None:
+        if ranking is not None:
+            raise ValueError('bucketed data points cannot be ranked')
+        bucket_shape = (bucket_width, tuple(prop_pos for prop_pos, prop in enumerate(properties_id.properties)
+                                            if prop in YEAR_PROPERTIES))
+    else:
+        bucket_shape = None
+
+    statement_shape = (len(properties_id.properties), aggregations_shape, ranking_shape, fills_shape, bucket_shape)
+    metrics_statement = _metrics_statements.get(statement_shape)
+    if metrics_statement is None:
+        metrics_statement = make_metrics_statement(*statement_shape)
+        _metrics_statements[statement_shape] = metrics_statement
+    return metrics_statement, params
+
+
+def make_metrics_statement(properties_len, aggregations_shape, ranking_shape=None, fills_shape='eq',
+                           bucket_shape=None):
+    """
+    build the statement for one shape of metrics request
 
     Expands the metrics row from json aggregations.aggregations list
      --> from
@@ -186,131 +261,303 @@ def get_metrics(session, fill_id, population_id, properties_id, aggregations_id,
 
     This can be done by writing a dynamics query, based on the fact that we know how many properties
     are being queried by the api user. For instance.
-    The reason this transform is necessary here is to facilitate labelling the aggregation values
-    using sql joins. That is also tricky because some aggegration values are site-links, and some are
-    qids.
+    Only ids come back, the aggregation values are labelled in python from the label_store,
+    which is also tricky because some aggegration values are site-links, and some are qids.
 
     This jiujitsu may be deprecated if we store the aggregations noramlized rather than as json list.
     The problem I was having there was the hetergenous types of the aggregations (sitelinks, str) (qids, int)
-    :param session:
-    :param fill_id:
-    :param population_id:
-    :param properties_id:
-    :param aggregations_id: a specificed aggregations id, or None
-    :param label_lang: if not None then label
-    :return:
+    :param properties_len: how many properties are aggregated over
+    :param aggregations_shape: see build_metrics_statement
+    :param ranking_shape: (sort, has limit, has offset) to only select one page of ranked data points, see
+     make_ranked_aggregations, or None for all of them
+    :param fills_shape: 'eq' for one fill, or 'in' for a list of them, whose rows are then ordered by fill within
+     each data point
+    :param bucket_shape: (bucket width, positions of the year properties) to group the years of those properties
+     into buckets, with the totals of the years in each bucket summed, or None for every year
+    :return: a select, ordered by the aggregation values, or by rank and then the aggregation values
     """
-    prop_id = properties_id.id
-    properties = properties_id.properties
-    property_query_cols = generate_json_expansion_values(properties)
+    property_query_cols = generate_json_expansion_values(range(properties_len))
+    if bucket_shape is not None:
+        bucket_width, bucket_positions = bucket_shape
+        for prop_pos in bucket_positions:
+            agg_col_i = prop_pos * 2 + 1
+            property_query_cols[agg_col_i] = year_bucket(property_query_cols[agg_col_i].element, bucket_width) \
+                .label(f'agg_{prop_pos}')
+
+    total_col = metric.total if bucket_shape is None else cast(func.sum(metric.total), Integer).label('total')
+    query_cols = [*property_query_cols, metric.bias_value, total_col]
+    if fills_shape == 'in':
+        query_cols.append(metric.fill_id)
+
+    metrics_q = Query(query_cols) \
+        .join(metric_properties_j, metric.properties_id == metric_properties_j.id) \
+        .join(metric_aggregations_j, metric.aggregations_id == metric_aggregations_j.id) \
+        .filter(metric.properties_id == bindparam('properties_id')) \
+        .filter(metric.population_id == bindparam('population_id'))
+    if fills_shape == 'in':
+        metrics_q = metrics_q.filter(metric.fill_id.in_(bindparam('fill_ids', expanding=True)))
+    else:
+        metrics_q = metrics_q.filter(metric.fill_id == bindparam('fill_id'))
+    metrics_q = filter_aggregations(metrics_q, aggregations_shape)
+    if bucket_shape is not None:
+        group_by_cols = [*property_query_cols, metric.bias_value]
+        if fills_shape == 'in':
+            group_by_cols.append(metric.fill_id)
+        metrics_q = metrics_q.group_by(*group_by_cols)
+
+    # rows sharing aggregation values have to be contiguous for build_gap_response to group them in one pass,
+    # a data point's rank is the same on each of its rows so they still are when ranked
+    agg_order_cols = [col for col in property_query_cols if col.name.startswith('agg')]
+    if fills_shape == 'in':
+        metrics_q = metrics_q.order_by(*agg_order_cols, metric.fill_id)
+    elif ranking_shape is None:
+        metrics_q = metrics_q.order_by(*agg_order_cols)
+    else:
+        ranked_aggregations = make_ranked_aggregations(properties_len, aggregations_shape, *ranking_shape)
+        metrics_q = metrics_q.join(ranked_aggregations,
+                                   metric.aggregations_id == ranked_aggregations.c.aggregations_id) \
+            .order_by(desc(ranked_aggregations.c.sort_value), *agg_order_cols)
+    return metrics_q.statement
 
-    query_cols = [*property_query_cols, metric.bias_value, metric.total]
 
-    metrics_q = session.query(*query_cols) \
-        .join(metric_properties_j, metric.properties_id == metric_properties_j.id) \
+def year_bucket(year_col, bucket_width):
+    """the first year of the bucket of year_col, as a string like every other aggregation value"""
+    # the width is one of a few, so it is part of the statement rather than a parameter,
+    # and the 1.0 keeps the division from being an integer one, which would round negative years the wrong way
+    width_col = literal_column(str(int(bucket_width)))
+    return cast(cast(func.floor(year_col * literal_column('1.0') / width_col), Integer) * width_col, String)
+
+
+def filter_aggregations(metrics_q, aggregations_shape):
+    """
+    :param metrics_q: a query of the metric table
+    :param aggregations_shape: see build_metrics_statement
+    :return: metrics_q only for the aggregations of the shape, with their values as bind parameters
+    """
+    if aggregations_shape == 'eq':
+        metrics_q = metrics_q.filter(metric.aggregations_id == bindparam('aggregations_id'))
+    elif aggregations_shape == 'in':
+        metrics_q = metrics_q.filter(metric.aggregations_id.in_(bindparam('aggregations_ids', expanding=True)))
+    elif aggregations_shape:
+        for prop_pos, prop_id, predicate_op, predicate_len in aggregations_shape:
+            prop_pos_after_bias = prop_pos + 1
+            a_man = aliased(metric_aggregations_n)
+            bind_names = [f'agg_{prop_pos}_value_{value_i}' for value_i in range(predicate_len)]
+            val_predicate = AggregationPredicate(predicate_op, (None,) * predicate_len)(a_man.value,
+                                                                                        bind_names=bind_names)
+            metrics_q = metrics_q.join(a_man, and_(metric.aggregations_id == a_man.id,
+                                                   a_man.aggregation_order == prop_pos_after_bias,
+                                                   a_man.property == prop_id,
+                                                   val_predicate))
+    return metrics_q
+
+
+def make_ranked_aggregations(properties_len, aggregations_shape, sort, has_limit, has_offset):
+    """
+    the derived table of the aggregations ids of one page of data points, with the value they are ranked by.
+    the metrics are joined to it, rather than filtered with an IN subquery, because mysql has no LIMIT in those.
+    the ranking happens on the metric rows alone, before anything is grouped in python or labelled.
+    data points with the same sort value are ranked by their aggregation values, like rank_metric_rows ranks them,
+    so a page is the same whichever engine answers it.
+    :param sort: one of utils.GAP_SORTS
+    :return: a subquery of (aggregations_id, sort_value)
+    """
+    group_total = func.sum(metric.total)
+    # the 1.0 keeps the division from being an integer one
+    sort_value = group_total if sort == 'total' else func.max(metric.total) * 1.0 / group_total
+    # every row of an aggregations_id has the same aggregation values, min() only picks them out of the group
+    agg_values = [func.min(agg_col.element) for agg_col in generate_json_expansion_values(range(properties_len))[1::2]]
+    ranked_q = Query([metric.aggregations_id, sort_value.label('sort_value')]) \
         .join(metric_aggregations_j, metric.aggregations_id == metric_aggregations_j.id) \
-        .filter(metric.properties_id == prop_id) \
-        .filter(metric.fill_id == fill_id) \
-        .filter(metric.population_id == population_id) \
-        .order_by(metric.aggregations_id)
-    if isinstance(aggregations_id, int):
-        metrics_q = metrics_q.filter(metric.aggregations_id == aggregations_id)
-    if isinstance(aggregations_id, list):
-        metrics_q = metrics_q.filter(metric.aggregations_id.in_(aggregations_id))
-    if isinstance(aggregations_id, dict):
-        for prop_pos, (prop_id, val) in enumerate(aggregations_id.items()):
-            if val == 'all':
-                continue
-            else:
-                prop_pos_after_bias = prop_pos + 1
-                a_man = aliased(metric_aggregations_n)
-                val_predicate = val(a_man.value) if callable(val) else a_man.value == val
-                metrics_q = metrics_q.join(a_man, and_(metric.aggregations_id == a_man.id,
-                                                       a_man.aggregation_order == prop_pos_after_bias,
-                                                       a_man.property == prop_id,
-                                                       val_predicate))
-
-    # if a label_lang is defined we need to make a subquery
-    if label_lang is not None:
-        metrics_subq = metrics_q.subquery('metrics_driver')
-        metrics_q = label_metric_query(session, metrics_subq, properties, label_lang)
-
-    log.debug(f'metrics_q is:'
-              f' {metrics_q.statement.compile(compile_kwargs={"literal_binds": True})}')
-    metrics = metrics_q.all()
-    metrics_columns = metrics_q.column_descriptions
-    log.debug(f'Number of metrics to return are {len(metrics)}')
-    return metrics, metrics_columns
+        .filter(metric.properties_id == bindparam('properties_id')) \
+        .filter(metric.fill_id == bindparam('fill_id')) \
+        .filter(metric.population_id == bindparam('population_id'))
+    ranked_q = filter_aggregations(ranked_q, aggregations_shape) \
+        .group_by(metric.aggregations_id) \
+        .order_by(desc('sort_value'), *agg_values)
+    if has_limit:
+        ranked_q = ranked_q.limit(bindparam('limit'))
+    if has_offset:
+        ranked_q = ranked_q.offset(bindparam('offset'))
+    return ranked_q.subquery('ranked_aggregations')
+
+
+def rank_metric_rows(metrics_rows, columns, ranking):
+    """
+    the ranking of make_ranked_aggregations, for the metrics engines that already hold every row in memory
+    :param metrics_rows: rows ordered by their aggregation values, like get_metrics returns
+    :param ranking: a utils.GapRanking, or None to leave the rows as they are
+    :return: the rows of one page of ranked data points, each data point's rows still contiguous
+    """
+    if ranking is None:
+        return metrics_rows
+    col_names = [col['name'] for col in columns]
+    aggr_idxs = [i for i, name in enumerate(col_names) if name.startswith('agg')]
+    total_idx = col_names.index('total')
+    groups = [list(group_rows) for _, group_rows in
+              itertools.groupby(metrics_rows, key=lambda row: tuple(row[i] for i in aggr_idxs))]
 
+    def sort_value(group_rows):
+        group_total = sum(row[total_idx] for row in group_rows)
+        if ranking.sort == 'total':
+            return group_total
+        return max(row[total_idx] for row in group_rows) / group_total if group_total else 0
 
-def build_gap_response(properties_id, metrics_res, columns, label_lang, session):
+    # a stable sort, ties stay in the order of their aggregation values, as make_ranked_aggregations breaks them
+    ranked_groups = sorted(groups, key=sort_value, reverse=True)
+    page_stop = ranking.offset + ranking.limit if ranking.limit is not None else None
+    return [row for group_rows in ranked_groups[ranking.offset:page_stop] for row in group_rows]
+
+
+def build_gap_response(properties_id, metrics_res, columns, label_lang, session, stage_timer=None):
     """
     transforms a metrics response into a json-able serialization
     see https://docs.google.com/document/d/1tdm1Xixy-eUvZkCc02kqQre-VTxzUebsComFYefS5co/edit#heading=h.a8xg7ij7tuqm
     :param label_lang:
     :param metrics:
+    :param stage_timer: an optional instrumentation.StageTimer to record the labels and grouping stages in
     :return: response dict
     """
-    prop_names = [utils.Properties(p).name.lower() for p in properties_id.properties]
-    is_citizenship = is_property_exclusively_citizenship(properties_id)
-    iso_codes = get_iso_codes_as_lookup_table(session) if is_citizenship else None
-    col_names = [col['name'] for col in columns]
-    aggr_cols = [col['name'] for col in columns if col['name'].startswith('agg')]
-    label_cols = [col['name'] for col in columns if col['name'].startswith('label')]
-    # use pandas to group by all dimensions except gender
-    metric_df = pd.DataFrame.from_records(metrics_res, columns=col_names)
-    metric_df.to_dict()
-    pandas_groupby_start = time.time()
-    agg_groups = metric_df.groupby(by=aggr_cols) if aggr_cols else [('global', metric_df)]
-    pandas_groupby_end = time.time()
-    # accumulator pattern
-    data_points = []
-    for group_i, (group_name, group) in enumerate(agg_groups):
-        group_name_as_list = group_name if isinstance(group_name, tuple) else [group_name]
-        item_d = dict(zip(prop_names, group_name_as_list))
-        values = dict(group[['bias_value', 'total']].to_dict('split')['data'])
-        labels_prop_order = group[label_cols].iloc[0].values if label_cols else []
-        item_labels = dict(zip(prop_names, labels_prop_order))
-        if is_citizenship:
-            try:
-                item_labels['iso_3166'] = iso_codes[group_name]
-            except KeyError as ke:
-                # log.debug(f'iso code exception: {ke}')
-                pass
-        data_point = {'order': group_i,
-                      'item': item_d,
-                      'item_label': item_labels,
-                      "values": values}
-        # including this just once in the meta portion for now.
-        # if label_lang:
-        #     labels = dict(group[['bias_value', 'bias_label']].to_dict('split')['data'])
-        #     data_point['labels'] = labels
-        data_points.append(data_point)
-    pandas_group_iteration_end = time.time()
-    log.debug(f'pandas groupby took {pandas_groupby_end - pandas_groupby_start} seconds')
-    log.debug(f'pandas group iteration took {pandas_group_iteration_end - pandas_groupby_end} seconds')
-
-    represented_biases = make_represented_genders(metric_df, label_lang) if label_lang else None
+    with timed(stage_timer, 'labels'):
+        is_citizenship = is_property_exclusively_citizenship(properties_id)
+        iso_codes = reference_data.get_iso_codes(session) if is_citizenship else None
+        labels = label_store.for_lang(session, label_lang) if label_lang else None
+    represented_biases = {} if label_lang else None
+    grouping_start = time.time()
+    with timed(stage_timer, 'grouping'):
+        data_points = list(iter_gap_data_points(properties_id, metrics_res, columns, iso_codes=iso_codes,
+                                                labels=labels, represented_biases=represented_biases))
+    grouping_end = time.time()
+    if stage_timer is not None:
+        stage_timer.count_rows('metric_rows', len(metrics_res))
+        stage_timer.count_rows('data_points', len(data_points))
+    log.debug(f'grouping {len(data_points)} data points took {grouping_end - grouping_start} seconds')
 
     return data_points, represented_biases
 
 
-def make_represented_genders(metric_df, label_lang):
+def iter_gap_data_points(properties_id, metrics_rows, columns, iso_codes=None, labels=None, represented_biases=None):
     """
-    return a dict of the represented genders and  (maybe their label) to make life easy for the front end.
-    :return:
+    walks the metric rows once, yielding a data point as soon as the group of rows sharing its aggregation values ends.
+    this relies on get_metrics ordering rows by their aggregation values, so that every group is contiguous,
+    and the data points come out in the same order a sort-then-group would produce.
+    :param metrics_rows: any iterable of rows, so it can be a list or a streaming cursor
+    :param iso_codes: if not None, a {qid: iso_code} lookup to add to the item labels
+    :param labels: if not None, the LanguageLabels to label the items and biases with
+    :param represented_biases: if not None, a dict that is filled in with {bias_value: bias_label} as rows are seen
+    :return: generator of data point dicts
+    """
+    prop_names = [utils.Properties(p).name.lower() for p in properties_id.properties]
+    label_fns = [labels.label_fn_for_property(p) for p in properties_id.properties] if labels else []
+    col_names = [col['name'] for col in columns]
+    aggr_idxs = [i for i, name in enumerate(col_names) if name.startswith('agg')]
+    bias_value_idx = col_names.index('bias_value')
+    total_idx = col_names.index('total')
+
+    def make_data_point(group_i, group_name, values):
+        item_d = dict(zip(prop_names, group_name))
+        return {'order': group_i,
+                'item': item_d,
+                'item_label': make_item_labels(prop_names, label_fns, group_name, iso_codes),
+                "values": values}
+
+    # accumulator pattern, but only ever for the current group
+    group_i = 0
+    group_name = None
+    group_values = {}
+    for row in metrics_rows:
+        bias_value = row[bias_value_idx]
+        if represented_biases is not None and bias_value not in represented_biases:
+            represented_biases[bias_value] = labels.bias_label(bias_value) if labels else None
+        row_group_name = tuple(row[i] for i in aggr_idxs)
+        if None in row_group_name:
+            # rows without an aggregation value do not belong to any group
+            continue
+        if row_group_name != group_name:
+            if group_name is not None:
+                yield make_data_point(group_i, group_name, group_values)
+                group_i += 1
+            group_name = row_group_name
+            group_values = {}
+        group_values[bias_value] = row[total_idx]
+
+    if group_name is not None:
+        yield make_data_point(group_i, group_name, group_values)
+    elif not aggr_idxs:
+        # no aggregations were asked for, there is still always exactly one global data point
+        yield make_data_point(group_i, (), group_values)
+
+
+def make_item_labels(prop_names, label_fns, group_name, iso_codes):
+    """the labels of a data point's aggregation values, and its iso code if iso_codes are given"""
+    item_labels = {prop_name: label_fn(agg_value) for prop_name, label_fn, agg_value in
+                   zip(prop_names, label_fns, group_name)}
+    if iso_codes is not None:
+        try:
+            item_labels['iso_3166'] = iso_codes[group_name[0]]
+        except (KeyError, IndexError):
+            pass
+    return item_labels
+
+
+def build_evolution_metrics(session, fill_ids, population_id, properties_id, aggregations_id, label_lang,
+                            stage_timer=None):
+    """
+    the evolution counterpart of build_metrics, the metrics of every fill in one query, grouped in one pass
+    :param fill_ids: the fills of the series, in the order of the series
+    :return: (data points, represented_biases) see iter_evolution_data_points
     """
-    return dict(metric_df[['bias_value', 'bias_label']].drop_duplicates().to_dict('split')['data'])
+    with timed(stage_timer, 'sql'):
+        metrics, metrics_columns = get_metrics(session, fill_ids, population_id, properties_id, aggregations_id,
+                                               stage_timer=stage_timer)
+    with timed(stage_timer, 'labels'):
+        iso_codes = reference_data.get_iso_codes(session) if is_property_exclusively_citizenship(properties_id) \
+            else None
+        labels = label_store.for_lang(session, label_lang) if label_lang else None
+    represented_biases = {} if label_lang else None
+    with timed(stage_timer, 'grouping'):
+        data_points = list(iter_evolution_data_points(properties_id, metrics, metrics_columns, fill_ids,
+                                                      iso_codes=iso_codes, labels=labels,
+                                                      represented_biases=represented_biases))
+    if stage_timer is not None:
+        stage_timer.count_rows('metric_rows', len(metrics))
+        stage_timer.count_rows('data_points', len(data_points))
+    return data_points, represented_biases
 
 
-def get_iso_codes_as_lookup_table(session, iso_subtype='iso_3166_1'):
+def iter_evolution_data_points(properties_id, metrics_rows, columns, fill_ids, iso_codes=None, labels=None,
+                               represented_biases=None):
     """
-    :return: a dict mapping qids to iso_3166_1
+    like iter_gap_data_points, but the rows of many fills become one data point per item,
+    whose values are a series per bias value, aligned with fill_ids and None where a fill has no such humans
+    {'order': 0, 'item': {...}, 'item_label': {...}, 'values': {bias_value: [total in fill_ids[0], ...]}}
+    this relies on the rows being ordered by aggregation values, see make_metrics_statement.
     """
-    iso_codes = session.query(label_misc.src, label_misc.label).filter(label_misc.lang == iso_subtype).all()
-    iso_codes_df = pd.DataFrame.from_records(iso_codes)
-    iso_codes_dict = iso_codes_df.to_dict('split')['data']
-    return dict(iso_codes_dict)
+    prop_names = [utils.Properties(p).name.lower() for p in properties_id.properties]
+    label_fns = [labels.label_fn_for_property(p) for p in properties_id.properties] if labels else []
+    col_names = [col['name'] for col in columns]
+    aggr_idxs = [i for i, name in enumerate(col_names) if name.startswith('agg')]
+    bias_value_idx = col_names.index('bias_value')
+    total_idx = col_names.index('total')
+    fill_id_idx = col_names.index('fill_id')
+    fill_positions = {fill_id: position for position, fill_id in enumerate(fill_ids)}
+
+    group_i = 0
+    for group_name, group_rows in itertools.groupby(metrics_rows, key=lambda row: tuple(row[i] for i in aggr_idxs)):
+        series = {}
+        for row in group_rows:
+            bias_value = row[bias_value_idx]
+            if represented_biases is not None and bias_value not in represented_biases:
+                represented_biases[bias_value] = labels.bias_label(bias_value) if labels else None
+            series.setdefault(bias_value, [None] * len(fill_ids))[fill_positions[row[fill_id_idx]]] = row[total_idx]
+        if None in group_name:
+            # rows without an aggregation value do not belong to any group
+            continue
+        yield {'order': group_i,
+               'item': dict(zip(prop_names, group_name)),
+               'item_label': make_item_labels(prop_names, label_fns, group_name, iso_codes),
+               'values': series}
+        group_i += 1
 
 
 def get_metrics_count(session):
@@ -325,32 +572,72 @@ def get_all_snapshot_dates(session):
 
 
 def get_coverage(session, population_id, properties_id, fill_id):
-    ## TODO, use sqlalchemy parameters not f-strings to sanitize inputs
-    metric_coverage_sql = text(f""" select n.total_with_properties / d.total_with_properties as coverage
-                                from
-                            (select
-                                   total_with_properties,
-                                   'n' as nd,
-                                    'k' as k
-                            from metric_coverage
-                            where fill_id={fill_id} and properties_id={properties_id} and population_id={population_id}) n
-                            join
-                            (select
-                                   total_with_properties,
-                                   'd' as nd,
-                                  'k' as k
-                            from metric_coverage
-                            where fill_id={fill_id}
-                              -- i really hope the fact holds that this is the numerator we want.
-                              and properties_id=(select id
-                                                from metric_properties_j
-                                                where properties_len=0)
-                              and population_id={population_id}) d
-                            on n.k = d.k
-                              """)
-    coverage_decimal = session.execute(metric_coverage_sql).scalar()
-    try:
-        coverage = float(coverage_decimal)
-    except TypeError:
-        coverage = None
-    return coverage
+    coverage_table = get_coverage_table(session, fill_id=fill_id, population_id=population_id)
+    return coverage_table[properties_id]['coverage'] if properties_id in coverage_table else None
+
+
+def get_coverage_series(session, fill_ids, population_id, properties_id):
+    """
+    the coverage of one properties combination in each of fill_ids, from one query rather than a coverage table per fill
+    :return: [coverage or None, for each of fill_ids]
+    """
+    coverage_rows = session.query(metric_coverage.fill_id, metric_coverage.properties_id,
+                                  metric_coverage.total_with_properties, metric_properties_j.properties_len) \
+        .join(metric_properties_j, metric_coverage.properties_id == metric_properties_j.id) \
+        .filter(metric_coverage.fill_id.in_(fill_ids)) \
+        .filter(metric_coverage.population_id == population_id) \
+        .filter(or_(metric_coverage.properties_id == properties_id, metric_properties_j.properties_len == 0)) \
+        .all()
+    numerators, denominators = {}, {}
+    for fill_id, row_properties_id, total_with_properties, properties_len in coverage_rows:
+        if properties_len == 0:
+            denominators[fill_id] = total_with_properties
+        if row_properties_id == properties_id:
+            numerators[fill_id] = total_with_properties
+    coverages = []
+    for fill_id in fill_ids:
+        try:
+            coverages.append(round(float(numerators[fill_id]) / float(denominators[fill_id]), 4))
+        except (KeyError, TypeError, ZeroDivisionError):
+            coverages.append(None)
+    return coverages
+
+
+def get_coverage_table(session, fill_id, population_id):
+    """
+    the coverage of every properties combination of a fill and population, loaded in one query and then kept,
+    since it never changes. coverage is the number of humans having the properties, divided by all the humans,
+    recall the properties combination with properties_len=0 is all the humans.
+    :return: {properties_id: {'properties': [...], 'coverage': float or None}}
+    """
+    table_key = (fill_id, population_id)
+    with _coverage_tables_lock:
+        if table_key in _coverage_tables:
+            _coverage_tables.move_to_end(table_key)
+            return _coverage_tables[table_key]
+
+    coverage_rows = session.query(metric_coverage.properties_id, metric_coverage.total_with_properties,
+                                  metric_properties_j.properties, metric_properties_j.properties_len) \
+        .join(metric_properties_j, metric_coverage.properties_id == metric_properties_j.id) \
+        .filter(metric_coverage.fill_id == fill_id) \
+        .filter(metric_coverage.population_id == population_id) \
+        .all()
+    denominators = [total for (_, total, _, properties_len) in coverage_rows if properties_len == 0]
+    denominator = denominators[0] if denominators else None
+    coverage_table = {}
+    for properties_id, total_with_properties, properties, _ in coverage_rows:
+        try:
+            # mysql used to do this division, keep its 4 decimal places
+            coverage = round(float(total_with_properties) / float(denominator), 4)
+        except (TypeError, ZeroDivisionError):
+            coverage = None
+        coverage_table[properties_id] = {'properties': properties, 'coverage': coverage}
+    if not coverage_table:
+        # nothing computed for this fill and population (yet), look again next time
+        return coverage_table
+
+    with _coverage_tables_lock:
+        _coverage_tables[table_key] = coverage_table
+        while len(_coverage_tables) > COVERAGE_MAX_TABLES:
+            _coverage_tables.popitem(last=False)
+    return coverage_table
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import literal
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.elements import BindParameter, ClauseList, Grouping
+from sqlalchemy.sql.visitors import replacement_traverse
+from sqlalchemy.types import NullType
+
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# queries slower than this are kept, with their parameters and the request's stage timings
+SLOW_QUERY_SECONDS = float(os.environ.get('HUMANIKI_SLOW_QUERY_SECONDS', 1.0))
+SLOW_QUERY_MAX_ENTRIES = 100
+# also run EXPLAIN on a slow query, this is one more round trip, but only for the slow ones
+SLOW_QUERY_EXPLAIN = os.environ.get('HUMANIKI_SLOW_QUERY_EXPLAIN', '').lower() in ('1', 'true', 'yes')
+
+
+class LazySQL(object):
+    """
+    A query or statement that only renders as sql, with its values inlined, when it is formatted.
+    Pass it as a logging argument, log.debug('%s', LazySQL(q)), and nothing is compiled unless debug is on.
+    :param params: values for the statement's bind parameters
+    :param dialect: the dialect to render for, the default one otherwise
+    """
+
+    def __init__(self, statement, params=None, dialect=None):
+        self.statement = statement
+        self.params = params
+        self.dialect = dialect
+
+    def __str__(self):
+        statement = getattr(self.statement, 'statement', self.statement)  # a query's select
+        if self.params:
+            statement = inline_params(statement, self.params).params(self.params)
+        return str(statement.compile(dialect=self.dialect, compile_kwargs={"literal_binds": True}))
+
+
+def inline_params(statement, params):
+    """
+    replace the bind parameters of statement that literal_binds cannot render with their values in params.
+    it would otherwise render expanding ones, like IN (:fill_ids), as the python list itself, IN [1, 2], which is
+    not sql, and untyped ones, like LIMIT :limit, as NULL
+    """
+    def inline_param(element):
+        if not isinstance(element, BindParameter) or element.key not in params:
+            return None
+        if element.expanding:
+            return Grouping(ClauseList(*[literal(value) for value in params[element.key]]))
+        if isinstance(element.type, NullType):
+            return literal(params[element.key])
+        return None
+
+    return replacement_traverse(statement, {}, inline_param)
+
+
+class SlowQueryLog(object):
+    """
+    The last max_entries queries that took at least threshold_seconds, newest last.
+    Each entry keeps the statement, its bind parameters, the row count, the stage timings of the request
+    that ran it and, if explain, the EXPLAIN output.
+    """
+
+    def __init__(self, threshold_seconds=SLOW_QUERY_SECONDS, max_entries=SLOW_QUERY_MAX_ENTRIES,
+                 explain=SLOW_QUERY_EXPLAIN):
+        self.threshold_seconds = threshold_seconds
+        self.explain = explain
+        self._entries = deque(maxlen=max_entries)
+        self._lock = threading.Lock()
+
+    def observe(self, session, statement, seconds, row_count, params=None, stage_timer=None):
+        """
+        record statement if it was slow, this is all a fast query pays
+        :param statement: a query or statement
+        :param params: the values bound to the statement's parameters
+        """
+        if seconds < self.threshold_seconds:
+            return
+        statement = getattr(statement, 'statement', statement)
+        compiled = statement.compile(dialect=session.get_bind().dialect)
+        bound_params = dict(compiled.params, **(params or {}))
+        entry = {'recorded_at': time.time(),
+                 'seconds': seconds,
+                 'row_count': row_count,
+                 'statement': str(compiled),
+                 'params': {param: str(val) for param, val in bound_params.items()},
+                 # the request is still running, its timings are only read once it has finished with them
+                 'stage_timer': stage_timer,
+                 'explain': self.run_explain(session, statement, params) if self.explain else None}
+        log.warning(f'slow query, {"%.3f" % seconds} seconds for {row_count} rows')
+        with self._lock:
+            self._entries.append(entry)
+
+    @staticmethod
+    def run_explain(session, statement, params):
+        try:
+            explain_sql = f'EXPLAIN {LazySQL(statement, params, dialect=session.get_bind().dialect)}'
+            explain_res = session.connection().execute(explain_sql)
+            return [{key: val if isinstance(val, (int, float, str, type(None))) else str(val)
+                     for key, val in zip(explain_res.keys(), row)} for row in explain_res]
+        except (SQLAlchemyError, NotImplementedError, TypeError) as e:
+            # including the values sqlalchemy cannot render inline
+            return repr(e)
+
+    def entries(self):
+        with self._lock:
+            entries = list(self._entries)
+        return [dict({key: val for key, val in entry.items() if key != 'stage_timer'},
+                     stage_timings=entry['stage_timer'].finished_durations if entry['stage_timer'] else None)
+                for entry in entries]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,83 @@
+import itertools
+import time
+
+from humaniki_backend.labels import label_store
+from humaniki_schema.queries import get_properties_obj, get_project_internal_id_from_wikiencoding
+from humaniki_schema.schema import label_misc
+from humaniki_schema.utils import Properties
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+# what warm_up preloads, every single and pair combination of these is a standard dashboard query
+WARM_UP_BIAS_PROPERTIES = [Properties.GENDER]
+WARM_UP_AGGREGATION_PROPERTIES = [Properties.PROJECT, Properties.CITIZENSHIP, Properties.OCCUPATION,
+                                  Properties.DATE_OF_BIRTH, Properties.DATE_OF_DEATH]
+WARM_UP_LABEL_LANGS = ['en']
+
+
+def get_iso_codes_as_lookup_table(session, iso_subtype='iso_3166_1'):
+    """
+    :return: a dict mapping qids to iso_3166_1
+    """
+    iso_codes = session.query(label_misc.src, label_misc.label).filter(label_misc.lang == iso_subtype).all()
+    return dict(iso_codes)
+
+
+class ReferenceData(object):
+    """
+    The lookups every request needs, but whose data is static: properties objects, project internal ids and iso codes.
+    Each is loaded on first use, or upfront by warm_up, and kept in a dict for the life of the process.
+    Only what was found is kept, lookups that find nothing are asked again next time.
+    """
+
+    def __init__(self):
+        self.properties_objs = {}
+        self.project_internal_ids = {}
+        self.iso_codes = {}
+
+    def get_properties_obj(self, session, dimension_properties, bias_property):
+        key = (tuple(dimension_properties), bias_property)
+        if key not in self.properties_objs:
+            properties_obj = get_properties_obj(session=session, dimension_properties=dimension_properties,
+                                                bias_property=bias_property)
+            if properties_obj is None:
+                return None
+            # detach it so it can outlive the session, its columns are already loaded
+            session.expunge(properties_obj)
+            self.properties_objs[key] = properties_obj
+        return self.properties_objs[key]
+
+    def get_project_internal_id(self, proj_code, session):
+        if proj_code not in self.project_internal_ids:
+            project_internal_id = get_project_internal_id_from_wikiencoding(proj_code, session)
+            if project_internal_id is None:
+                # misses are not kept, the project may be added by a later fill, and proj_code comes from the request
+                return None
+            self.project_internal_ids[proj_code] = project_internal_id
+        return self.project_internal_ids[proj_code]
+
+    def get_iso_codes(self, session, iso_subtype='iso_3166_1'):
+        if iso_subtype not in self.iso_codes:
+            self.iso_codes[iso_subtype] = get_iso_codes_as_lookup_table(session, iso_subtype)
+        return self.iso_codes[iso_subtype]
+
+    def warm_up(self, session):
+        """load everything the standard queries need, so that the first requests don't pay for it"""
+        warm_up_start = time.time()
+        self.get_iso_codes(session)
+        for bias_property in WARM_UP_BIAS_PROPERTIES:
+            for combination_len in (0, 1, 2):
+                for combination in itertools.combinations(WARM_UP_AGGREGATION_PROPERTIES, combination_len):
+                    dimension_properties = sorted(p.value for p in combination)
+                    try:
+                        self.get_properties_obj(session, dimension_properties, bias_property.value)
+                    except ValueError:
+                        # not every combination was computed
+                        continue
+        for label_lang in WARM_UP_LABEL_LANGS:
+            label_store.for_lang(session, label_lang)
+        log.info(f'warmed up {len(self.properties_objs)} properties in {"%.3f" % (time.time() - warm_up_start)} seconds')
+
+
+reference_data = ReferenceData()
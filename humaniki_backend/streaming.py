@@ -0,0 +1,78 @@
+from flask import json
+
+from humaniki_backend.formats import encode_default
+from humaniki_schema.log import get_logger
+
+log = get_logger(BASE_DIR=__file__)
+
+STREAM_MIMETYPES = {'ndjson': 'application/x-ndjson',
+                    'json': 'application/json'}
+# how many data points to encode before handing a chunk to the server
+STREAM_CHUNK_DATA_POINTS = 100
+
+
+def stream_gap_response(stream_format, meta, data_points, represented_biases):
+    """
+    :param stream_format: one of STREAM_MIMETYPES
+    :param data_points: a generator of data points, like from build_metrics_stream
+    :param represented_biases: None, or a dict that is complete once data_points is exhausted
+    :return: (generator of str chunks, mimetype)
+    """
+    if stream_format == 'ndjson':
+        chunks = stream_ndjson_gap(meta, data_points, represented_biases)
+    elif stream_format == 'json':
+        chunks = stream_json_gap(meta, data_points, represented_biases)
+    else:
+        raise ValueError(f'stream must be one of {list(STREAM_MIMETYPES)}, not {stream_format}')
+    return chunks, STREAM_MIMETYPES[stream_format]
+
+
+def chunk_data_points(data_points):
+    """group the encoded data points, so that we are not flushing a tiny write per data point"""
+    chunk = []
+    for data_point in data_points:
+        chunk.append(json.dumps(data_point, default=encode_default))
+        if len(chunk) >= STREAM_CHUNK_DATA_POINTS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_ndjson_gap(meta, data_points, represented_biases):
+    """
+    one json document per line. first {"meta": ...}, then one line per data point,
+    and last {"bias_labels": ...} if labels were asked for, since those are only known after the last row.
+    an error after the first line has gone out is reported as a final {"errors": ...} line.
+    """
+    yield json.dumps({'meta': meta}) + '\n'
+    try:
+        for chunk in chunk_data_points(data_points):
+            yield '\n'.join(chunk) + '\n'
+    except Exception as e:
+        log.exception('error while streaming gap response')
+        yield json.dumps({'errors': {'metrics': repr(e)}}) + '\n'
+        return
+    if represented_biases is not None:
+        yield json.dumps({'bias_labels': represented_biases}) + '\n'
+
+
+def stream_json_gap(meta, data_points, represented_biases):
+    """
+    the same document as the non-streamed response, except that bias_labels is a top-level key after the metrics
+    rather than in the meta. an error after the first chunk has gone out is reported as a top-level "errors" key.
+    """
+    yield '{"meta": ' + json.dumps(meta) + ', "metrics": ['
+    separator = ''
+    try:
+        for chunk in chunk_data_points(data_points):
+            yield separator + ', '.join(chunk)
+            separator = ', '
+    except Exception as e:
+        log.exception('error while streaming gap response')
+        yield '], "errors": ' + json.dumps({'metrics': repr(e)}) + '}'
+        return
+    yield ']'
+    if represented_biases is not None:
+        yield ', "bias_labels": ' + json.dumps(represented_biases)
+    yield '}'
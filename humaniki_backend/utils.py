@@ -1,13 +1,25 @@
+import hmac
+import os
+from collections import namedtuple
 from datetime import datetime
 
-from sqlalchemy import and_
+from sqlalchemy import and_, bindparam
 
-from humaniki_schema.queries import get_exact_fill_id, get_project_internal_id_from_wikiencoding
+from humaniki_backend.reference import reference_data
+from humaniki_schema.queries import get_exact_fill_id
 from humaniki_schema import utils
 from humaniki_schema.schema import metric_properties_j, metric_properties_n, metric_aggregations_n
 from humaniki_schema.utils import Properties, make_fill_dt, HUMANIKI_SNAPSHOT_DATE_FMT
 
 DATE_RANGE_SEPERATOR = '~'
+# admin routes are disabled unless this environment variable holds a token, which is sent in ADMIN_TOKEN_HEADER
+ADMIN_TOKEN_ENV_VAR = 'HUMANIKI_ADMIN_TOKEN'
+ADMIN_TOKEN_HEADER = 'X-Humaniki-Admin-Token'
+# what gap data points can be ranked by, see GapRanking
+GAP_SORTS = ['total', 'gap_ratio']
+# the properties whose aggregation values are years, and the named widths, in years, they can be bucketed by
+YEAR_PROPERTIES = [Properties.DATE_OF_BIRTH.value, Properties.DATE_OF_DEATH.value]
+YEAR_BUCKET_WIDTHS = {'decade': 10, 'century': 100}
 
 
 def get_pid_from_str(property_str):
@@ -74,11 +86,12 @@ def determine_population_conflict(population, query_params):
         return pop.value, pop.name, was_corrected
 
 
-def determine_fill_id(session, snapshot, latest_fill_id, latest_fill_dt):
+def determine_fill_id(session, snapshot, latest_fill_id, latest_fill_dt, exact_fill_id_fn=get_exact_fill_id):
     """
     figure out the fill id, given a string "latest" or a date in HUMANIKI_SNAPSHOT_DATE_FMT
     :param snapshot:
     :param latest_fill_id:
+    :param exact_fill_id_fn: how to look up a dated snapshot, like FillRegistry.get_exact_fill_id
     :return:
     """
     was_corrected = False
@@ -89,7 +102,7 @@ def determine_fill_id(session, snapshot, latest_fill_id, latest_fill_dt):
             exact_fill_dt = make_fill_dt(snapshot)
         except ValueError as ve:
             raise ValueError(f'snapshot needs to be in {HUMANIKI_SNAPSHOT_DATE_FMT}, not {ve}')
-        fill_id, fill_date = get_exact_fill_id(session, exact_fill_dt)
+        fill_id, fill_date = exact_fill_id_fn(session, exact_fill_dt)
         if fill_id:
             return fill_id, fill_date, was_corrected
         else:
@@ -99,6 +112,13 @@ def determine_fill_id(session, snapshot, latest_fill_id, latest_fill_dt):
             # return corrected_fill_id, corrected_fill_date, was_corrected
 
 
+def is_admin_request(request):
+    admin_token = os.environ.get(ADMIN_TOKEN_ENV_VAR)
+    if not admin_token:
+        return False
+    return hmac.compare_digest(request.headers.get(ADMIN_TOKEN_HEADER, ''), admin_token)
+
+
 def is_property_exclusively_citizenship(properties_obj):
     if isinstance(properties_obj, metric_properties_j):
         return (properties_obj.properties_len == 1) and (
@@ -106,55 +126,168 @@ def is_property_exclusively_citizenship(properties_obj):
     elif isinstance(properties_obj, metric_properties_n):
         raise NotImplementedError
 
+class AggregationPredicate(namedtuple('AggregationPredicate', ['op', 'values'])):
+    """
+    A predicate on an aggregation value column, one of
+     eq (value), between (start, stop), gte (start), lte (stop)
+    kept as its operator and values rather than as a closure, so that every query with the same operators
+    can share one statement, with the values bound as parameters.
+    """
+
+    def __call__(self, agg_value, bind_names=None):
+        """
+        :param agg_value: the column to compare
+        :param bind_names: if given, the names of the bind parameters to compare against instead of the values
+        """
+        operands = [bindparam(bind_name) for bind_name in bind_names] if bind_names else list(self.values)
+        if self.op == 'eq':
+            return agg_value == operands[0]
+        elif self.op == 'between':
+            return and_(agg_value >= operands[0], agg_value <= operands[1])
+        elif self.op == 'gte':
+            return agg_value >= operands[0]
+        elif self.op == 'lte':
+            return agg_value <= operands[0]
+        raise ValueError(f'unknown aggregation predicate {self.op}')
+
+
+class GapRanking(namedtuple('GapRanking', ['sort', 'limit', 'offset'])):
+    """
+    Which page of a gap response's data points to return, ranked descending by sort, one of
+     total (all the humans of the data point), gap_ratio (the share of its largest bias value, most lopsided first)
+    limit is None for every data point after offset.
+    """
+
+
+def parse_gap_ranking(non_orderable_params):
+    """
+    :param non_orderable_params: from order_query_params
+    :return: a GapRanking if any of sort, limit or offset are given, otherwise None
+    """
+    if not any(param in non_orderable_params for param in ('sort', 'limit', 'offset')):
+        return None
+    sort = non_orderable_params.get('sort', 'total')
+    if sort not in GAP_SORTS:
+        raise ValueError(f'sort must be one of {GAP_SORTS}, not {sort}')
+    try:
+        limit = int(non_orderable_params['limit']) if 'limit' in non_orderable_params else None
+        offset = int(non_orderable_params.get('offset', 0))
+    except ValueError:
+        raise ValueError('limit and offset must be whole numbers')
+    if (limit is not None and limit < 1) or offset < 0:
+        # a page of nothing would still run the whole ranking query
+        raise ValueError('limit must be at least 1 and offset cannot be negative')
+    return GapRanking(sort, limit, offset)
+
+
 def get_transform_ordered_aggregation_qid_match(property):
     '''higher order function that returns function that returns aggregation_predicacte'''
     def transform_ordered_aggregation_qid_match(ordered_aggregations, db_session=None):
         target_qid = ordered_aggregations[getattr(property, 'value')]
-        def exact_fn(agg_value):
-            return agg_value == int(target_qid)
-        ordered_aggregations[getattr(property, 'value')] = exact_fn
+        ordered_aggregations[getattr(property, 'value')] = AggregationPredicate('eq', (int(target_qid),))
         return ordered_aggregations
     return transform_ordered_aggregation_qid_match
 
 def transform_ordered_aggregations_with_proj_internal_codes(ordered_aggregations, db_session):
     proj_code = ordered_aggregations[Properties.PROJECT.value]
-    internal_id = get_project_internal_id_from_wikiencoding(proj_code, db_session)
+    internal_id = reference_data.get_project_internal_id(proj_code, db_session)
     ordered_aggregations[Properties.PROJECT.value] = internal_id
     return ordered_aggregations
 
-def transform_ordered_aggregations_with_year_fns(ordered_aggregations, session=None):
+def parse_year_range(year_range_str):
     """
-    in the year elements of the aggregations, transform their query param into a sqlalchemy func
-    :param ordered_aggregations:
-    :return: dict, ordered aggregations
+    Expecting a string like "YYYY~YYYY" but either the left or the right half could be missing, or just "YYYY"
+    Validation occurs elsewhere
+    :return: (exact_year_str, start_year, stop_year) exact_year_str is None for ranges, the years are None if open
     """
-    # TODO, generalize to include DOD as well
-    agg_to_transform = Properties.DATE_OF_BIRTH.value
-    # transform string into range
-    year_range_str = ordered_aggregations[agg_to_transform]
-    # Expecting a string like "YYYY~YYYY" but either the left or the right half could be missing
-    # Validation occurs elsewhere
     year_range_str_split = year_range_str.split(DATE_RANGE_SEPERATOR)
     # are there two dates or one?
     if len(year_range_str_split) == 1:
-        def year_fn(agg_value):
-            return agg_value == year_range_str_split[0]
-    elif len(year_range_str_split) == 2:
-        start_year_str, stop_year_str = year_range_str_split
-        start_year, stop_year = int(start_year_str) if start_year_str else None, int(
-            stop_year_str) if stop_year_str else None
-        # transform range into funcs of an metric_aggregations_n.value column
-        if (start_year is not None) and (stop_year is not None):
-            # if they both exist combine them with and
-            def year_fn(agg_value):
-                return and_(agg_value >= start_year, agg_value <= stop_year)
-        elif start_year is not None:
-            # it must be the case that just the left or right exists
-            def year_fn(agg_value):
-                return agg_value >= start_year
+        return year_range_str_split[0], None, None
+    start_year_str, stop_year_str = year_range_str_split
+    start_year, stop_year = int(start_year_str) if start_year_str else None, int(
+        stop_year_str) if stop_year_str else None
+    return None, start_year, stop_year
+
+
+def parse_year_bucket(non_orderable_params, ordered_query_params):
+    """
+    :param non_orderable_params: from order_query_params, with bucket as one of YEAR_BUCKET_WIDTHS or a number of years
+    :return: the bucket width in years, or None if there is no bucket
+    """
+    if 'bucket' not in non_orderable_params:
+        return None
+    bucket_str = non_orderable_params['bucket']
+    try:
+        bucket_width = YEAR_BUCKET_WIDTHS[bucket_str] if bucket_str in YEAR_BUCKET_WIDTHS else int(bucket_str)
+    except ValueError:
+        raise ValueError(f'bucket must be one of {list(YEAR_BUCKET_WIDTHS)} or a number of years, not {bucket_str}')
+    if bucket_width < 1:
+        raise ValueError('bucket must be at least a year')
+    if not any(prop in YEAR_PROPERTIES for prop in ordered_query_params):
+        raise ValueError('bucket needs a date_of_birth or date_of_death property')
+    return bucket_width
+
+
+def parse_snapshot_range(snapshot_range_str):
+    """
+    Expecting "all", or a string like "YYYY-MM-DD~YYYY-MM-DD" where either half could be missing, or just "YYYY-MM-DD"
+    :return: (start_dt, stop_dt) both inclusive, and None if open
+    """
+    if snapshot_range_str.lower() == 'all':
+        return None, None
+    snapshot_range_split = snapshot_range_str.split(DATE_RANGE_SEPERATOR)
+    try:
+        if len(snapshot_range_split) == 1:
+            exact_dt = make_fill_dt(snapshot_range_split[0])
+            return exact_dt, exact_dt
+        start_str, stop_str = snapshot_range_split
+        return make_fill_dt(start_str) if start_str else None, make_fill_dt(stop_str) if stop_str else None
+    except ValueError:
+        raise ValueError(f'snapshot range needs to be "all" or dates in {HUMANIKI_SNAPSHOT_DATE_FMT} around a '
+                         f'"{DATE_RANGE_SEPERATOR}", not {snapshot_range_str}')
+
+
+def select_snapshots_in_range(available_snapshots, start_dt, stop_dt):
+    """
+    :param available_snapshots: the fill dicts of FillSnapshot.available_snapshots
+    :return: the fill dicts from start_dt to stop_dt, oldest first
+    """
+    snapshots_in_range = []
+    for snapshot in available_snapshots:
+        # only the date part of the fill's date counts
+        snapshot_dt = make_fill_dt(str(snapshot['date'])[:len('YYYY-MM-DD')])
+        if (start_dt is None or snapshot_dt >= start_dt) and (stop_dt is None or snapshot_dt <= stop_dt):
+            snapshots_in_range.append(snapshot)
+    return sorted(snapshots_in_range, key=lambda snapshot: str(snapshot['date']))
+
+
+def transform_ordered_aggregations_with_year_fns(ordered_aggregations, session=None):
+    """
+    in the year elements of the aggregations, date of birth and date of death,
+    transform their query param into an AggregationPredicate
+    :param ordered_aggregations:
+    :return: dict, ordered aggregations
+    """
+    for agg_to_transform in YEAR_PROPERTIES:
+        year_range_str = ordered_aggregations.get(agg_to_transform)
+        # not asked for, all of them, or already transformed for the other year property
+        if not isinstance(year_range_str, str) or year_range_str.lower() == 'all':
+            continue
+        # transform string into range
+        exact_year_str, start_year, stop_year = parse_year_range(year_range_str)
+        if exact_year_str is not None:
+            year_predicate = AggregationPredicate('eq', (exact_year_str,))
         else:
-            def year_fn(agg_value):
-                return agg_value <= stop_year
-    # overwrite value to sql funcs in ordered_aggregations
-    ordered_aggregations[agg_to_transform] = year_fn
+            # transform range into predicates on an metric_aggregations_n.value column
+            if (start_year is not None) and (stop_year is not None):
+                # if they both exist combine them with and
+                year_predicate = AggregationPredicate('between', (start_year, stop_year))
+            elif start_year is not None:
+                # it must be the case that just the left or right exists
+                year_predicate = AggregationPredicate('gte', (start_year,))
+            else:
+                year_predicate = AggregationPredicate('lte', (stop_year,))
+        # overwrite value to predicates in ordered_aggregations
+        ordered_aggregations[agg_to_transform] = year_predicate
     return ordered_aggregations
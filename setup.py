@@ -8,5 +8,10 @@ setup(
     license='',
     author='notconfusing',
     author_email='',
-    description=''
+    description='',
+    # each is imported only if installed, without it its feature is off
+    extras_require={
+        'formats': ['orjson', 'msgpack', 'pyarrow'],  # faster json, and the msgpack and arrow gap formats
+        'compression': ['brotli'],  # br compressed responses, next to gzip
+    }
 )
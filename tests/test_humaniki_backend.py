@@ -1,14 +1,22 @@
+import gzip
 import json
 import os
+import threading
 import time
+from decimal import Decimal
 
 import pytest
 from sqlalchemy import func
 
 from humaniki_schema import generate_example_data, db
-from humaniki_backend import app
-from humaniki_schema.schema import metric
-from humaniki_schema.utils import read_config_file
+from humaniki_backend import app, utils, columnar, query, materialize, prerender, labels, reference, querylog, \
+    formats, streaming, concurrency
+from humaniki_backend.admission import AdmissionControl, MetricRowCounts, Overloaded
+from humaniki_backend.cache import ResponseCache
+from humaniki_backend.instrumentation import StageTimer
+from humaniki_backend.concurrency import SingleFlight, FlightAborted
+from humaniki_schema.schema import metric, metric_properties_j
+from humaniki_schema.utils import read_config_file, PopulationDefinition, Properties
 from unittest import TestCase
 tc = TestCase()
 
@@ -164,3 +172,466 @@ def test_by_proj_all_dob_all_citizenship_all(client, test_jsons):
     actual_first_item = actual_data[0]
     expected_first_item = expected_data[0]
     tc.assertEqual(actual_first_item['values'], expected_first_item['values'])
+
+def test_gap_response_cached(client):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all&label_lang=en'
+    first_body = client.get(url).get_data()
+    cached_entries = len(app.gap_cache)
+    second_body = client.get(url).get_data()
+    assert first_body == second_body
+    assert len(app.gap_cache) == cached_entries > 0
+
+def test_response_cache_evicts_to_byte_budget():
+    response_cache = ResponseCache(max_bytes=10)
+    response_cache.put(('gender', 1, 1, False, (), None), b'12345')
+    response_cache.put(('gender', 1, 2, False, (), None), b'12345')
+    response_cache.get(('gender', 1, 1, False, (), None))
+    response_cache.put(('gender', 2, 1, False, (), None), b'12345')
+    assert response_cache.current_bytes == 10
+    assert response_cache.get(('gender', 1, 2, False, (), None)) is None
+    response_cache.drop_fill(1)
+    assert len(response_cache) == 1
+
+def test_label_store_evicts_to_byte_budget(monkeypatch):
+    fake_labels = lambda session, lang: labels.LanguageLabels(lang, qids={str(qid): lang for qid in range(100)},
+                                                              misc={}, bias={})
+    monkeypatch.setattr(labels, 'load_language_labels', fake_labels)
+    one_lang_bytes = fake_labels(None, 'en').nbytes
+    label_store = labels.LabelStore(max_bytes=2 * one_lang_bytes)
+    label_store.for_lang(None, 'en')
+    label_store.for_lang(None, 'fr')
+    label_store.for_lang(None, 'en')
+    label_store.for_lang(None, 'de')
+    assert 'en' in label_store and 'de' in label_store and 'fr' not in label_store
+    assert label_store.current_bytes == 2 * one_lang_bytes
+    label_store.observe_latest_fill(1)
+    label_store.observe_latest_fill(2)
+    assert 'en' not in label_store and label_store.current_bytes == 0
+
+def test_project_lookup_misses_not_kept(monkeypatch):
+    project_ids = {}
+    monkeypatch.setattr(reference, 'get_project_internal_id_from_wikiencoding',
+                        lambda proj_code, session: project_ids.get(proj_code))
+    reference_data = reference.ReferenceData()
+    assert reference_data.get_project_internal_id('newwiki', None) is None
+    assert reference_data.project_internal_ids == {}
+    project_ids['newwiki'] = 1234
+    assert reference_data.get_project_internal_id('newwiki', None) == 1234
+
+def test_stream_ndjson(client, test_jsons):
+    resp = client.get('/v1/gender/gap/latest/gte_one_sitelink/properties?date_of_birth=all&label_lang=en&stream=ndjson')
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    expected_json = test_jsons['properties_dob.json']
+    assert resp.mimetype == 'application/x-ndjson'
+    assert lines[0]['meta']['label_lang'] == 'en'
+    assert len(lines[1:-1]) == len(expected_json['metrics'])
+    assert lines[-1]['bias_labels']['6581097'] == expected_json['meta']['bias_labels']['6581097']
+
+def test_stream_json_matches_unstreamed(client):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all'
+    unstreamed = client.get(url).get_json()
+    streamed = json.loads(client.get(url + '&stream=json').get_data(as_text=True))
+    assert streamed['metrics'] == unstreamed['metrics']
+
+def test_available_snapshots(client):
+    snapshots = client.get('/v1/available_snapshots/').get_json()
+    assert len(snapshots) > 0
+
+def test_admin_refresh_fills(client, monkeypatch):
+    monkeypatch.delenv(utils.ADMIN_TOKEN_ENV_VAR, raising=False)
+    assert client.post('/v1/admin/refresh_fills').status_code == 403
+    monkeypatch.setenv(utils.ADMIN_TOKEN_ENV_VAR, 'sekrit')
+    assert client.post('/v1/admin/refresh_fills', headers={utils.ADMIN_TOKEN_HEADER: 'wrong'}).status_code == 403
+    rv = client.post('/v1/admin/refresh_fills', headers={utils.ADMIN_TOKEN_HEADER: 'sekrit'})
+    assert rv.get_json()['latest_fill_id'] == app.fill_registry.snapshot().latest_fill_id
+
+def test_columnar_snapshot_matches_database(client, tmp_path):
+    session = db.session_factory()
+    fill_id = app.fill_registry.snapshot().latest_fill_id
+    assert columnar.export_fill(session, fill_id, str(tmp_path)) > 0
+    columnar_snapshot = columnar.ColumnarSnapshot(columnar.fill_dir(str(tmp_path), fill_id))
+    properties_obj = session.query(metric_properties_j).filter(metric_properties_j.properties_len == 1).first()
+    ordered_query_params = {prop: 'all' for prop in properties_obj.properties}
+    population_id = PopulationDefinition.GTE_ONE_SITELINK.value
+    columnar_metrics, _ = columnar_snapshot.get_metrics(population_id, properties_obj, ordered_query_params)
+    db_metrics, _ = query.get_metrics(session, fill_id, population_id, properties_obj, ordered_query_params)
+    assert [tuple(row)[-3:] for row in columnar_metrics] == [tuple(row)[-3:] for row in db_metrics]
+
+def test_ranked_ties_broken_alike_by_every_engine(client, tmp_path):
+    session = db.session_factory()
+    fill_id = app.fill_registry.snapshot().latest_fill_id
+    columnar.export_fill(session, fill_id, str(tmp_path))
+    columnar_snapshot = columnar.ColumnarSnapshot(columnar.fill_dir(str(tmp_path), fill_id))
+    population_id = PopulationDefinition.GTE_ONE_SITELINK.value
+    tied = False
+    for properties_obj in session.query(metric_properties_j).filter(metric_properties_j.properties_len == 1):
+        ordered_query_params = {prop: 'all' for prop in properties_obj.properties}
+        all_rows, columns = columnar_snapshot.get_metrics(population_id, properties_obj, ordered_query_params)
+        group_totals = {}
+        for row in all_rows:
+            group_totals[row[1]] = group_totals.get(row[1], 0) + row[-1]
+        # only ties can come out in a different order
+        tied = tied or len(set(group_totals.values())) < len(group_totals)
+        for offset in range(len(group_totals)):
+            ranking = utils.GapRanking('total', 1, offset)
+            db_page, _ = query.get_metrics(session, fill_id, population_id, properties_obj, ordered_query_params,
+                                           ranking=ranking)
+            columnar_page = query.rank_metric_rows(all_rows, columns, ranking)
+            assert [tuple(row)[-3:] for row in columnar_page] == [tuple(row)[-3:] for row in db_page]
+    assert tied
+
+def test_columnar_snapshot_reloaded_after_reexport(client, tmp_path):
+    session = db.session_factory()
+    fill_id = app.fill_registry.snapshot().latest_fill_id
+    columnar.export_fill(session, fill_id, str(tmp_path))
+    first_snapshot = columnar.get_columnar_snapshot(fill_id, store_dir=str(tmp_path))
+    assert columnar.get_columnar_snapshot(fill_id, store_dir=str(tmp_path)) is first_snapshot
+    columnar.export_fill(session, fill_id, str(tmp_path))
+    assert columnar.get_columnar_snapshot(fill_id, store_dir=str(tmp_path)) is not first_snapshot
+
+def test_materialized_wide_table_matches_json_extraction(client):
+    session = db.session_factory()
+    fill_id = app.fill_registry.snapshot().latest_fill_id
+    assert materialize.materialize_fill(session, fill_id)
+    properties_obj = session.query(metric_properties_j).filter(metric_properties_j.properties_len == 1).first()
+    ordered_query_params = {prop: 'all' for prop in properties_obj.properties}
+    population_id = PopulationDefinition.GTE_ONE_SITELINK.value
+    wide_table = materialize.get_wide_table(session, fill_id, properties_obj)
+    wide_metrics = materialize.build_wide_metrics_query(session, wide_table, population_id, properties_obj,
+                                                        ordered_query_params).all()
+    json_metrics, _ = query.get_metrics(session, fill_id, population_id, properties_obj, ordered_query_params)
+    assert [tuple(row)[1:] for row in wide_metrics] == [tuple(row)[1:] for row in json_metrics]
+
+def test_batch(client):
+    gap_specs = [{'population': 'gte_one_sitelink', 'params': {'citizenship': 'all', 'label_lang': 'en'}},
+                 {'population': 'all_wikidata', 'params': {'project': 'all'}},
+                 {'population': 'gte_one_sitelink', 'params': {'citizenship': 'all', 'label_lang': 'en'}}]
+    results = client.post('/v1/batch', json={'queries': gap_specs}).get_json()['results']
+    assert len(results) == len(gap_specs)
+    assert results[0] == results[2]
+    assert results[1]['meta']['population_corrected'] == True
+    single = client.get('/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all&label_lang=en').get_json()
+    assert results[0] == single
+    unknown_snapshot = client.post('/v1/batch', json={'queries': [{'snapshot': '1999-01-01'}]})
+    assert unknown_snapshot.status_code == 200
+    assert 'queries[0]' in unknown_snapshot.get_json()['errors']
+
+def test_coverage(client):
+    coverage = client.get('/v1/coverage/latest/gte_one_sitelink').get_json()['coverage']
+    coverage_by_properties = {tuple(row['aggregation_properties']): row['coverage'] for row in coverage}
+    assert coverage_by_properties[()] == 1.0
+    gap_meta = client.get('/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all').get_json()['meta']
+    assert coverage_by_properties[('CITIZENSHIP',)] == gap_meta['coverage']
+    assert 'snapshot' in client.get('/v1/coverage/1999-01-01/gte_one_sitelink').get_json()['errors']
+
+def test_concurrent_gap_queries_match_serial(client, monkeypatch):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all&label_lang=en'
+    app.gap_cache.clear()
+    serial_body = client.get(url).get_data()
+    monkeypatch.setattr(app, 'CONCURRENT_GAP_QUERIES', True)
+    app.gap_cache.clear()
+    assert client.get(url).get_data() == serial_body
+
+def test_failed_label_preload_logged(monkeypatch):
+    logged = []
+    monkeypatch.setattr(concurrency.log, 'error', lambda msg, exc_info=None: logged.append(exc_info))
+
+    def failing_query(session):
+        raise RuntimeError('no connection')
+
+    preload = concurrency.submit_query(db.session_factory, failing_query)
+    preload.add_done_callback(concurrency.log_query_failure)
+    with pytest.raises(RuntimeError):
+        preload.result()
+    deadline = time.time() + 5
+    while not logged and time.time() < deadline:
+        time.sleep(0.01)
+    assert [type(e) for e in logged] == [RuntimeError]
+
+def test_server_timing_and_metrics(client):
+    resp = client.get('/v1/gender/gap/latest/gte_one_sitelink/properties?date_of_birth=all&label_lang=fr')
+    timed_stages = [timing.split(';')[0] for timing in resp.headers['Server-Timing'].split(', ')]
+    assert timed_stages[0] == 'validation' and timed_stages[-1] == 'total'
+    exposition = client.get('/metrics').get_data(as_text=True)
+    assert 'humaniki_gap_stage_seconds_count{stage="sql"}' in exposition
+
+def test_slow_queries(client, monkeypatch):
+    monkeypatch.setenv(utils.ADMIN_TOKEN_ENV_VAR, 'sekrit')
+    monkeypatch.setattr(app.slow_query_log, 'threshold_seconds', 0)
+    app.slow_query_log.clear()
+    app.gap_cache.clear()
+    client.get('/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all')
+    assert client.get('/v1/admin/slow_queries').status_code == 403
+    slow_queries = client.get('/v1/admin/slow_queries', headers={utils.ADMIN_TOKEN_HEADER: 'sekrit'}).get_json()
+    assert slow_queries['slow_queries'][0]['row_count'] > 0
+    assert 'sql' in slow_queries['slow_queries'][0]['stage_timings']
+
+def test_slow_query_timings_only_read_once_finished():
+    slow_log = querylog.SlowQueryLog(threshold_seconds=0)
+    stage_timer = StageTimer()
+    session = db.session_factory()
+    with stage_timer.stage('sql'):
+        slow_log.observe(session, session.query(metric.fill_id), 2.0, 1, stage_timer=stage_timer)
+    session.close()
+    # the request thread is still writing its timings
+    assert slow_log.entries()[0]['stage_timings'] is None
+    stage_timer.observe()
+    assert list(slow_log.entries()[0]['stage_timings']) == ['sql']
+    assert 'stage_timer' not in slow_log.entries()[0]
+
+def test_lazy_sql_inlines_params():
+    from sqlalchemy.dialects import mysql
+    properties_obj = metric_properties_j(id=2, properties=[Properties.CITIZENSHIP.value])
+    statement, params = query.build_metrics_statement([1, 2], 1, properties_obj, None)
+    assert 'IN (1, 2)' in str(querylog.LazySQL(statement, params, dialect=mysql.dialect()))
+    ranked_statement, ranked_params = query.build_metrics_statement(1, 1, properties_obj, None,
+                                                                    ranking=utils.GapRanking('total', 5, 10))
+    assert 'LIMIT 10, 5' in str(querylog.LazySQL(ranked_statement, ranked_params, dialect=mysql.dialect()))
+
+def test_metrics_statement_shared_by_shape():
+    properties_obj = metric_properties_j(id=3, properties=[Properties.CITIZENSHIP.value, Properties.DATE_OF_BIRTH.value])
+    preds = lambda citizenship, years: {Properties.CITIZENSHIP.value: utils.AggregationPredicate('eq', (citizenship,)),
+                                        Properties.DATE_OF_BIRTH.value: utils.AggregationPredicate('between', years)}
+    statement, params = query.build_metrics_statement(1, 1, properties_obj, preds(16, (1900, 1950)))
+    same_statement, other_params = query.build_metrics_statement(2, 1, properties_obj, preds(142, (1800, 1850)))
+    assert statement is same_statement
+    assert params != other_params
+    exact_year = {Properties.CITIZENSHIP.value: 'all',
+                  Properties.DATE_OF_BIRTH.value: utils.AggregationPredicate('eq', ('1966',))}
+    assert query.build_metrics_statement(1, 1, properties_obj, exact_year)[0] is not statement
+
+def test_conditional_get(client):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all'
+    resp = client.get(url)
+    assert resp.headers['Cache-Control'] == 'public, no-cache'
+    not_modified = client.get(url, headers={'If-None-Match': resp.headers['ETag']})
+    assert not_modified.status_code == 304 and not not_modified.get_data()
+    snapshot = resp.get_json()['meta']['snapshot']
+    dated = client.get(f'/v1/gender/gap/{snapshot}/gte_one_sitelink/properties?citizenship=all')
+    assert 'immutable' in dated.headers['Cache-Control']
+
+def test_gzip_negotiation(client):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?project=all&citizenship=all&date_of_birth=all'
+    plain = client.get(url)
+    compressed = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert 'Accept-Encoding' in compressed.headers['Vary']
+    if compressed.headers.get('Content-Encoding') == 'gzip':
+        assert gzip.decompress(compressed.get_data()) == plain.get_data()
+        assert compressed.headers['ETag'] != plain.headers['ETag']
+    assert ResponseCache().put(('gender', 1, 1, False, (), None), b' ' * 2048)['gzip']
+
+def test_columnar_format(client):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all&label_lang=en'
+    data_points = client.get(url).get_json()['metrics']
+    columnar_metrics = client.get(url + '&format=columnar').get_json()['metrics']
+    assert columnar_metrics['length'] == len(data_points)
+    assert columnar_metrics['item']['citizenship'] == [data_point['item']['citizenship'] for data_point in data_points]
+    for bias_value, totals in columnar_metrics['values'].items():
+        assert totals == [data_point['values'].get(bias_value) for data_point in data_points]
+    assert 'errors' in client.get(url + '&format=xml').get_json()
+
+def test_decimal_totals_encoded_in_every_format(monkeypatch):
+    data_points = [{'order': 0, 'item': {'citizenship': '16'}, 'item_label': {}, 'values': {6581072: Decimal(5)}}]
+    meta = {'coverage': Decimal('0.5'), 'bias_labels': {6581072: 'female'}}
+    for gap_format in formats.available_gap_formats():
+        body, _ = formats.render_gap(gap_format, meta, data_points, {6581072: 'female'})
+        assert body
+    assert json.loads(formats.render_gap('json', meta, data_points, None)[0])['metrics'][0]['values'] == {'6581072': 5}
+    monkeypatch.setattr(formats, 'orjson', None)
+    assert json.loads(formats.dumps_json(meta)) == {'coverage': 0.5, 'bias_labels': {'6581072': 'female'}}
+    chunks, _ = streaming.stream_gap_response('ndjson', {}, iter(data_points), None)
+    assert json.loads(list(chunks)[1])['values'] == {'6581072': 5}
+
+def test_prerendered_responses_served(client, tmp_path, monkeypatch):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?citizenship=all&label_lang=en'
+    live = client.get(url)
+    monkeypatch.setattr(prerender, 'PRERENDER_PROPERTIES', ['citizenship'])
+    assert prerender.prerender_fill('latest', str(tmp_path), label_langs=[None, 'en']) > 0
+    monkeypatch.setattr(prerender, 'PRERENDER_DIR', str(tmp_path))
+    prerendered = client.get(url)
+    assert prerendered.get_data() == live.get_data()
+    assert prerendered.headers['ETag'] == live.headers['ETag']
+
+def test_ranked_page(client):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?project=all&citizenship=all&date_of_birth=all'
+    data_points = client.get(url).get_json()['metrics']
+    group_total = lambda data_point: sum(data_point['values'].values())
+    ranked = client.get(url + '&sort=total&limit=3&offset=1').get_json()
+    assert ranked['meta']['ranking'] == {'sort': 'total', 'limit': 3, 'offset': 1}
+    assert [group_total(dp) for dp in ranked['metrics']] == \
+           sorted(map(group_total, data_points), reverse=True)[1:4]
+    assert 'errors' in client.get(url + '&sort=alphabetical').get_json()
+    assert 'ranking' in client.get(url + '&limit=0').get_json()['errors']
+
+def test_evolution_matches_gap(client):
+    evolution = client.get('/v1/gender/evolution/all/gte_one_sitelink/properties?citizenship=all').get_json()
+    assert evolution['meta']['snapshots'] == sorted(evolution['meta']['snapshots'])
+    for snapshot_i, snapshot in enumerate(evolution['meta']['snapshots']):
+        gap = client.get(f'/v1/gender/gap/{snapshot}/gte_one_sitelink/properties?citizenship=all').get_json()
+        assert gap['meta']['coverage'] == evolution['meta']['coverage'][snapshot_i]
+        gap_totals = {dp['item']['citizenship']: dp['values'] for dp in gap['metrics']}
+        for data_point in evolution['metrics']:
+            series_totals = {bias_value: series[snapshot_i] for bias_value, series in data_point['values'].items()
+                             if series[snapshot_i] is not None}
+            assert series_totals == gap_totals.get(data_point['item']['citizenship'], {})
+    assert 'errors' in client.get('/v1/gender/evolution/1999-01-01/gte_one_sitelink/properties').get_json()
+    bad_value = client.get('/v1/gender/evolution/all/gte_one_sitelink/properties?citizenship=notaqid').get_json()
+    assert list(bad_value['errors']) == ['aggregations_id_preds']
+
+def test_diff_matches_gaps(client):
+    snapshots = sorted(snapshot['date'] for snapshot in client.get('/v1/available_snapshots/').get_json())
+    query = 'citizenship=all'
+    diff = client.get(f'/v1/gender/diff/{snapshots[0]}/latest/gte_one_sitelink/properties?{query}').get_json()
+    from_gap, to_gap = [{dp['item']['citizenship']: dp['values'] for dp in client.get(
+        f'/v1/gender/gap/{snapshot}/gte_one_sitelink/properties?{query}').get_json()['metrics']}
+        for snapshot in (snapshots[0], 'latest')]
+    for data_point in diff['metrics']:
+        citizenship = data_point['item']['citizenship']
+        for bias_value, (from_total, to_total) in data_point['values'].items():
+            assert from_total == from_gap.get(citizenship, {}).get(bias_value, 0)
+            assert to_total == to_gap.get(citizenship, {}).get(bias_value, 0)
+            assert data_point['delta'][bias_value] == to_total - from_total
+    bad_value = client.get(f'/v1/gender/diff/{snapshots[0]}/latest/gte_one_sitelink/properties?citizenship=notaqid')
+    assert list(bad_value.get_json()['errors']) == ['aggregations_id_preds']
+    top = client.get(f'/v1/gender/diff/{snapshots[0]}/latest/gte_one_sitelink/properties?{query}&limit=2').get_json()
+    assert [abs(dp['total_delta']) for dp in top['metrics']] == \
+           sorted((abs(dp['total_delta']) for dp in diff['metrics']), reverse=True)[:2]
+
+def test_year_buckets(client):
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?date_of_birth=all'
+    decade_totals = {}
+    for data_point in client.get(url).get_json()['metrics']:
+        decade = str(int(data_point['item']['date_of_birth']) // 10 * 10)
+        for bias_value, total in data_point['values'].items():
+            decade_totals.setdefault(decade, {}).setdefault(bias_value, 0)
+            decade_totals[decade][bias_value] += total
+    bucketed = client.get(url + '&bucket=decade').get_json()
+    assert bucketed['meta']['bucket'] == 10
+    assert {dp['item']['date_of_birth']: dp['values'] for dp in bucketed['metrics']} == decade_totals
+    assert 'errors' in client.get(url.replace('date_of_birth', 'citizenship') + '&bucket=decade').get_json()
+
+def test_year_bucket_totals_are_integers(client):
+    from sqlalchemy.dialects import mysql
+    properties_obj = metric_properties_j(id=4, properties=[Properties.DATE_OF_BIRTH.value])
+    statement, params = query.build_metrics_statement(1, 1, properties_obj, None, bucket_width=10)
+    # mysql sums integers as decimals, the cast keeps them integers in every format
+    assert 'CAST(sum(metric.total) AS SIGNED INTEGER)' in str(querylog.LazySQL(statement, params, dialect=mysql.dialect()))
+    url = '/v1/gender/gap/latest/gte_one_sitelink/properties?date_of_birth=all&bucket=decade'
+    for data_point in client.get(url).get_json()['metrics']:
+        assert all(type(total) is int for total in data_point['values'].values())
+
+def test_year_predicates_for_birth_and_death():
+    preds = utils.transform_ordered_aggregations_with_year_fns({Properties.DATE_OF_BIRTH.value: '1900~1950',
+                                                                Properties.DATE_OF_DEATH.value: '2000'})
+    assert preds == {Properties.DATE_OF_BIRTH.value: utils.AggregationPredicate('between', (1900, 1950)),
+                     Properties.DATE_OF_DEATH.value: utils.AggregationPredicate('eq', ('2000',))}
+
+def test_single_flight_shares_one_computation():
+    flights = SingleFlight(timeout=5)
+    started, release, calls, results = threading.Event(), threading.Event(), [], []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'rendered'
+
+    leader = threading.Thread(target=lambda: results.append(flights.do('key', compute)))
+    leader.start()
+    started.wait()
+    waiters = [threading.Thread(target=lambda: results.append(flights.do('key', compute))) for _ in range(3)]
+    for waiter in waiters:
+        waiter.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + waiters:
+        thread.join()
+    assert results == ['rendered'] * 4
+    assert len(calls) == 1
+    assert len(flights) == 0
+    with pytest.raises(ValueError):
+        flights.do('key', lambda: int('not a number'))
+
+def test_single_flight_releases_waiters_when_interrupted():
+    flights = SingleFlight(timeout=5)
+    started, release, waiter_errors = threading.Event(), threading.Event(), []
+
+    def interrupted():
+        started.set()
+        release.wait()
+        raise KeyboardInterrupt
+
+    def lead():
+        try:
+            flights.do('key', interrupted)
+        except KeyboardInterrupt:
+            pass
+
+    def wait():
+        try:
+            flights.do('key', lambda: 'never computed')
+        except Exception as e:
+            waiter_errors.append(e)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+    waiter = threading.Thread(target=wait)
+    waiter.start()
+    time.sleep(0.1)
+    wait_start = time.time()
+    release.set()
+    for thread in [leader, waiter]:
+        thread.join()
+    # the waiter is told right away rather than sitting out the timeout
+    assert time.time() - wait_start < 1
+    assert [type(e) for e in waiter_errors] == [FlightAborted]
+    assert len(flights) == 0
+
+def test_admission_limits_each_cost_class():
+    admission = AdmissionControl(limits={'cheap': None, 'expensive': 1}, max_queued={'expensive': 1},
+                                 queue_seconds={'expensive': 0.05}, retry_after={'expensive': 30})
+    release = admission.acquire('expensive')
+    # cheap requests are never held back by expensive ones
+    with admission.admit('cheap'):
+        pass
+    with pytest.raises(Overloaded) as overloaded:
+        admission.acquire('expensive')
+    assert overloaded.value.retry_after == 30
+    release()
+    release()
+    with admission.admit('expensive'):
+        pass
+
+def test_metric_row_counts_never_counted_on_request():
+    session = db.session_factory()
+    fill_ids = [fill_id for (fill_id,) in session.query(metric.fill_id).distinct().order_by(metric.fill_id)]
+    population_id, properties_id, rows = session.query(metric.population_id, metric.properties_id, func.count()) \
+        .filter(metric.fill_id == fill_ids[-1]) \
+        .group_by(metric.population_id, metric.properties_id) \
+        .first()
+    session.close()
+    row_counts = MetricRowCounts(db.session_factory)
+
+    def wait_for_counts():
+        deadline = time.time() + 5
+        while row_counts._counting and time.time() < deadline:
+            time.sleep(0.01)
+        assert row_counts._counting == set()
+
+    # the fill registry's listener only starts the count, it runs under the refresh lock
+    row_counts.observe_latest_fill(fill_ids[-1])
+    wait_for_counts()
+    assert row_counts.get(fill_ids[-1], population_id, properties_id) == rows
+    # a fill that is not counted yet is estimated by the latest one while it is counted in the background
+    assert row_counts.get(-1, population_id, properties_id) == rows
+    wait_for_counts()
+
+def test_overloaded_requests_rejected(client, monkeypatch):
+    monkeypatch.setattr(app, 'gap_admission', AdmissionControl(limits={'cheap': 0, 'moderate': 0, 'expensive': 0},
+                                                               max_queued={}))
+    app.gap_cache.clear()
+    response = client.get('/v1/gender/gap/latest/gte_one_sitelink/properties?date_of_birth=all&bucket=decade')
+    assert response.status_code == 503
+    assert 'admission' in response.get_json()['errors']
+    assert int(response.headers['Retry-After']) > 0
@@ -1 +1,3 @@
-from humaniki_backend.app import app
+from humaniki_backend.app import app, warm_up
+
+warm_up()